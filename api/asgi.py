@@ -0,0 +1,491 @@
+"""ASGI entry point serving the game API without blocking on I/O.
+
+Run with:
+    uvicorn asgi:app --app-dir api --workers 4
+
+The endpoints mirror the Flask app in index.py and reuse its game logic,
+sessions, caches and configuration; only the I/O is different. Session-store,
+blockchain-file and image-cache access run in worker threads via
+asyncio.to_thread, and image-proxy fetches go through a pooled
+httpx.AsyncClient. A slow disk or a slow upstream never holds the event loop,
+so one process can keep thousands of slow clients in flight.
+
+Needs the extra packages in requirements-asgi.txt.
+"""
+import asyncio
+import contextlib
+import functools
+import hashlib
+import logging
+import os
+import time
+import traceback
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.datastructures import Headers
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+import index
+
+PUBLIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public')
+
+http_client = None
+_inflight_images = {}
+
+
+def json_response(data, status_code=200):
+    # Same encoder settings as Flask's jsonify, so both entry points answer byte-for-byte alike
+    body = index.app.json.dumps(data, separators=(",", ":")) + "\n"
+    return Response(body, status_code, media_type="application/json")
+
+
+def error_response(message, status_code):
+    return json_response({"error": message}, status_code)
+
+
+def set_session_cookie(response, session_id):
+    response.set_cookie('session_id', session_id, httponly=True, samesite='strict')
+    return response
+
+
+def session_endpoint(handler):
+    """Count the handler's session loads and saves under its name, like Flask's endpoints"""
+    @functools.wraps(handler)
+    async def wrapper(request):
+        token = index.session_io_endpoint.set(handler.__name__)
+        try:
+            return await handler(request)
+        finally:
+            index.session_io_endpoint.reset(token)
+    return wrapper
+
+
+async def load_session(session_id):
+    return await asyncio.to_thread(index.get_user_session, session_id)
+
+
+async def save_session(session_id, session_data):
+    if index.session_flusher is not None:
+        # Write-behind only marks the session dirty, no I/O to wait for
+        index.save_user_session(session_id, session_data)
+    else:
+        await asyncio.to_thread(index.save_user_session, session_id, session_data)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def _state_payload(session_id, session_data):
+    game_state = session_data['state']
+    node = index.STORY_GRAPH.get(game_state["current_node_id"])
+    if not node:
+        return None
+    image_url = index.state_image_url(node, game_state, session_data, session_id)
+    if index.image_prefetcher is not None and not node.is_end:
+        index.image_prefetcher.schedule(session_id, node, game_state, session_data)
+    return index.state_body(node, game_state.get("score", 0), image_url)
+
+
+async def state_response(session_id, session_data):
+    if index.IMAGE_PROXY:
+        # Registering a new proxy key may touch the disk
+        body = await asyncio.to_thread(_state_payload, session_id, session_data)
+    else:
+        body = _state_payload(session_id, session_data)
+    if body is None:
+        return error_response("Invalid node", 400)
+    return set_session_cookie(Response(body, media_type="application/json"), session_id)
+
+
+def new_session_id():
+    return hashlib.md5(f"{time.time()}-{os.urandom(8).hex()}".encode()).hexdigest()
+
+
+@session_endpoint
+async def get_current_state(request):
+    try:
+        session_id = request.cookies.get('session_id') or new_session_id()
+        session_data = await load_session(session_id)
+        if not session_data.get('state'):
+            index.start_new_game(session_data)
+            await save_session(session_id, session_data)
+            logging.info(f"Created new state for session {session_id}")
+        return await state_response(session_id, session_data)
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+@session_endpoint
+async def make_choice(request):
+    try:
+        data = await read_json(request)
+        if not data:
+            return error_response("No data provided", 400)
+        if not isinstance(data, dict):
+            return error_response("Request body must be a JSON object", 400)
+
+        session_id = request.cookies.get('session_id')
+        if not session_id:
+            return error_response("No session found", 400)
+
+        choice_index = data.get("choice_index")
+        if choice_index is None:
+            return error_response("No choice index provided", 400)
+        try:
+            choice_index = int(choice_index)
+        except ValueError:
+            return error_response("Choice index must be a number", 400)
+
+        session_data = await load_session(session_id)
+        game_state = session_data.get('state')
+        if not game_state:
+            return error_response("No game in progress", 400)
+
+        error = index.apply_choice(game_state, choice_index, session_id)
+        if error:
+            return error_response(error, 400)
+        await save_session(session_id, session_data)
+        return await state_response(session_id, session_data)
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+@session_endpoint
+async def make_choices(request):
+    try:
+        data = await read_json(request)
+        if not data:
+            return error_response("No data provided", 400)
+        if not isinstance(data, dict):
+            return error_response("Request body must be a JSON object", 400)
+
+        session_id = request.cookies.get('session_id')
+        if not session_id:
+            return error_response("No session found", 400)
+
+        session_data = await load_session(session_id)
+        game_state = session_data.get('state')
+        if not game_state:
+            return error_response("No game in progress", 400)
+
+        new_state, error = index.apply_choices(game_state, data.get("choice_indexes"), session_id)
+        if error:
+            step, message = error
+            return json_response({"error": message, "step": step}, 400)
+        session_data['state'] = new_state
+        await save_session(session_id, session_data)
+        return await state_response(session_id, session_data)
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+@session_endpoint
+async def reset_game(request):
+    try:
+        session_id = request.cookies.get('session_id') or new_session_id()
+        session_data = await load_session(session_id)
+        index.start_new_game(session_data)
+        await save_session(session_id, session_data)
+        logging.info(f"Reset game state for session {session_id}")
+        return await state_response(session_id, session_data)
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+@session_endpoint
+async def generate_share_image(request):
+    try:
+        session_id = request.cookies.get('session_id')
+        if not session_id:
+            return error_response("No session found", 400)
+
+        session_data = await load_session(session_id)
+        game_state = session_data.get('state')
+        if not game_state:
+            return error_response("No game in progress", 400)
+
+        details, error = await asyncio.to_thread(index.share_image_details, game_state, session_data, session_id)
+        if error:
+            return error_response(error, 400)
+        return json_response(details)
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+def cached_image_response(request, data, etag, media_type):
+    etag = f'"{etag}"'
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'ETag': etag}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type=media_type, headers=headers)
+
+
+async def fetch_upstream_image(key, url):
+    """Fetch and cache one image; concurrent requests for the same key share the fetch"""
+    task = _inflight_images.get(key)
+    if task is None:
+        async def fetch():
+            try:
+                upstream = index.IMAGE_UPSTREAM_BASE + url[len(index.POLLINATIONS_BASE_URL):]
+                with index.timed('image_fetch_seconds'):
+                    response = await http_client.get(upstream)
+                response.raise_for_status()
+                await asyncio.to_thread(index.image_cache.put, key, response.content)
+                return response.content
+            finally:
+                _inflight_images.pop(key, None)
+        task = _inflight_images[key] = asyncio.ensure_future(fetch())
+    return await asyncio.shield(task)
+
+
+async def get_proxied_image(request):
+    key = request.path_params['key']
+    if not index.IMAGE_PROXY or len(key) != 64 or key.strip('0123456789abcdef'):
+        return error_response("Image not found", 404)
+
+    try:
+        data = await asyncio.to_thread(index.image_cache.get, key)
+        if data is None:
+            url = await asyncio.to_thread(index.image_cache.upstream_url, key)
+            if url is None or not url.startswith(index.POLLINATIONS_BASE_URL):
+                return error_response("Image not found", 404)
+            data = await fetch_upstream_image(key, url)
+        if index.image_prefetcher is not None:
+            index.image_prefetcher.record_use(key)
+        return cached_image_response(request, data, key, index._sniff_image_type(data))
+
+    except httpx.HTTPError as e:
+        logging.error(f"Error fetching image {key}: {str(e)}")
+        return error_response("Image generator unavailable", 502)
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+async def get_share_image(request):
+    name = request.path_params['name']
+    key, _, extension = name.partition('.')
+    if (index.SHARE_IMAGE_MODE != 'composite' or len(key) != 64 or key.strip('0123456789abcdef')
+            or extension not in ('png', 'webp')):
+        return error_response("Image not found", 404)
+
+    try:
+        data = await asyncio.to_thread(index.share_images.render, name)
+        if data is None:
+            return error_response("Image not found", 404)
+        return cached_image_response(request, data, key, f"image/{extension}")
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+async def save_to_blockchain(request):
+    try:
+        data = await read_json(request)
+        if not data:
+            return error_response("No data provided", 400)
+
+        wallet_address = data.get('walletAddress')
+        game_data = data.get('gameData')
+        signature = data.get('signature')
+        message = data.get('message')
+        if not all([wallet_address, game_data, signature, message]):
+            return error_response("Missing required fields", 400)
+
+        verifier = index.signature_verifier
+        error = verifier.format_error(wallet_address, message, signature)
+        if error:
+            return error_response(error, 400)
+        future = verifier.submit(wallet_address, message, signature)
+        # Shielded so a timeout leaves the pool's future (and its cache entry) alone
+        if not await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), index.SIGNATURE_TIMEOUT):
+            return error_response("Signature does not match wallet", 400)
+
+        blockchain_record = index.create_blockchain_record(wallet_address, game_data, signature, message)
+        if index.blockchain_writer is not None:
+            # Wait for the group commit without tying up a thread. The shield keeps a
+            # timeout from cancelling the writer's future; the record may still be
+            # committed, and a retry of the same signed save is deduplicated.
+            future = index.blockchain_writer.submit(blockchain_record)
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), index.BLOCKCHAIN_COMMIT_TIMEOUT)
+        else:
+            await asyncio.to_thread(index.store_blockchain_record, blockchain_record)
+        logging.info(f"Saved blockchain record for wallet {wallet_address}")
+
+        return json_response({
+            "success": True,
+            "blockchainHash": blockchain_record['blockchainHash'],
+            "message": "Game data saved to blockchain successfully"
+        })
+
+    except (index.BlockchainBusy, index.SignatureVerifierUnavailable) as e:
+        response = error_response(str(e), 503)
+        response.headers['Retry-After'] = '1'
+        return response
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+async def load_from_blockchain(request):
+    try:
+        wallet_address = request.query_params.get('walletAddress')
+        if not wallet_address:
+            return error_response("Wallet address required", 400)
+
+        start, limit, error = index.blockchain_page_args(request.query_params.get('cursor'),
+                                                         request.query_params.get('limit'))
+        if error:
+            return error_response(error, 400)
+
+        summary = await asyncio.to_thread(index.blockchain_log.summary, wallet_address)
+        etag = f'"{index.blockchain_etag(summary, start, limit)}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in request.headers.get('if-none-match', ''):
+            return Response(status_code=304, headers=headers)
+
+        payload = await asyncio.to_thread(index.blockchain_page, wallet_address, summary, start, limit)
+        response = json_response(payload)
+        response.headers.update(headers)
+        return response
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+async def get_wallet_balance(request):
+    try:
+        wallet_address = request.query_params.get('walletAddress')
+        if not wallet_address:
+            return error_response("Wallet address required", 400)
+        if index.WALLET_BALANCE_PROVIDER == 'rpc' and not index.valid_wallet_address(wallet_address):
+            return error_response("Invalid wallet address", 400)
+        return json_response(await asyncio.to_thread(index.wallet_balance, wallet_address))
+
+    except index.requests.RequestException as e:
+        logging.error(f"Error fetching balance for {wallet_address}: {str(e)}")
+        return error_response("Balance service unavailable", 502)
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+async def get_metrics(request):
+    if not index.METRICS_TOKEN or not index.METRICS_ENABLED:
+        return error_response("Metrics are disabled", 404)
+    if not index.metrics_token_ok(request.headers.get('authorization')):
+        return error_response("Unauthorized", 401)
+
+    try:
+        def render():
+            index.write_metrics_snapshot()
+            return index.render_prometheus(index.collect_worker_snapshots())
+        return Response(await asyncio.to_thread(render), media_type='text/plain; version=0.0.4')
+
+    except Exception as e:
+        traceback.print_exc()
+        return error_response(str(e), 500)
+
+
+class MetricsMiddleware:
+    """Per-route request counts and latency, recorded into index.metrics like the Flask hooks"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            # The static-file mount sits at '', which would make an empty label
+            route = (route.path or '/<path:path>') if route is not None else 'unmatched'
+            method = scope['method']
+            index.metrics.observe('http_request_duration_seconds', time.perf_counter() - start, (route, method))
+            index.metrics.inc('http_requests_total', (route, method, str(status[0])))
+
+
+class AssetFiles(StaticFiles):
+    """Serves the in-memory assets from index.static_assets, and anything else from disk"""
+    async def get_response(self, path, scope):
+        name = 'index.html' if path in ('.', '') else path.replace(os.sep, '/')
+        headers = Headers(scope=scope)
+        result = index.static_assets.respond(name, headers.get('accept-encoding'), headers.get('if-none-match'))
+        if result is None:
+            return await super().get_response(path, scope)
+        status, body, response_headers = result
+        return Response(body, status, headers=response_headers)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global http_client
+    index.start_metrics_snapshots()
+    if index.session_sweeper is not None:
+        index.session_sweeper.start()
+    await asyncio.to_thread(index.static_assets.load)
+    http_client = httpx.AsyncClient(
+        timeout=index.IMAGE_FETCH_TIMEOUT,
+        limits=httpx.Limits(max_connections=index.IMAGE_FETCH_POOL_SIZE * 4,
+                            max_keepalive_connections=index.IMAGE_FETCH_POOL_SIZE))
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        if index.session_flusher is not None:
+            await asyncio.to_thread(index.session_flusher.flush)
+
+
+routes = [
+    Route('/api/state', get_current_state, methods=['GET']),
+    Route('/api/choice', make_choice, methods=['POST']),
+    Route('/api/choices', make_choices, methods=['POST']),
+    Route('/api/reset', reset_game, methods=['POST']),
+    Route('/api/share-image', generate_share_image, methods=['GET']),
+    Route('/api/share-image/{name}', get_share_image, methods=['GET']),
+    Route('/api/image/{key}', get_proxied_image, methods=['GET']),
+    Route('/api/save-to-blockchain', save_to_blockchain, methods=['POST']),
+    Route('/api/load-from-blockchain', load_from_blockchain, methods=['GET']),
+    Route('/api/wallet-balance', get_wallet_balance, methods=['GET']),
+    Route('/api/metrics', get_metrics, methods=['GET']),
+    Mount('/', AssetFiles(directory=PUBLIC_DIR, html=True)),
+]
+
+middleware = [
+    Middleware(MetricsMiddleware),
+    Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['GET', 'POST', 'OPTIONS'],
+               allow_headers=['Content-Type', 'Authorization'], expose_headers=['Set-Cookie'],
+               allow_credentials=True),
+]
+
+app = Starlette(routes=routes, middleware=middleware, lifespan=lifespan)
@@ -1,20 +1,47 @@
-from flask import Flask, request, jsonify, send_from_directory, make_response
-import requests
+from flask import Flask, request, jsonify, send_from_directory, make_response, g, has_request_context
 import hashlib
+import itertools
 import os
+import sys
 import time
 from flask_cors import CORS
 import traceback
-import pickle
+import struct
+import zlib
 import logging
 import threading
+import bisect
+import contextvars
 from collections import OrderedDict
 import json
 from datetime import datetime
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+from urllib.parse import quote
 # Import your story_nodes, other helpers (modified to remove pygame)
 # MAKE SURE Pillow is installed for manga generation later
 # from PIL import Image, ImageDraw # If doing manga server-side
 
+
+class _LazyModule:
+    """Stand-in for a module that is imported on first attribute access.
+
+    `requests` costs ~50ms to import and is only needed for image proxying and
+    RPC balances, so cold starts that never touch those paths skip it. After
+    the first access the global name is rebound to the real module.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        import importlib
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+requests = _LazyModule('requests')
+
 app = Flask(__name__)
 # Configure CORS to allow credentials
 CORS(app, supports_credentials=True, resources={
@@ -31,58 +58,994 @@ CORS(app, supports_credentials=True, resources={
 # Create a tmp directory if it doesn't exist
 os.makedirs('/tmp', exist_ok=True)
 
+# --- Metrics ---
+# In-process counters and fixed-bucket histograms for the hot paths. Each worker
+# updates its own registry (a dict update under a lock, well under a microsecond)
+# and writes a JSON snapshot to METRICS_DIR every METRICS_SNAPSHOT_INTERVAL
+# seconds; /api/metrics merges the snapshots of all live workers and renders
+# them in the Prometheus text format.
+METRICS_ENABLED = os.environ.get('METRICS', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR', '/tmp/metrics')
+METRICS_SNAPSHOT_INTERVAL = float(os.environ.get('METRICS_SNAPSHOT_INTERVAL', '10'))
+METRICS_PREFIX = 'forest_'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # name -> (help, label names, {labels: value})
+        self.histograms = {}  # name -> (help, label names, buckets, {labels: [bucket counts..., +Inf, sum, count]})
+        self.collectors = []  # callables returning {name: value} gauges, read at snapshot time
+
+    def counter(self, name, help_text, labelnames=()):
+        self.counters.setdefault(name, (help_text, labelnames, {}))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.histograms.setdefault(name, (help_text, labelnames, buckets, {}))
+
+    def inc(self, name, labels=(), amount=1):
+        if not METRICS_ENABLED:
+            return
+        values = self.counters[name][2]
+        with self.lock:
+            values[labels] = values.get(labels, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        if not METRICS_ENABLED:
+            return
+        _, _, buckets, series = self.histograms[name]
+        position = bisect.bisect_left(buckets, value)
+        with self.lock:
+            counts = series.get(labels)
+            if counts is None:
+                counts = series[labels] = [0] * (len(buckets) + 3)
+            counts[position] += 1  # the slot past the last bucket is +Inf
+            counts[-2] += value
+            counts[-1] += 1
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def snapshot(self):
+        with self.lock:
+            counters = {name: [help_text, list(labelnames), [[list(labels), value] for labels, value in values.items()]]
+                        for name, (help_text, labelnames, values) in self.counters.items()}
+            histograms = {name: [help_text, list(labelnames), list(buckets),
+                                 [[list(labels), list(counts)] for labels, counts in series.items()]]
+                          for name, (help_text, labelnames, buckets, series) in self.histograms.items()}
+        gauges = {}
+        for fn in self.collectors:
+            try:
+                gauges.update(fn())
+            except Exception as e:
+                logging.error(f"Error collecting metrics from {fn.__name__}: {str(e)}")
+        return {'pid': os.getpid(), 'time': time.time(), 'counters': counters,
+                'histograms': histograms, 'gauges': gauges}
+
+metrics = MetricsRegistry()
+
+class timed:
+    """Context manager observing the wall time of its block into a histogram"""
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        metrics.observe(self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+# Gauges that describe a shared resource or a high-water mark merge by max instead of sum
+_MAX_MERGED_GAUGES = ('max_', 'last_', 'session_sweeper_live')
+
+def merge_metric_snapshots(snapshots):
+    """Sum counters, histograms and gauges across workers (see _MAX_MERGED_GAUGES)"""
+    counters, histograms, gauges = {}, {}, {}
+    for snap in snapshots:
+        for name, (help_text, labelnames, values) in snap['counters'].items():
+            merged = counters.setdefault(name, [help_text, labelnames, {}])[2]
+            for labels, value in values:
+                merged[tuple(labels)] = merged.get(tuple(labels), 0) + value
+        for name, (help_text, labelnames, buckets, series) in snap['histograms'].items():
+            merged = histograms.setdefault(name, [help_text, labelnames, buckets, {}])[3]
+            for labels, counts in series:
+                total = merged.setdefault(tuple(labels), [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+        for name, value in snap['gauges'].items():
+            if name in gauges and any(part in name for part in _MAX_MERGED_GAUGES):
+                gauges[name] = max(gauges[name], value)
+            else:
+                gauges[name] = gauges.get(name, 0) + value
+    return counters, histograms, gauges
+
+def _prometheus_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def render_prometheus(snapshots):
+    counters, histograms, gauges = merge_metric_snapshots(snapshots)
+    lines = [f"# HELP {METRICS_PREFIX}workers Workers included in this scrape",
+             f"# TYPE {METRICS_PREFIX}workers gauge", f"{METRICS_PREFIX}workers {len(snapshots)}"]
+    for name, (help_text, names, values) in sorted(counters.items()):
+        full = METRICS_PREFIX + name
+        lines += [f"# HELP {full} {help_text}", f"# TYPE {full} counter"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{full}{_prometheus_labels(names, labels)} {value}")
+    for name, (help_text, names, buckets, series) in sorted(histograms.items()):
+        full = METRICS_PREFIX + name
+        lines += [f"# HELP {full} {help_text}", f"# TYPE {full} histogram"]
+        for labels, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f"{full}_bucket{_prometheus_labels(names, labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{full}_sum{_prometheus_labels(names, labels)} {counts[-2]}")
+            lines.append(f"{full}_count{_prometheus_labels(names, labels)} {counts[-1]}")
+    for name, value in sorted(gauges.items()):
+        full = METRICS_PREFIX + name
+        lines += [f"# TYPE {full} gauge", f"{full} {value}"]
+    return '\n'.join(lines) + '\n'
+
+def write_metrics_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"worker_{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(metrics.snapshot(), f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def collect_worker_snapshots():
+    """This worker's live registry plus the latest snapshot of every other live worker"""
+    snapshots = [metrics.snapshot()]
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return snapshots
+    for name in names:
+        if not (name.startswith('worker_') and name.endswith('.json')):
+            continue
+        pid = int(name[len('worker_'):-len('.json')])
+        if pid == os.getpid():
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            # The worker is gone; its counts went with it, as with any restarted exporter
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        except PermissionError:
+            pass
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+    return snapshots
+
+_snapshot_thread = None
+_snapshot_lock = threading.Lock()
+
+def start_metrics_snapshots():
+    """Start this worker's snapshot writer once (it is started from the first request, after any fork)"""
+    global _snapshot_thread
+    if not METRICS_ENABLED or (_snapshot_thread is not None and _snapshot_thread.is_alive()):
+        return
+    with _snapshot_lock:
+        if _snapshot_thread is not None and _snapshot_thread.is_alive():
+            return
+
+        def run():
+            while True:
+                time.sleep(METRICS_SNAPSHOT_INTERVAL)
+                try:
+                    write_metrics_snapshot()
+                except Exception as e:
+                    logging.error(f"Error writing metrics snapshot: {str(e)}")
+        _snapshot_thread = threading.Thread(target=run, name='metrics-snapshot', daemon=True)
+        _snapshot_thread.start()
+
+metrics.counter('http_requests_total', 'Requests handled, by route, method and status', ('route', 'method', 'status'))
+metrics.histogram('http_request_duration_seconds', 'Request latency by route and method', ('route', 'method'))
+metrics.counter('session_io_total', 'Session loads and saves requested, by endpoint', ('endpoint', 'kind'))
+metrics.histogram('session_store_load_seconds', 'Time reading a session blob from the store')
+metrics.histogram('session_store_save_seconds', 'Time writing session blobs to the store')
+metrics.histogram('session_decode_seconds', 'Time decoding a stored session')
+metrics.histogram('session_encode_seconds', 'Time encoding a session for storage')
+metrics.histogram('blockchain_append_seconds', 'Time appending records to a wallet log')
+metrics.histogram('blockchain_read_seconds', 'Time reading records from a wallet log')
+metrics.histogram('image_fetch_seconds', 'Time fetching an image from the generator')
+metrics.histogram('balance_fetch_seconds', 'Time fetching a balance from the provider')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    start_metrics_snapshots()
+    if session_sweeper is not None:
+        session_sweeper.start()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started, (route, request.method))
+        metrics.inc('http_requests_total', (route, request.method, str(response.status_code)))
+    return response
+
+# --- Request profiling ---
+# Setting PROFILE_ADMIN_TOKEN turns on cProfile for single requests: those that
+# send `X-Profile: <token>`, plus one in every PROFILE_SAMPLE_EVERY requests when
+# that is above 0. Each profile is written as <PROFILE_DIR>/<name>.pstats, only the
+# newest PROFILE_MAX_FILES are kept, and a token-carrying request gets the name
+# back in an X-Profile-File header (fetch it from /api/profiles/<name>). Without
+# a token the hooks are never registered, so normal requests pay nothing.
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN', '')
+PROFILE_SAMPLE_EVERY = int(os.environ.get('PROFILE_SAMPLE_EVERY', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '50'))
+
+def profile_token_ok(value):
+    import hmac
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(value or '', PROFILE_ADMIN_TOKEN)
+
+def save_profile(profiler, label):
+    """Write a finished profile into the spool, pruning the oldest; returns its file name"""
+    import pstats
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.time_ns()}_{os.getpid()}_{label}.pstats"
+    pstats.Stats(profiler).dump_stats(os.path.join(PROFILE_DIR, name))
+    profiles = sorted(entry for entry in os.listdir(PROFILE_DIR) if entry.endswith('.pstats'))
+    for old in profiles[:-PROFILE_MAX_FILES] if PROFILE_MAX_FILES > 0 else []:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except FileNotFoundError:
+            pass
+    return name
+
+_profile_counter = itertools.count(1)  # next() on it is atomic under the GIL
+# Only one cProfile can be enabled per process on Python 3.12+ (enable() raises
+# ValueError otherwise), so a request that overlaps a profiled one is not profiled
+_profile_lock = threading.Lock()
+
+def start_request_profile():
+    requested = profile_token_ok(request.headers.get('X-Profile'))
+    sampled = PROFILE_SAMPLE_EVERY > 0 and next(_profile_counter) % PROFILE_SAMPLE_EVERY == 0
+    if not (requested or sampled):
+        return
+    if not _profile_lock.acquire(blocking=False):
+        logging.info(f"Not profiling {request.method} {request.path}: another request is being profiled")
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Some other profiler or monitoring tool already holds the hook
+        _profile_lock.release()
+        logging.info(f"Not profiling {request.method} {request.path}: {str(e)}")
+        return
+    g.profiler = profiler
+    g.profile_requested = requested
+
+def _stop_request_profile():
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+    return profiler
+
+def finish_request_profile(response):
+    profiler = _stop_request_profile()
+    if profiler is None:
+        return response
+    try:
+        name = save_profile(profiler, request.endpoint or 'unmatched')
+        logging.info(f"Profiled {request.method} {request.path} into {name}")
+        if g.get('profile_requested'):
+            response.headers['X-Profile-File'] = name
+    except Exception as e:
+        logging.error(f"Error saving profile: {str(e)}")
+    return response
+
+def teardown_request_profile(exc=None):
+    # after_request is skipped when a request raises, but the profiler must still be released
+    _stop_request_profile()
+
+if PROFILE_ADMIN_TOKEN:
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
+    app.teardown_request(teardown_request_profile)
+
 # --- In-memory LRU cache for hot sessions (performance boost) ---
-class LRUCache:
-    def __init__(self, capacity=1000):
-        self.cache = OrderedDict()
+def approx_size(obj):
+    """Rough deep size of a session-like structure in bytes"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_size(item) for item in obj)
+    return size
+
+class _CacheShard:
+    def __init__(self, capacity, max_bytes):
+        self.cache = OrderedDict()  # key -> (value, size, expires_at)
         self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.bytes = 0
         self.lock = threading.Lock()
+        # Snapshots of entries changed since they were last persisted. They stay
+        # here even if the entry is evicted or expires so write-behind never drops
+        # a session.
+        self.dirty = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        _, size, _ = self.cache.pop(key)
+        self.bytes -= size
+
+class LRUCache:
+    """LRU cache split into lock-striped shards, bounded by entry count,
+    approximate byte size and an optional per-entry TTL"""
+    def __init__(self, capacity=1000, max_bytes=0, ttl=0, shards=1, sizer=approx_size):
+        shards = max(1, shards)
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizer = sizer
+        # Limits are split evenly so each shard can enforce them under its own lock
+        self.shards = [_CacheShard(-(-capacity // shards), -(-max_bytes // shards) if max_bytes else 0)
+                       for _ in range(shards)]
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
 
     def get(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.cache.get(key)
+            if entry is not None and entry[2] and entry[2] <= time.monotonic():
+                shard._remove(key)
+                shard.expirations += 1
+                entry = None
+            if entry is None:
+                shard.misses += 1
+                return None
+            shard.hits += 1
+            shard.cache.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        shard = self._shard(key)
+        size = self.sizer(value) if self.max_bytes else 0
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else 0
+        with shard.lock:
+            if key in shard.cache:
+                shard._remove(key)
+            shard.cache[key] = (value, size, expires_at)
+            shard.bytes += size
+            while shard.cache and (len(shard.cache) > shard.capacity
+                                   or (shard.max_bytes and shard.bytes > shard.max_bytes)):
+                oldest = next(iter(shard.cache))
+                shard._remove(oldest)
+                shard.evictions += 1
+
+    def mark_dirty(self, key, value, replace=True):
+        """Record an unpersisted snapshot; replace=False keeps a newer one already waiting"""
+        shard = self._shard(key)
+        with shard.lock:
+            if replace or key not in shard.dirty:
+                shard.dirty[key] = value
+        return self.dirty_count()
+
+    def discard(self, keys):
+        """Drop cached entries (not their dirty snapshots), e.g. for sessions deleted from the store"""
+        for key in keys:
+            shard = self._shard(key)
+            with shard.lock:
+                if key in shard.cache:
+                    shard._remove(key)
+
+    def get_dirty(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.dirty.get(key)
+
+    def pop_dirty(self):
+        dirty = {}
+        for shard in self.shards:
+            with shard.lock:
+                dirty.update(shard.dirty)
+                shard.dirty = {}
+        return dirty
+
+    def dirty_count(self):
+        return sum(len(shard.dirty) for shard in self.shards)
+
+    def stats(self):
+        totals = {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'dirty': 0}
+        for shard in self.shards:
+            with shard.lock:
+                totals['entries'] += len(shard.cache)
+                totals['bytes'] += shard.bytes
+                totals['hits'] += shard.hits
+                totals['misses'] += shard.misses
+                totals['evictions'] += shard.evictions
+                totals['expirations'] += shard.expirations
+                totals['dirty'] += len(shard.dirty)
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+        return totals
+
+# SESSION_CACHE_MAX_BYTES and SESSION_CACHE_TTL of 0 mean unbounded / no expiry
+SESSION_CACHE_CAPACITY = int(os.environ.get('SESSION_CACHE_CAPACITY', '500'))
+SESSION_CACHE_MAX_BYTES = int(os.environ.get('SESSION_CACHE_MAX_BYTES', '0'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '0'))
+SESSION_CACHE_SHARDS = int(os.environ.get('SESSION_CACHE_SHARDS', '8'))
+
+hot_sessions = LRUCache(capacity=SESSION_CACHE_CAPACITY, max_bytes=SESSION_CACHE_MAX_BYTES,
+                        ttl=SESSION_CACHE_TTL, shards=SESSION_CACHE_SHARDS)
+
+# --- Pluggable session stores ---
+# SESSION_STORE selects the backend: "file" keeps the original one-file-per-player
+# layout under SESSION_DIR, "sqlite" keeps every session in a single WAL-mode database.
+SESSION_STORE = os.environ.get('SESSION_STORE', 'file').lower()
+SESSION_DIR = os.environ.get('SESSION_DIR', '/tmp')
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', '/tmp/sessions.db')
+# SESSION_DURABILITY controls how hard each write is pushed to disk:
+# "none" leaves it to the OS, "flush" empties user-space buffers, "fsync" forces it to the device
+SESSION_DURABILITY = os.environ.get('SESSION_DURABILITY', 'flush').lower()
+
+class SessionStore:
+    """Base interface for session persistence; stores deal in raw serialized bytes"""
+    def load(self, session_id):
+        raise NotImplementedError
+
+    def save(self, session_id, blob):
+        raise NotImplementedError
+
+    def save_many(self, items):
+        """Persist a batch of (session_id, blob) pairs"""
+        for session_id, blob in items:
+            self.save(session_id, blob)
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def iter_ids(self):
+        raise NotImplementedError
+
+    def sweep(self, max_age, max_bytes):
+        """Delete sessions idle for more than max_age seconds, then least recently
+        saved ones until the rest fit in max_bytes (0 disables either limit).
+        Returns counts of live, expired and evicted sessions, plus the removed IDs."""
+        raise NotImplementedError
+
+class FileSessionStore(SessionStore):
+    """One file per session, spread over 256 hashed subdirectories of SESSION_DIR/sessions.
+
+    Files from the original flat layout (SESSION_DIR/session_<id>.pkl) are still
+    found, and moved into their subdirectory the first time they are loaded.
+    SESSION_DIR itself is only scanned by the first sweep, since it is usually /tmp.
+    """
+    def __init__(self, directory=SESSION_DIR, durability=SESSION_DURABILITY):
+        self.directory = directory
+        self.root = os.path.join(directory, 'sessions')
+        self.durability = durability
+        self.known_dirs = set()
+        self.legacy_swept = False
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def _hashed(session_id):
+        # Cookie values reach the filesystem here, so anything path-like is hashed
+        return not session_id.replace('-', '').replace('_', '').isalnum()
+
+    @classmethod
+    def _filename(cls, session_id):
+        if cls._hashed(session_id):
+            session_id = hashlib.sha256(session_id.encode()).hexdigest()
+        return f"session_{session_id}.pkl"
+
+    def _path(self, session_id):
+        shard = hashlib.md5(session_id.encode()).hexdigest()[:2]
+        return os.path.join(self.root, shard, self._filename(session_id))
+
+    def _legacy_path(self, session_id):
+        return os.path.join(self.directory, self._filename(session_id))
+
+    def load(self, session_id):
+        # A single open() instead of exists() + open() saves a syscall per miss
+        path = self._path(session_id)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        legacy_path = self._legacy_path(session_id)
+        try:
+            with open(legacy_path, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            self._ensure_dir(path)
+            os.replace(legacy_path, path)
+        except OSError as e:
+            logging.error(f"Error moving session {session_id} into its subdirectory: {str(e)}")
+        return blob
+
+    def _ensure_dir(self, path):
+        directory = os.path.dirname(path)
+        if directory not in self.known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self.known_dirs.add(directory)
+
+    @staticmethod
+    def _id_path(path):
+        # A hashed file name cannot be turned back into its id, so the id is kept beside it
+        return path[:-len('.pkl')] + '.id'
+
+    def save(self, session_id, blob):
+        path = self._path(session_id)
+        self._ensure_dir(path)
+        if self._hashed(session_id) and not os.path.exists(self._id_path(path)):
+            with open(self._id_path(path), 'w') as f:
+                f.write(session_id)
+        with open(path, 'wb') as f:
+            f.write(blob)
+            if self.durability in ('flush', 'fsync'):
+                f.flush()
+            if self.durability == 'fsync':
+                os.fsync(f.fileno())
+
+    def _remove(self, path):
+        for name in (path, self._id_path(path)):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def delete(self, session_id):
+        self._remove(self._path(session_id))
+        self._remove(self._legacy_path(session_id))
+
+    def _entries(self, legacy=True):
+        """(mtime, size, path, session_id) for every session file, sharded and (if legacy) flat"""
+        directories = [self.directory] if legacy else []
+        try:
+            directories += [entry.path for entry in os.scandir(self.root) if entry.is_dir()]
+        except FileNotFoundError:
+            pass
+        for directory in directories:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                name = entry.name
+                if name.startswith('session_') and name.endswith('.pkl'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    session_id = name[len('session_'):-len('.pkl')]
+                    if len(session_id) == 64:
+                        try:
+                            with open(self._id_path(entry.path)) as f:
+                                session_id = f.read()
+                        except FileNotFoundError:
+                            pass
+                    yield stat.st_mtime, stat.st_size, entry.path, session_id
+
+    def iter_ids(self):
+        for _, _, _, session_id in self._entries():
+            yield session_id
+
+    def sweep(self, max_age, max_bytes):
+        cutoff = time.time() - max_age if max_age else None
+        live, expired = [], []
+        legacy, self.legacy_swept = not self.legacy_swept, True
+        for entry in self._entries(legacy):
+            (expired if cutoff is not None and entry[0] < cutoff else live).append(entry)
+        over_cap = []
+        if max_bytes:
+            total = sum(size for _, size, _, _ in live)
+            live.sort()
+            while live and total > max_bytes:
+                entry = live.pop(0)
+                total -= entry[1]
+                over_cap.append(entry)
+        for _, _, path, _ in expired + over_cap:
+            self._remove(path)
+        return {'live': len(live), 'live_bytes': sum(size for _, size, _, _ in live),
+                'expired': len(expired), 'evicted': len(over_cap),
+                'removed': [session_id for _, _, _, session_id in expired + over_cap]}
+
+class SQLiteSessionStore(SessionStore):
+    """All sessions in one SQLite database running in WAL mode.
+
+    Each worker process holds a single connection (reopened after a fork) and
+    reuses the same statement strings so sqlite3's statement cache keeps them
+    prepared.
+    """
+    LOAD_SQL = "SELECT data FROM sessions WHERE id = ?"
+    SAVE_SQL = ("INSERT INTO sessions (id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at")
+    DELETE_SQL = "DELETE FROM sessions WHERE id = ?"
+    IDS_SQL = "SELECT id FROM sessions"
+
+    SYNCHRONOUS = {'none': 'OFF', 'flush': 'NORMAL', 'fsync': 'FULL'}
+
+    def __init__(self, path=SESSION_DB_PATH, durability=SESSION_DURABILITY):
+        self.path = path
+        self.durability = durability
+        self.lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        # Connections must not be shared across a fork, so gunicorn workers
+        # each open their own on first use
+        if self._conn is None or self._pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   isolation_level=None, cached_statements=16)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS.get(self.durability, 'NORMAL')}")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "id TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def load(self, session_id):
+        with self.lock:
+            row = self._connection().execute(self.LOAD_SQL, (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, session_id, blob):
         with self.lock:
-            if key not in self.cache:
+            self._connection().execute(self.SAVE_SQL, (session_id, blob, time.time()))
+
+    def save_many(self, items):
+        # One transaction per batch, so a flush costs a single WAL commit
+        now = time.time()
+        rows = [(session_id, blob, now) for session_id, blob in items]
+        with self.lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(self.SAVE_SQL, rows)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def delete(self, session_id):
+        with self.lock:
+            self._connection().execute(self.DELETE_SQL, (session_id,))
+
+    def iter_ids(self):
+        with self.lock:
+            rows = self._connection().execute(self.IDS_SQL).fetchall()
+        return (row[0] for row in rows)
+
+    def sweep(self, max_age, max_bytes):
+        with self.lock:
+            conn = self._connection()
+            expired = []
+            if max_age:
+                expired = conn.execute("SELECT id FROM sessions WHERE updated_at < ?",
+                                       (time.time() - max_age,)).fetchall()
+                conn.executemany(self.DELETE_SQL, expired)
+            stale = []
+            if max_bytes:
+                total = 0
+                for session_id, size in conn.execute(
+                        "SELECT id, length(data) FROM sessions ORDER BY updated_at DESC"):
+                    total += size
+                    if total > max_bytes:
+                        stale.append((session_id,))
+                conn.executemany(self.DELETE_SQL, stale)
+            live, live_bytes = conn.execute("SELECT count(*), coalesce(sum(length(data)), 0) FROM sessions").fetchone()
+        return {'live': live, 'live_bytes': live_bytes, 'expired': len(expired), 'evicted': len(stale),
+                'removed': [session_id for (session_id,) in expired + stale]}
+
+def create_session_store(kind=SESSION_STORE):
+    if kind == 'sqlite':
+        return SQLiteSessionStore(SESSION_DB_PATH, SESSION_DURABILITY)
+    if kind != 'file':
+        logging.warning(f"Unknown SESSION_STORE '{kind}', falling back to file storage")
+    return FileSessionStore(SESSION_DIR, SESSION_DURABILITY)
+
+session_store = create_session_store()
+
+# --- Session sweeper ---
+# Every browser without a cookie starts a new session, so stored sessions are
+# swept in the background: every SESSION_SWEEP_INTERVAL seconds, sessions not
+# saved for SESSION_MAX_AGE seconds are deleted, then the least recently saved
+# ones until the store fits in SESSION_STORE_MAX_BYTES. A non-blocking flock
+# makes sure only one worker sweeps a given store at a time; that worker drops
+# the swept sessions from its hot cache, and the other workers' hot caches
+# expire entries after SESSION_MAX_AGE so none of them outlives its file.
+#
+# Like the metrics snapshot writer, background threads (this one, the
+# write-behind flusher and the group-commit writer) start on first use rather
+# than at import, so they are created in each worker after a gunicorn --preload
+# fork and scripts that only import this module start none.
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '600'))
+SESSION_MAX_AGE = float(os.environ.get('SESSION_MAX_AGE', str(7 * 24 * 3600)))
+SESSION_STORE_MAX_BYTES = int(os.environ.get('SESSION_STORE_MAX_BYTES', '0'))
+
+if SESSION_SWEEP_INTERVAL > 0 and SESSION_MAX_AGE and not 0 < hot_sessions.ttl <= SESSION_MAX_AGE:
+    hot_sessions.ttl = SESSION_MAX_AGE
+
+_background_start_lock = threading.Lock()
+
+class BackgroundThread:
+    """Mixin for objects with one worker thread, started by start() once per process"""
+    thread = None
+    thread_name = 'background'
+
+    def start(self):
+        # After a fork the parent's thread object is still here but no longer alive
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with _background_start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self.thread.start()
+
+class SessionSweeper(BackgroundThread):
+    thread_name = 'session-sweeper'
+
+    def __init__(self, store, interval=SESSION_SWEEP_INTERVAL, max_age=SESSION_MAX_AGE,
+                 max_bytes=SESSION_STORE_MAX_BYTES, cache=None):
+        self.store = store
+        self.cache = cache
+        self.interval = interval
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        if isinstance(store, SQLiteSessionStore):
+            self.lock_path = store.path + '.sweep.lock'
+        else:
+            self.lock_path = os.path.join(store.root, '.sweep.lock')
+        self.lock = threading.Lock()
+        self.counts = {'runs': 0, 'live': 0, 'live_bytes': 0, 'expired': 0, 'evicted': 0, 'last_run_seconds': 0.0}
+        self.stopped = threading.Event()
+
+    def sweep(self):
+        """Run one sweep unless another worker is already sweeping; returns its counts or None"""
+        import fcntl
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
                 return None
-            self.cache.move_to_end(key)
-            return self.cache[key]
+            start = time.monotonic()
+            result = self.store.sweep(self.max_age, self.max_bytes)
+        if self.cache is not None:
+            self.cache.discard(result['removed'])
+        with self.lock:
+            self.counts['runs'] += 1
+            self.counts['live'] = result['live']
+            self.counts['live_bytes'] = result['live_bytes']
+            self.counts['expired'] += result['expired']
+            self.counts['evicted'] += result['evicted']
+            self.counts['last_run_seconds'] = time.monotonic() - start
+        if result['expired'] or result['evicted']:
+            logging.info(f"Swept {result['expired']} expired and {result['evicted']} evicted sessions, "
+                         f"{result['live']} live")
+        return result
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error sweeping sessions: {str(e)}")
 
-    def set(self, key, value):
+    def stats(self):
         with self.lock:
-            self.cache[key] = value
-            self.cache.move_to_end(key)
-            if len(self.cache) > self.capacity:
-                self.cache.popitem(last=False)
+            return dict(self.counts)
+
+    def shutdown(self):
+        self.stopped.set()
+
+session_sweeper = None
+if SESSION_SWEEP_INTERVAL > 0:
+    session_sweeper = SessionSweeper(session_store, cache=hot_sessions)
+
+def upgrade_session_blob(blob):
+    """Re-encode a legacy pickled session in the compact format; other blobs pass through"""
+    if blob[:1] != b'\x80':
+        return blob
+    import pickle
+    return encode_session(pickle.loads(blob))
 
-hot_sessions = LRUCache(capacity=500)
+def migrate_sessions(source, destination):
+    """Copy every session from one store into another (or back into itself), re-encoding
+    legacy pickles so SESSION_LEGACY_PICKLE can stay off"""
+    migrated = 0
+    for session_id in list(source.iter_ids()):
+        blob = source.load(session_id)
+        if blob is not None:
+            destination.save(session_id, upgrade_session_blob(blob))
+            migrated += 1
+    return migrated
 
 # --- Enhanced session management ---
 def get_user_session(session_id):
+    count_session_io('loads')
     # Try in-memory cache first
     session = hot_sessions.get(session_id)
     if session:
         return session
     try:
-        session_file = f"/tmp/session_{session_id}.pkl"
-        if os.path.exists(session_file):
-            with open(session_file, 'rb') as f:
-                session = pickle.load(f)
-                hot_sessions.set(session_id, session)
-                return session
+        # An evicted session may still be waiting for the write-behind flusher
+        blob = hot_sessions.get_dirty(session_id)
+        if blob is None:
+            with timed('session_store_load_seconds'):
+                blob = session_store.load(session_id)
+        if blob is not None:
+            with timed('session_decode_seconds'):
+                session = decode_session(blob)
+            hot_sessions.set(session_id, session)
+            return session
         return {'state': None}
     except Exception as e:
         logging.error(f"Error getting user session: {str(e)}")
         return {'state': None}
 
 def save_user_session(session_id, session_data):
+    count_session_io('saves')
     hot_sessions.set(session_id, session_data)
     try:
-        session_file = f"/tmp/session_{session_id}.pkl"
-        with open(session_file, 'wb') as f:
-            pickle.dump(session_data, f)
+        with timed('session_encode_seconds'):
+            blob = encode_session(session_data)
+        if session_flusher is not None:
+            # Write-behind: the flusher persists the snapshot off the request path
+            session_flusher.mark_dirty(session_id, blob)
+            return True
+        with timed('session_store_save_seconds'):
+            session_store.save(session_id, blob)
         return True
     except Exception as e:
         logging.error(f"Error saving user session: {str(e)}")
         return False
 
+# --- Request-scoped session context ---
+# Within a request every helper shares one session dict: request_session loads it
+# at most once, mark_session_dirty flags it, and the teardown hook saves each
+# dirty session exactly once after the handler finishes. Outside a request the
+# helpers fall back to loading and saving directly. Handlers that run outside
+# Flask (the ASGI app) label their session I/O by setting session_io_endpoint.
+SESSION_IO_COUNTS = {}  # endpoint -> {'loads': n, 'saves': n}
+_session_io_lock = threading.Lock()
+session_io_endpoint = contextvars.ContextVar('session_io_endpoint', default='background')
+
+def count_session_io(kind):
+    endpoint = (request.endpoint or 'unknown') if has_request_context() else session_io_endpoint.get()
+    with _session_io_lock:
+        counts = SESSION_IO_COUNTS.setdefault(endpoint, {'loads': 0, 'saves': 0})
+        counts[kind] += 1
+    metrics.inc('session_io_total', (endpoint, kind))
+
+def session_io_counts():
+    with _session_io_lock:
+        return {endpoint: dict(counts) for endpoint, counts in SESSION_IO_COUNTS.items()}
+
+def request_session(session_id):
+    """The session for session_id, loaded once per request"""
+    if not has_request_context():
+        return get_user_session(session_id)
+    sessions = g.setdefault('sessions', {})
+    if session_id not in sessions:
+        sessions[session_id] = get_user_session(session_id)
+    return sessions[session_id]
+
+def mark_session_dirty(session_id, session_data):
+    """Schedule a save of the request's session; saves immediately outside a request"""
+    if not has_request_context():
+        return save_user_session(session_id, session_data)
+    g.setdefault('sessions', {})[session_id] = session_data
+    g.setdefault('dirty_sessions', set()).add(session_id)
+    return True
+
+@app.teardown_request
+def commit_request_sessions(exc):
+    dirty = g.pop('dirty_sessions', None)
+    sessions = g.pop('sessions', {})
+    if not dirty or exc is not None:
+        return
+    for session_id in dirty:
+        save_user_session(session_id, sessions[session_id])
+
+# --- Write-behind session persistence ---
+# SESSION_WRITE_MODE=write-behind moves session writes onto a background thread that
+# persists dirty sessions in batches every SESSION_FLUSH_INTERVAL seconds, or sooner
+# once SESSION_FLUSH_THRESHOLD sessions are waiting. Repeated saves of the same
+# session between flushes coalesce into one write. Sessions are encoded on the
+# request thread when marked dirty, so the flusher only ever writes snapshots
+# and never reads a session dict another request is still changing.
+SESSION_WRITE_MODE = os.environ.get('SESSION_WRITE_MODE', 'sync').lower()
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', '1.0'))
+SESSION_FLUSH_THRESHOLD = int(os.environ.get('SESSION_FLUSH_THRESHOLD', '64'))
+
+class SessionFlusher(BackgroundThread):
+    thread_name = 'session-flusher'
+
+    def __init__(self, cache, store, interval=SESSION_FLUSH_INTERVAL, threshold=SESSION_FLUSH_THRESHOLD):
+        self.cache = cache
+        self.store = store
+        self.interval = interval
+        self.threshold = threshold
+        self.wakeup = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.stopped = False
+
+    def mark_dirty(self, session_id, blob):
+        """Queue an encoded session snapshot for the next flush"""
+        self.start()
+        if self.cache.mark_dirty(session_id, blob) >= self.threshold:
+            self.wakeup.set()
+
+    def flush(self):
+        """Persist every dirty session; returns the number written"""
+        with self.flush_lock:
+            items = list(self.cache.pop_dirty().items())
+            if not items:
+                return 0
+            try:
+                with timed('session_store_save_seconds'):
+                    self.store.save_many(items)
+            except Exception as e:
+                logging.error(f"Error flushing {len(items)} sessions: {str(e)}")
+                for session_id, blob in items:
+                    # Retry on the next pass unless a newer snapshot arrived meanwhile
+                    self.cache.mark_dirty(session_id, blob, replace=False)
+                return 0
+            return len(items)
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def shutdown(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval + 5)
+        self.flush()
+
+session_flusher = None
+if SESSION_WRITE_MODE == 'write-behind':
+    import atexit
+    session_flusher = SessionFlusher(hot_sessions, session_store)
+    atexit.register(session_flusher.shutdown)
+
 # --- Achievements, Inventory, Stats ---
 def init_player_extras():
     return {
@@ -113,6 +1076,10 @@ POLLINATIONS_BASE_URL = "https://image.pollinations.ai/prompt/"
 IMAGE_WIDTH = 1024
 IMAGE_HEIGHT = 1024
 IMAGE_MODEL = 'flux'
+# "deterministic" makes each image URL a pure function of node, style, sentiment and
+# seed so browsers, CDNs and the image proxy can cache it; "timestamp" restores the
+# old behaviour of stamping every prompt with the current time
+IMAGE_PROMPT_MODE = os.environ.get('IMAGE_PROMPT_MODE', 'deterministic').lower()
 # ... other non-pygame constants ...
 # ... your story_nodes dictionary ...
 
@@ -482,6 +1449,345 @@ story_nodes = {
     }
 }
 
+# --- Compiled story graph ---
+# story_nodes is compiled once at import into frozen, integer-indexed records so
+# request handlers can read nodes and choices without copying anything. Each
+# node also keeps a payload in the original story_nodes shape for JSON responses.
+# Payloads are shared between requests, so they are read-only mappings (with the
+# choices as a tuple) and a handler that tries to change one fails loudly.
+CALCULATE_END = "_calculate_end"
+CALCULATE_END_INDEX = -1
+
+# Dynamic endings: _calculate_end picks a generic ending from score and sentiment,
+# then a session-specific variant of it
+CUSTOM_ENDINGS = MappingProxyType({
+    "generic_good_ending": (
+        "heroic_savior_ending", "wise_mage_ending", "forest_guardian_ending"
+    ),
+    "generic_neutral_ending": (
+        "peaceful_traveler_ending", "forest_explorer_ending", "merchant_ending"
+    ),
+    "generic_bad_ending": (
+        "lost_soul_ending", "cursed_wanderer_ending", "forest_prisoner_ending"
+    )
+})
+
+class StoryChoice(NamedTuple):
+    id: int
+    index: int
+    text: str
+    next_node: str
+    next_index: int
+    score_modifier: int
+    tag: str
+    payload: Mapping
+
+class StoryNode(NamedTuple):
+    id: str
+    index: int
+    situation: str
+    prompt: str
+    seed: int
+    is_end: bool
+    ending_category: str
+    choices: tuple
+    successors: tuple
+    payload: Mapping
+
+class StoryGraph:
+    def __init__(self, nodes, tags):
+        self.nodes = nodes
+        self.tags = tags
+        self.by_id = {node.id: node for node in nodes}
+        self.tag_index = {tag: i for i, tag in enumerate(tags)}
+
+    def get(self, node_id):
+        return self.by_id.get(node_id)
+
+def compile_story(nodes_source, start="start"):
+    """Validate story_nodes and freeze it into a StoryGraph.
+
+    nodes_source is a mapping of node ID to node, or a sequence of (ID, node)
+    pairs, e.g. several story files concatenated; a repeated ID is an error there
+    rather than one node silently replacing another.
+    """
+    pairs = list(nodes_source.items() if isinstance(nodes_source, Mapping) else nodes_source)
+    node_index = {}
+    errors = []
+    for node_id, _ in pairs:
+        if node_id in node_index:
+            errors.append(f"node '{node_id}' is defined more than once")
+        else:
+            node_index[node_id] = len(node_index)
+    if start not in node_index:
+        errors.append(f"start node '{start}' is missing")
+    for generic, variants in CUSTOM_ENDINGS.items():
+        for ending in (generic, *variants):
+            if ending not in node_index:
+                errors.append(f"ending '{ending}' is missing")
+
+    tags = []
+    compiled = []
+    choice_id = 0
+    for node_id, node in pairs:
+        if node_index[node_id] != len(compiled):
+            continue  # A duplicate, already reported
+        choices = []
+        for index, choice in enumerate(node.get("choices", [])):
+            next_node = choice.get("next_node")
+            if next_node == CALCULATE_END:
+                next_index = CALCULATE_END_INDEX
+            elif next_node in node_index:
+                next_index = node_index[next_node]
+            else:
+                errors.append(f"choice {index} of '{node_id}' points to unknown node '{next_node}'")
+                continue
+            tag = choice.get("tag")
+            if tag and tag not in tags:
+                tags.append(tag)
+            choices.append(StoryChoice(
+                id=choice_id, index=index, text=choice.get("text", ""), next_node=next_node,
+                next_index=next_index, score_modifier=choice.get("score_modifier", 0), tag=tag,
+                payload=MappingProxyType(dict(choice))))
+            choice_id += 1
+        is_end = node.get("is_end", False)
+        if is_end and choices:
+            errors.append(f"end node '{node_id}' has choices")
+        if not is_end and not node.get("choices"):
+            errors.append(f"node '{node_id}' has no choices and is not an ending")
+        payload = dict(node)
+        if "choices" in node:
+            payload["choices"] = tuple(choice.payload for choice in choices)
+        payload = MappingProxyType(payload)
+        compiled.append(StoryNode(
+            id=node_id, index=node_index[node_id], situation=node.get("situation", ""),
+            prompt=node.get("prompt", ""), seed=node.get("seed", 12345), is_end=is_end,
+            ending_category=node.get("ending_category"), choices=tuple(choices),
+            successors=tuple(sorted({choice.next_index for choice in choices})), payload=payload))
+
+    if errors:
+        raise ValueError("Invalid story graph: " + "; ".join(errors))
+    return StoryGraph(tuple(compiled), tuple(tags))
+
+STORY_GRAPH = compile_story(story_nodes)
+
+_flask_json_default = app.json.default
+
+def _story_json_default(value):
+    # Frozen story payloads serialize exactly like the dicts they wrap
+    if isinstance(value, MappingProxyType):
+        return dict(value)
+    return _flask_json_default(value)
+
+app.json.default = _story_json_default
+
+# --- Compact session encoding ---
+# Sessions are stored as a small versioned binary record instead of a pickle.
+# Node IDs and tags become indexes into tables derived from story_nodes, the
+# path is a packed array of node indexes and each history entry is just
+# (from_node, choice_index) since the text and tag can be looked up again.
+#
+# Layout (little endian):
+#   header   magic "MF", version u8, story fingerprint u32, flags u8 (state/style/traits present)
+#   prefs    u8 count, then u16 length + UTF-8 bytes per string (style, then traits)
+#   state    u16 node, i32 score, f64 created_at,
+#            u16 n + n*u16 path, u8 n + n*(u16 tag, u32 count) tally,
+#            u16 n + n*(u16 node, u8 choice) history
+#   extras   u32 length + JSON for any keys the binary layout doesn't cover
+# Version 0 is the same header followed by plain JSON, used whenever a session
+# holds something the tables can't represent.
+SESSION_CODEC_MAGIC = b'MF'
+SESSION_CODEC_VERSION = 1
+SESSION_LEGACY_PICKLE = os.environ.get('SESSION_LEGACY_PICKLE', '0') == '1'
+
+_CODEC_HEADER = struct.Struct('<2sBIB')
+_CODEC_STATE = struct.Struct('<Hid')
+_CODEC_FLAG_STATE = 1
+_CODEC_FLAG_STYLE = 2
+_CODEC_FLAG_TRAITS = 4
+_SESSION_KEYS = ('style_preferences', 'personality_traits', 'state')
+_STATE_KEYS = ('current_node_id', 'path_history', 'score', 'sentiment_tally', 'choice_history', 'created_at')
+
+CODEC_NODE_IDS = [node.id for node in STORY_GRAPH.nodes]
+CODEC_NODE_INDEX = {node.id: node.index for node in STORY_GRAPH.nodes}
+CODEC_TAGS = STORY_GRAPH.tags
+CODEC_TAG_INDEX = STORY_GRAPH.tag_index
+# Any edit to node order, choices or tags changes the fingerprint, so blobs
+# written against an older story are rejected instead of decoded wrongly
+CODEC_FINGERPRINT = zlib.crc32(json.dumps(
+    [[node_id, [[c.get('next_node'), c.get('tag'), c.get('text')] for c in node.get('choices', [])]]
+     for node_id, node in story_nodes.items()]
+).encode())
+
+def _json_default(value):
+    # init_player_extras keeps achievements and visited nodes in sets
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': list(value)}
+    raise TypeError(f"Cannot encode {type(value).__name__} in a session")
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and '__set__' in obj:
+        return set(obj['__set__'])
+    return obj
+
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+# (from_node, choice_index) -> (node index, choice text, tag), for validating history on encode
+_CODEC_CHOICES = {(node.id, choice.index): (node.index, choice.text, choice.tag)
+                  for node in STORY_GRAPH.nodes for choice in node.choices}
+# [node index][choice index] -> the history entry it decodes to; decode copies these
+# instead of building each dict key by key
+_CODEC_HISTORY = [[{"from_node": node.id, "choice_index": choice.index,
+                    "choice_text": choice.text, "tag": choice.tag} for choice in node.choices]
+                  for node in STORY_GRAPH.nodes]
+_HISTORY_KEYS = frozenset(('from_node', 'choice_index', 'choice_text', 'tag'))
+_codec_structs = {}
+
+def _counted_struct(unit, count):
+    """Cached Struct for `count` repetitions of `unit`, so formats aren't rebuilt per call"""
+    key = (unit, count)
+    packer = _codec_structs.get(key)
+    if packer is None:
+        packer = _codec_structs[key] = struct.Struct('<' + unit * count)
+    return packer
+
+def _pack_strings(strings):
+    out = [_U8.pack(len(strings))]
+    for value in strings:
+        raw = value.encode('utf-8')
+        out.append(_U16.pack(len(raw)))
+        out.append(raw)
+    return b''.join(out)
+
+def _unpack_strings(blob, offset):
+    count = blob[offset]
+    offset += 1
+    strings = []
+    for _ in range(count):
+        (length,) = _U16.unpack_from(blob, offset)
+        offset += 2
+        strings.append(blob[offset:offset + length].decode('utf-8'))
+        offset += length
+    return strings, offset
+
+def _pack_state(state):
+    path = [CODEC_NODE_INDEX[node_id] for node_id in state['path_history']]
+    tally = []
+    for tag, count in state['sentiment_tally'].items():
+        tally.append(CODEC_TAG_INDEX[tag])
+        tally.append(count)
+    history = []
+    for entry in state['choice_history']:
+        # A node renamed or removed since the entry was written raises KeyError,
+        # which sends the whole session down the JSON path
+        node_index, text, tag = _CODEC_CHOICES[entry['from_node'], entry['choice_index']]
+        if entry.get('choice_text') != text or entry.get('tag') != tag:
+            raise ValueError("choice history entry does not match the story")
+        if entry.keys() != _HISTORY_KEYS:
+            raise ValueError("choice history entry has unknown keys")
+        history.append(node_index)
+        history.append(entry['choice_index'])
+    return b''.join([
+        _CODEC_STATE.pack(CODEC_NODE_INDEX[state['current_node_id']], state['score'], state['created_at']),
+        _U16.pack(len(path)),
+        _counted_struct('H', len(path)).pack(*path),
+        _U8.pack(len(tally) // 2),
+        _counted_struct('HI', len(tally) // 2).pack(*tally),
+        _U16.pack(len(history) // 2),
+        _counted_struct('HB', len(history) // 2).pack(*history),
+    ])
+
+def _unpack_state(blob, offset):
+    node, score, created_at = _CODEC_STATE.unpack_from(blob, offset)
+    offset += _CODEC_STATE.size
+    (count,) = _U16.unpack_from(blob, offset)
+    path = _counted_struct('H', count).unpack_from(blob, offset + 2)
+    offset += 2 + 2 * count
+    count = blob[offset]
+    packed = _counted_struct('HI', count).unpack_from(blob, offset + 1)
+    offset += 1 + 6 * count
+    tags = CODEC_TAGS
+    tally = {tags[tag]: value for tag, value in zip(packed[::2], packed[1::2])}
+    (count,) = _U16.unpack_from(blob, offset)
+    packed = _counted_struct('HB', count).unpack_from(blob, offset + 2)
+    offset += 2 + 3 * count
+    templates = _CODEC_HISTORY
+    node_ids = CODEC_NODE_IDS
+    state = {
+        "current_node_id": node_ids[node],
+        "path_history": [node_ids[i] for i in path],
+        "score": score,
+        "sentiment_tally": tally,
+        "choice_history": [templates[n][c].copy() for n, c in zip(packed[::2], packed[1::2])],
+        "created_at": created_at
+    }
+    return state, offset
+
+def encode_session(session_data):
+    """Serialize a session dict to the compact binary format"""
+    try:
+        state = session_data.get('state')
+        extras = {key: value for key, value in session_data.items() if key not in _SESSION_KEYS}
+        if state:
+            state_extras = {key: value for key, value in state.items() if key not in _STATE_KEYS}
+            if state_extras:
+                extras['__state__'] = state_extras
+        flags = ((_CODEC_FLAG_STATE if state else 0)
+                 | (_CODEC_FLAG_STYLE if 'style_preferences' in session_data else 0)
+                 | (_CODEC_FLAG_TRAITS if 'personality_traits' in session_data else 0))
+        parts = [_CODEC_HEADER.pack(SESSION_CODEC_MAGIC, SESSION_CODEC_VERSION, CODEC_FINGERPRINT, flags)]
+        if flags & _CODEC_FLAG_STYLE:
+            parts.append(_pack_strings(session_data['style_preferences']))
+        if flags & _CODEC_FLAG_TRAITS:
+            parts.append(_pack_strings(session_data['personality_traits']))
+        if state:
+            parts.append(_pack_state(state))
+        raw_extras = json.dumps(extras, separators=(',', ':'), default=_json_default).encode() if extras else b''
+        parts.append(_U32.pack(len(raw_extras)))
+        parts.append(raw_extras)
+        return b''.join(parts)
+    except (KeyError, IndexError, TypeError, ValueError, struct.error):
+        # Anything outside the tables (or out of range) still round-trips as JSON
+        return (_CODEC_HEADER.pack(SESSION_CODEC_MAGIC, 0, CODEC_FINGERPRINT, 0)
+                + json.dumps(session_data, separators=(',', ':'), default=_json_default).encode())
+
+def decode_session(blob):
+    """Inverse of encode_session; also reads legacy pickle blobs when allowed"""
+    if blob[:2] != SESSION_CODEC_MAGIC:
+        if blob[:1] == b'\x80':
+            if SESSION_LEGACY_PICKLE:
+                import pickle
+                return pickle.loads(blob)
+            # The player starts over; say why, so a skipped migration is noticed
+            logging.warning("Ignoring a pickled session from an older deployment; run "
+                            "scripts/migrate_sessions.py or set SESSION_LEGACY_PICKLE=1 to keep them")
+        raise ValueError("Unrecognized session encoding")
+    _, version, fingerprint, flags = _CODEC_HEADER.unpack_from(blob, 0)
+    offset = _CODEC_HEADER.size
+    if version == 0:
+        return json.loads(blob[offset:], object_hook=_json_object_hook)
+    if version != SESSION_CODEC_VERSION:
+        raise ValueError(f"Unsupported session encoding version {version}")
+    if fingerprint != CODEC_FINGERPRINT:
+        raise ValueError("Session was encoded against a different story")
+    session_data = {}
+    if flags & _CODEC_FLAG_STYLE:
+        session_data['style_preferences'], offset = _unpack_strings(blob, offset)
+    if flags & _CODEC_FLAG_TRAITS:
+        session_data['personality_traits'], offset = _unpack_strings(blob, offset)
+    session_data['state'] = None
+    if flags & _CODEC_FLAG_STATE:
+        session_data['state'], offset = _unpack_state(blob, offset)
+    (length,) = _U32.unpack_from(blob, offset)
+    if length:
+        extras = json.loads(blob[offset + 4:offset + 4 + length], object_hook=_json_object_hook)
+        state_extras = extras.pop('__state__', None)
+        if state_extras and session_data['state'] is not None:
+            session_data['state'].update(state_extras)
+        session_data.update(extras)
+    return session_data
+
 # --- Game State (In-memory - BAD for multiple users/production) ---
 game_state = {
     "current_node_id": "start",
@@ -510,47 +1816,81 @@ def get_dynamic_seed(base_seed, path_node_ids, session_id=None):
     
     return seed
 
-def enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id=None):
-    """Enhance a prompt based on the user's journey and style preferences"""
+POSITIVE_TRAITS = ["kind", "adventurous", "bold", "wise", "resourceful"]
+NEGATIVE_TRAITS = ["selfish", "cautious", "stubborn"]
+
+def sentiment_bucket(sentiment_tally):
+    """Collapse a sentiment tally into "positive", "negative" or "neutral" """
+    positive_count = sum(sentiment_tally.get(tag, 0) for tag in POSITIVE_TRAITS)
+    negative_count = sum(sentiment_tally.get(tag, 0) for tag in NEGATIVE_TRAITS)
+    if positive_count > negative_count:
+        return "positive"
+    if negative_count > positive_count:
+        return "negative"
+    return "neutral"
+
+def style_elements_for(style_preferences, bucket):
     # Start with base style elements
     style_elements = ["detailed", "fantasy style"]
-    
-    if session_id:
-        # Get user session data
-        session_data = get_user_session(session_id)
-        
-        # Get style preferences from session data
-        style_preferences = session_data.get('style_preferences', [])
-        if style_preferences:
-            style_elements.extend(style_preferences)
-    
-    # Add elements based on sentiment tally
-    positive_traits = ["kind", "adventurous", "bold", "wise", "resourceful"]
-    negative_traits = ["selfish", "cautious", "stubborn"]
-    
-    positive_count = sum(sentiment_tally.get(tag, 0) for tag in positive_traits)
-    negative_count = sum(sentiment_tally.get(tag, 0) for tag in negative_traits)
+    style_elements.extend(style_preferences)
     
     # Add style modifiers based on sentiment balance
-    if positive_count > negative_count:
+    if bucket == "positive":
         style_elements.append("bright")
         style_elements.append("vibrant colors")
-    elif negative_count > positive_count:
+    elif bucket == "negative":
         style_elements.append("dark")
         style_elements.append("muted colors")
+    return style_elements
+
+def enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id=None, style_preferences=None):
+    """Enhance a prompt based on the user's journey and style preferences"""
+    if style_preferences is None:
+        style_preferences = []
+        if session_id:
+            # Get style preferences from session data
+            session_data = request_session(session_id)
+            style_preferences = session_data.get('style_preferences', [])
+    
+    style_elements = style_elements_for(style_preferences, sentiment_bucket(sentiment_tally))
     
     # Combine everything into an enhanced prompt
     enhanced = f"{base_prompt}, {', '.join(style_elements)}"
     
-    # Make each image different even for the same node by adding timestamp
-    timestamp = int(time.time())
-    enhanced += f", seed:{timestamp}"
+    if IMAGE_PROMPT_MODE == 'timestamp':
+        # Make each image different even for the same node by adding timestamp
+        timestamp = int(time.time())
+        enhanced += f", seed:{timestamp}"
     
     return enhanced
 
-def reset_game_state(session_id=None):
-    """Reset the game state"""
-    initial_state = {
+def image_query(seed):
+    return f"?seed={seed}&width={IMAGE_WIDTH}&height={IMAGE_HEIGHT}&model={IMAGE_MODEL}"
+
+# Built URLs keyed by (node index, style preferences, sentiment bucket, seed)
+image_url_cache = LRUCache(capacity=4096, shards=4)
+
+def build_image_url(node, style_preferences, sentiment_tally, dynamic_seed):
+    """Deterministic image URL for a node, memoized so repeated polls skip prompt building"""
+    bucket = sentiment_bucket(sentiment_tally)
+    key = (node.index, tuple(style_preferences), bucket, dynamic_seed)
+    image_url = image_url_cache.get(key)
+    if image_url is None:
+        prompt = f"{node.prompt}, {', '.join(style_elements_for(style_preferences, bucket))}"
+        image_url = proxied_image_url(
+            f"{POLLINATIONS_BASE_URL}{quote(prompt)}{image_query(dynamic_seed)}")
+        image_url_cache.set(key, image_url)
+    return image_url
+
+STYLE_OPTIONS = [
+    "fantasy", "medieval", "ethereal", "mystical", "dramatic", 
+    "whimsical", "dark", "bright", "colorful", "muted"
+]
+PERSONALITY_TRAITS = ["cautious", "bold", "diplomatic", "direct", "curious", "practical", 
+                      "optimistic", "pessimistic", "detailed", "concise"]
+
+def new_game_state():
+    return {
         "current_node_id": "start",
         "path_history": ["start"],
         "score": 0,
@@ -558,148 +1898,1794 @@ def reset_game_state(session_id=None):
         "choice_history": [],
         "created_at": time.time()
     }
-    
+
+def start_new_game(session_data):
+    """Give a session fresh style preferences, traits and game state (no I/O)"""
+    import random
+    session_data['style_preferences'] = random.sample(STYLE_OPTIONS, 3)
+    session_data['personality_traits'] = random.sample(PERSONALITY_TRAITS, 3)
+    session_data['state'] = new_game_state()
+    return session_data['state']
+
+def reset_game_state(session_id=None):
+    """Reset the game state"""
     # If we have a session ID, store the state in persistent storage
     if session_id:
         try:
-            import random
-            all_style_options = [
-                "fantasy", "medieval", "ethereal", "mystical", "dramatic", 
-                "whimsical", "dark", "bright", "colorful", "muted"
-            ]
-            traits = ["cautious", "bold", "diplomatic", "direct", "curious", "practical", 
-                      "optimistic", "pessimistic", "detailed", "concise"]
-            
             # Get existing session or create new one
-            session_data = get_user_session(session_id)
+            session_data = request_session(session_id)
+            initial_state = start_new_game(session_data)
             
-            # Update the session data
-            session_data['style_preferences'] = random.sample(all_style_options, 3)
-            session_data['personality_traits'] = random.sample(traits, 3)
-            session_data['state'] = initial_state
-            
-            # Save the updated session
-            save_user_session(session_id, session_data)
+            # Save the updated session once the request is done
+            mark_session_dirty(session_id, session_data)
             
             logging.info(f"Successfully reset state for session {session_id}")
             return initial_state
         except Exception as e:
             logging.error(f"Error resetting state: {str(e)}")
-            return initial_state
+            return new_game_state()
+    
+    return new_game_state()
+
+def state_image_url(node, game_state, session_data, session_id):
+    """Image URL shown for the player's current node"""
+    path_node_ids = game_state.get("path_history", [])
+    sentiment_tally = game_state.get("sentiment_tally", {})
+    style_preferences = session_data.get('style_preferences', [])
+    dynamic_seed = get_dynamic_seed(node.seed, path_node_ids, session_id)
     
-    return initial_state
+    if IMAGE_PROMPT_MODE == 'deterministic':
+        return build_image_url(node, style_preferences, sentiment_tally, dynamic_seed)
+    
+    choice_history = game_state.get("choice_history", [])
+    last_choice = choice_history[-1] if choice_history else None
+    path_tuples = [(node_id, sentiment_tally.get(node_id, 0)) for node_id in path_node_ids]
+    enhanced_prompt = enhance_prompt(node.prompt, path_tuples, sentiment_tally, last_choice,
+                                     style_preferences=style_preferences)
+    
+    # Create the image URL
+    encoded_prompt = quote(enhanced_prompt)
+    return proxied_image_url(f"{POLLINATIONS_BASE_URL}{encoded_prompt}")
 
 def get_node_details(node_id):
-    """Get details for a story node with personalized content"""
-    try:
-        # Get base node
-        node = story_nodes.get(node_id)
-        if not node:
-            return None
-            
-        # Make a copy so we don't modify the original
-        node_copy = node.copy()
-        
-        # Personalize choices if we're not at an end node
-        if not node_copy.get("is_end", False) and "choices" in node_copy:
-            # Deep copy choices to avoid modifying original
-            node_copy["choices"] = [choice.copy() for choice in node_copy["choices"]]
-            
-            # Personalize choice texts with small variations
-            for choice in node_copy["choices"]:
-                if "text" in choice:
-                    # We could add small variations to choice text here
-                    # But we'll keep the first choice consistent as required
-                    pass  # Implemented in the next update
+    """Get the shared, read-only payload for a story node"""
+    node = STORY_GRAPH.get(node_id)
+    return node.payload if node else None
+
+def apply_choice(game_state, choice_index, session_id):
+    """Apply one choice to game_state in place; returns an error message if it is invalid"""
+    # Get current node
+    current_node_id = game_state.get("current_node_id", "")
+    if not current_node_id:
+        return "No current node in game state"
+    
+    # Get current node details
+    node = STORY_GRAPH.get(current_node_id)
+    if not node:
+        return "Invalid current node"
         
-        return node_copy
+    # Validate choice index
+    if not 0 <= choice_index < len(node.choices):
+        return "Invalid choice index"
         
-    except Exception as e:
-        traceback.print_exc()
-        return None
+    # Get the chosen choice
+    choice = node.choices[choice_index]
+    
+    # Special processing for dynamic ending calculation
+    next_node_id = resolve_next_node(choice, game_state, session_id)
+    
+    # Update game state
+    game_state["current_node_id"] = next_node_id
+    game_state["path_history"].append(next_node_id)
+    
+    # Update score
+    game_state["score"] += choice.score_modifier
+    
+    # Update sentiment tally
+    tag = choice.tag
+    if tag:
+        if tag not in game_state["sentiment_tally"]:
+            game_state["sentiment_tally"][tag] = 0
+        game_state["sentiment_tally"][tag] += 1
+    
+    # Record this choice
+    game_state["choice_history"].append({
+        "from_node": current_node_id,
+        "choice_index": choice_index,
+        "choice_text": choice.text,
+        "tag": tag
+    })
+    return None
 
-# --- API Endpoints ---
-@app.route('/')
-def serve_index():
-    try:
-        return send_from_directory('../public', 'index.html')
-    except Exception as e:
-        print(f"Error serving index: {str(e)}")
-        return f"Error serving page: {str(e)}", 500
+CHOICE_BATCH_MAX = int(os.environ.get('CHOICE_BATCH_MAX', '64'))
 
-@app.route('/<path:path>')
-def serve_static(path):
-    try:
-        return send_from_directory('../public', path)
-    except Exception as e:
-        print(f"Error serving static file {path}: {str(e)}")
-        return f"Error serving file: {str(e)}", 404
+def apply_choices(game_state, choice_indexes, session_id):
+    """Apply a sequence of choices all-or-nothing.
 
-@app.route('/api/state', methods=['GET', 'OPTIONS'])
-def get_current_state():
-    if request.method == 'OPTIONS':
-        response = make_response()
-        response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
+    Returns (new_state, None) on success or (None, (step, message)) for the
+    first invalid step; game_state itself is never modified.
+    """
+    if not isinstance(choice_indexes, list) or not choice_indexes:
+        return None, (None, "choice_indexes must be a non-empty list")
+    if len(choice_indexes) > CHOICE_BATCH_MAX:
+        return None, (None, f"At most {CHOICE_BATCH_MAX} choices per batch")
+
+    # Work on a copy so a failing step leaves the stored state untouched
+    state = dict(game_state)
+    state["path_history"] = list(game_state["path_history"])
+    state["sentiment_tally"] = dict(game_state["sentiment_tally"])
+    state["choice_history"] = list(game_state["choice_history"])
+
+    for step, choice_index in enumerate(choice_indexes):
+        if isinstance(choice_index, bool):
+            return None, (step, "Choice index must be a number")
+        try:
+            choice_index = int(choice_index)
+        except (TypeError, ValueError):
+            return None, (step, "Choice index must be a number")
+        error = apply_choice(state, choice_index, session_id)
+        if error:
+            return None, (step, error)
+    return state, None
+
+def generic_ending_for(score, positive_count, negative_count):
+    """The _calculate_end rule: pick a generic ending from score and sentiment balance"""
+    if score >= 5 and positive_count > negative_count:
+        return "generic_good_ending"
+    elif score <= 0 or negative_count > positive_count:
+        return "generic_bad_ending"
+    return "generic_neutral_ending"
+
+# --- Story graph analysis ---
+def enumerate_story_paths(graph=None, max_depth=32):
+    """Yield every path from the start node as a tuple of (node, choice) pairs.
+
+    A path ends at an end node, at a _calculate_end choice, or when it reaches
+    max_depth choices (which only happens if the story has a cycle). Branches
+    that rejoin, like tree_climb and creature_guidance both leading to
+    forest_edge, are followed separately, since the score and tags that led
+    there differ.
+    """
+    graph = graph or STORY_GRAPH
+    stack = [(graph.get("start"), ())]
+    while stack:
+        node, path = stack.pop()
+        if node.is_end or len(path) >= max_depth:
+            yield path
+            continue
+        for choice in node.choices:
+            step = path + ((node, choice),)
+            if choice.next_index == CALCULATE_END_INDEX:
+                yield step
+            else:
+                stack.append((graph.nodes[choice.next_index], step))
+
+def path_outcome(path):
+    """Score and (positive, negative) tag counts accumulated before the last choice"""
+    score = positive_count = negative_count = 0
+    for _, choice in path[:-1]:
+        score += choice.score_modifier
+        positive_count += choice.tag in POSITIVE_TRAITS
+        negative_count += choice.tag in NEGATIVE_TRAITS
+    return score, positive_count, negative_count
+
+def build_ending_table(graph=None, max_depth=32):
+    """Map every (score, positive, negative) reachable at a _calculate_end to its generic ending.
+
+    An offline view for scripts/analyze_story.py of which endings the story can
+    actually produce; requests apply generic_ending_for directly, which is as
+    cheap as a lookup and also covers states the enumeration never reaches.
+    """
+    table = {}
+    for path in enumerate_story_paths(graph, max_depth):
+        if path and path[-1][1].next_index == CALCULATE_END_INDEX:
+            key = path_outcome(path)
+            table[key] = generic_ending_for(*key)
+    return table
+
+def resolve_next_node(choice, game_state, session_id):
+    """Where a choice leads, resolving _calculate_end from the state before the choice"""
+    if choice.next_index != CALCULATE_END_INDEX:
+        return choice.next_node
+    
+    # Calculate ending based on score and sentiment
+    score = game_state.get("score", 0)
+    sentiment_tally = game_state.get("sentiment_tally", {})
+    
+    # Count positive vs negative tags
+    positive_count = sum(sentiment_tally.get(tag, 0) for tag in POSITIVE_TRAITS)
+    negative_count = sum(sentiment_tally.get(tag, 0) for tag in NEGATIVE_TRAITS)
+    
+    next_node_id = generic_ending_for(score, positive_count, negative_count)
+        
+    # Create a unique ending variation based on the session ID
+    # This ensures each user gets a different ending
+    if next_node_id in CUSTOM_ENDINGS:
+        # Use the session ID to pick a specific variant
+        session_hash = int(hashlib.md5(session_id.encode()).hexdigest(), 16)
+        ending_options = CUSTOM_ENDINGS[next_node_id]
+        ending_index = session_hash % len(ending_options)
+        # compile_story guarantees every variant exists
+        next_node_id = ending_options[ending_index]
+    return next_node_id
+
+# --- Image proxy with content-addressed disk cache ---
+# With IMAGE_PROXY=1 image URLs handed to the browser point at /api/image/<key>,
+# where key is the SHA-256 of the upstream Pollinations URL. The first request
+# fetches the image through a pooled requests.Session and stores the bytes under
+# IMAGE_CACHE_DIR; later requests (from any player) are served from disk with
+# long-lived cache headers. All workers share the directory and one size counter
+# kept under a file lock; once it passes IMAGE_CACHE_MAX_BYTES the directory is
+# recounted and trimmed least-recently-used first. .url sidecars count towards
+# the cap and are removed after IMAGE_URL_MAX_AGE if their image never arrives.
+IMAGE_PROXY = os.environ.get('IMAGE_PROXY', '0') == '1'
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', '/tmp/image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get('IMAGE_FETCH_TIMEOUT', '25'))
+IMAGE_FETCH_POOL_SIZE = int(os.environ.get('IMAGE_FETCH_POOL_SIZE', '16'))
+IMAGE_URL_MAX_AGE = float(os.environ.get('IMAGE_URL_MAX_AGE', '86400'))
+# Where upstream fetches actually go; point it at a local stand-in server for testing
+IMAGE_UPSTREAM_BASE = os.environ.get('IMAGE_UPSTREAM_BASE', POLLINATIONS_BASE_URL)
+
+def _sniff_image_type(data):
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+class ImageCache:
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES,
+                 url_max_age=IMAGE_URL_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.url_max_age = url_max_age
+        self.lock = threading.Lock()
+        self.urls = LRUCache(capacity=10000, shards=4)
+        # Striped locks so concurrent requests for the same image trigger one upstream fetch
+        self.fetch_locks = [threading.Lock() for _ in range(64)]
+        self.counts = {'rescans': 0, 'evictions': 0, 'orphans_removed': 0, 'last_orphans': 0, 'last_bytes': 0}
+        self._session = None
+
+    @staticmethod
+    def key_for(url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, key, suffix=''):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def _scan(self):
+        """(mtime, size, key, suffix) for every image and .url file on disk"""
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                key, suffix = name[:64], name[64:]
+                if len(key) == 64 and suffix in ('', '.url'):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    found.append((stat.st_mtime, stat.st_size, key, suffix))
+        return found
+
+    def _rebuild(self):
+        """Evict least recently used images until the directory fits in max_bytes.
+
+        Called with the cache file lock held. Every worker writes into the same
+        directory, so the size is recounted from disk rather than trusted from
+        any one process. .url files whose image was never fetched are deleted
+        once they are url_max_age old; younger ones count towards the cap.
+        """
+        found = self._scan()
+        images = [(mtime, size, key) for mtime, size, key, suffix in found if not suffix]
+        url_sizes = {key: size for _, size, key, suffix in found if suffix}
+        cached = {key for _, _, key in images}
+        cutoff = time.time() - self.url_max_age
+        orphans = [key for mtime, _, key, suffix in found if suffix and key not in cached]
+        stale = {key for mtime, _, key, suffix in found
+                 if suffix and key not in cached and mtime < cutoff}
+        removed = [(key, '.url') for key in stale]
+        total = sum(size for _, size, _ in images) + sum(
+            size for key, size in url_sizes.items() if key not in stale)
+        evicted = 0
+        # Oldest first; an image takes its .url sidecar with it
+        for _, size, key in sorted(images):
+            if total <= self.max_bytes:
+                break
+            removed += [(key, ''), (key, '.url')]
+            total -= size + url_sizes.get(key, 0)
+            evicted += 1
+        for key, suffix in removed:
+            try:
+                os.remove(self._path(key, suffix))
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.counts['rescans'] += 1
+            self.counts['evictions'] += evicted
+            self.counts['orphans_removed'] += len(stale)
+            self.counts['last_orphans'] = len(orphans) - len(stale)
+            self.counts['last_bytes'] = total
+        return total
+
+    def _account(self, added):
+        """Add bytes to the shared size counter, rebuilding it from disk when over the cap"""
+        import fcntl
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.size.lock'), 'a+') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            lock_file.seek(0)
+            current = lock_file.read().strip()
+            if current.isdigit():
+                total = int(current) + added
+            else:
+                total = self.max_bytes + 1  # No counter yet: count what is on disk
+            if total > self.max_bytes:
+                total = self._rebuild()
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write(str(total))
+            lock_file.flush()
+
+    def http(self):
+        if self._session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=IMAGE_FETCH_POOL_SIZE)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+
+    def register(self, url):
+        """Remember the upstream URL for a key and return the key"""
+        key = self.key_for(url)
+        if self.urls.get(key) is None:
+            self.urls.set(key, url)
+            # Persist the mapping so other workers (and restarts) can resolve the key
+            path = self._path(key, '.url')
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'x') as f:
+                    f.write(url)
+                self._account(len(url.encode()))
+            except FileExistsError:
+                pass
+            except OSError as e:
+                logging.error(f"Error recording image URL for {key}: {str(e)}")
+        return key
+
+    def upstream_url(self, key):
+        url = self.urls.get(key)
+        if url is None:
+            try:
+                with open(self._path(key, '.url')) as f:
+                    url = f.read()
+                self.urls.set(key, url)
+            except FileNotFoundError:
+                return None
+        return url
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # The mtime is the shared recency every worker's eviction sorts by
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        # Overwriting an image over-counts until the next rebuild, which only evicts sooner
+        self._account(len(data))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def fetch(self, key):
+        """Return the image bytes for key from disk, fetching upstream on a miss"""
+        data = self.get(key)
+        if data is not None:
+            return data
+        url = self.upstream_url(key)
+        if url is None or not url.startswith(POLLINATIONS_BASE_URL):
+            return None
+        with self.fetch_locks[int(key[:8], 16) % len(self.fetch_locks)]:
+            data = self.get(key)
+            if data is not None:
+                return data
+            upstream = IMAGE_UPSTREAM_BASE + url[len(POLLINATIONS_BASE_URL):]
+            with timed('image_fetch_seconds'):
+                response = self.http().get(upstream, timeout=IMAGE_FETCH_TIMEOUT)
+            response.raise_for_status()
+            data = response.content
+            self.put(key, data)
+            return data
+
+image_cache = ImageCache()
+
+def proxied_image_url(url):
+    """Map an upstream image URL to this server's caching proxy when enabled"""
+    if not IMAGE_PROXY:
+        return url
+    return f"/api/image/{image_cache.register(url)}"
+
+# --- Speculative image prefetch ---
+# With IMAGE_PREFETCH=1 (which needs IMAGE_PROXY=1 and deterministic prompts),
+# serving /api/state also queues the images of every node the current choices
+# lead to, so the chosen branch is usually already in the image cache when
+# /api/choice returns. Work is capped globally and per session, and queued
+# fetches for a node the player has left are cancelled.
+IMAGE_PREFETCH = os.environ.get('IMAGE_PREFETCH', '0') == '1'
+IMAGE_PREFETCH_WORKERS = int(os.environ.get('IMAGE_PREFETCH_WORKERS', '4'))
+IMAGE_PREFETCH_MAX_INFLIGHT = int(os.environ.get('IMAGE_PREFETCH_MAX_INFLIGHT', '16'))
+IMAGE_PREFETCH_PER_SESSION = int(os.environ.get('IMAGE_PREFETCH_PER_SESSION', '2'))
+# Prefetched images nobody asked for within this many seconds count as wasted
+IMAGE_PREFETCH_WASTE_AFTER = float(os.environ.get('IMAGE_PREFETCH_WASTE_AFTER', '300'))
+
+class ImagePrefetcher:
+    def __init__(self, cache, workers=IMAGE_PREFETCH_WORKERS, max_inflight=IMAGE_PREFETCH_MAX_INFLIGHT,
+                 per_session=IMAGE_PREFETCH_PER_SESSION):
+        self.cache = cache
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.per_session = per_session
+        self.lock = threading.Lock()
+        self.executor = None
+        self.sessions = OrderedDict()  # session_id -> (node_id, [(key, future), ...]), oldest first
+        self.unused = OrderedDict()  # prefetched key -> completion time, until requested
+        self.counts = {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0,
+                       'skipped': 0, 'hits': 0, 'wasted': 0}
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def candidate_urls(self, session_id, node, game_state, session_data):
+        """Image URLs of every node reachable from node in one choice"""
+        style_preferences = session_data.get('style_preferences', [])
+        path_node_ids = game_state.get("path_history", [])
+        sentiment_tally = game_state.get("sentiment_tally", {})
+        urls = []
+        for choice in node.choices:
+            next_node = STORY_GRAPH.get(resolve_next_node(choice, game_state, session_id))
+            next_tally = sentiment_tally
+            if choice.tag:
+                next_tally = dict(sentiment_tally)
+                next_tally[choice.tag] = next_tally.get(choice.tag, 0) + 1
+            seed = get_dynamic_seed(next_node.seed, path_node_ids + [next_node.id], session_id)
+            url = build_image_url(next_node, style_preferences, next_tally, seed)
+            if url not in urls:
+                urls.append(url)
+        return urls
+
+    def schedule(self, session_id, node, game_state, session_data):
+        keys = [url.rsplit('/', 1)[1] for url in
+                self.candidate_urls(session_id, node, game_state, session_data)]
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='image-prefetch')
+            previous_node, previous = self.sessions.get(session_id, (None, []))
+            if previous_node == node.id:
+                return
+            # The player moved on: drop queued work for branches they can no longer reach.
+            # Fetches that could not be cancelled (already running) or are still
+            # wanted stay pending and count against the per-session cap.
+            pending = []
+            for key, future in previous:
+                if future.done():
+                    continue
+                if key not in keys and future.cancel():
+                    self.counts['cancelled'] += 1
+                else:
+                    pending.append((key, future))
+            self._expire_unused()
+            inflight = {key for key, _ in pending}
+            for key in keys:
+                if key in inflight:
+                    continue
+                if len(pending) >= self.per_session or not self.slots.acquire(blocking=False):
+                    self.counts['skipped'] += 1
+                    continue
+                self.counts['submitted'] += 1
+                future = self.executor.submit(self._fetch, key)
+                future.add_done_callback(lambda _: self.slots.release())
+                pending.append((key, future))
+            self.sessions[session_id] = (node.id, pending)
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > 10000:
+                self.sessions.popitem(last=False)
+
+    def _fetch(self, key):
+        try:
+            if self.cache.get(key) is not None:
+                return
+            self.cache.fetch(key)
+            with self.lock:
+                self.counts['completed'] += 1
+                self.unused[key] = time.monotonic()
+        except Exception as e:
+            logging.error(f"Error prefetching image {key}: {str(e)}")
+            self._count('failed')
+
+    def _expire_unused(self):
+        # Called with self.lock held
+        cutoff = time.monotonic() - IMAGE_PREFETCH_WASTE_AFTER
+        while self.unused:
+            key, finished_at = next(iter(self.unused.items()))
+            if finished_at > cutoff:
+                break
+            del self.unused[key]
+            self.counts['wasted'] += 1
+
+    def record_use(self, key):
+        """Called when a browser requests an image, to credit prefetch hits"""
+        with self.lock:
+            if self.unused.pop(key, None) is not None:
+                self.counts['hits'] += 1
+
+    def stats(self):
+        with self.lock:
+            self._expire_unused()
+            stats = dict(self.counts)
+        resolved = stats['hits'] + stats['wasted']
+        stats['hit_rate'] = stats['hits'] / resolved if resolved else 0.0
+        return stats
+
+image_prefetcher = None
+if IMAGE_PREFETCH:
+    if IMAGE_PROXY and IMAGE_PROMPT_MODE == 'deterministic':
+        image_prefetcher = ImagePrefetcher(image_cache)
+    else:
+        logging.warning("IMAGE_PREFETCH needs IMAGE_PROXY=1 and IMAGE_PROMPT_MODE=deterministic; prefetch disabled")
+
+# --- Composited share images ---
+# SHARE_IMAGE_MODE=composite builds the share strip locally with Pillow instead of
+# asking the generator to invent a comic: four panels taken from the player's
+# actual path, plus the title, ending and score. Panel images depend only on the
+# path (not the session), so the finished image is cached by path + ending + score
+# under SHARE_CACHE_DIR and identical journeys reuse it. Compositing runs in a
+# process pool to keep CPU-heavy image work off the request threads.
+SHARE_IMAGE_MODE = os.environ.get('SHARE_IMAGE_MODE', 'remote').lower()
+SHARE_IMAGE_FORMAT = os.environ.get('SHARE_IMAGE_FORMAT', 'png').lower()
+SHARE_CACHE_DIR = os.environ.get('SHARE_CACHE_DIR', '/tmp/share_cache')
+SHARE_IMAGE_WORKERS = int(os.environ.get('SHARE_IMAGE_WORKERS', '2'))
+SHARE_IMAGE_TIMEOUT = float(os.environ.get('SHARE_IMAGE_TIMEOUT', '60'))
+SHARE_IMAGE_TITLE = "Mystic Forest Adventure"
+
+def share_panels(game_state, count=4):
+    """Pick up to count steps of the journey, always including the first and the ending"""
+    path_node_ids = game_state.get("path_history", [])
+    choice_history = game_state.get("choice_history", [])
+    if len(path_node_ids) <= count:
+        steps = list(range(len(path_node_ids)))
+    else:
+        last = len(path_node_ids) - 1
+        steps = sorted({round(i * last / (count - 1)) for i in range(count)})
+    panels = []
+    for step in steps:
+        node = STORY_GRAPH.get(path_node_ids[step])
+        tally = {}
+        for entry in choice_history[:step]:
+            if entry.get("tag"):
+                tally[entry["tag"]] = tally.get(entry["tag"], 0) + 1
+        # No session ID or style preferences, so the same path always yields the same panels
+        prompt = f"{node.prompt}, {', '.join(style_elements_for([], sentiment_bucket(tally)))}"
+        seed = get_dynamic_seed(node.seed, path_node_ids[:step + 1])
+        panels.append({
+            "url": f"{POLLINATIONS_BASE_URL}{quote(prompt)}{image_query(seed)}",
+            "caption": node.situation
+        })
+    return panels
+
+def _load_font(size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 only ships the fixed-size bitmap font
+        return ImageFont.load_default()
+
+def compose_share_image(panel_images, captions, ending_category, score, image_format=SHARE_IMAGE_FORMAT):
+    """Render the share strip; runs inside the process pool so it must stay picklable"""
+    import io
+    import textwrap
+    from PIL import Image, ImageDraw, ImageOps
+
+    panel_size, margin, header, footer = 480, 24, 120, 100
+    width = 2 * panel_size + 3 * margin
+    height = header + 2 * panel_size + 3 * margin + footer
+    canvas = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(canvas)
+    draw.text((width // 2, header // 2 + margin // 2), SHARE_IMAGE_TITLE, fill=(34, 60, 34),
+              font=_load_font(56), anchor='mm')
+
+    caption_font = _load_font(20)
+    for i, (data, caption) in enumerate(zip(panel_images, captions)):
+        x = margin + (i % 2) * (panel_size + margin)
+        y = header + margin + (i // 2) * (panel_size + margin)
+        panel = None
+        if data:
+            try:
+                panel = ImageOps.fit(Image.open(io.BytesIO(data)).convert('RGB'), (panel_size, panel_size))
+            except Exception:
+                panel = None
+        if panel is None:
+            # Generator failed for this step: fall back to the situation text
+            panel = Image.new('RGB', (panel_size, panel_size), (214, 234, 214))
+            # The bundled font has no em dash
+            ImageDraw.Draw(panel).multiline_text((24, 24), textwrap.fill(caption.replace('\u2014', ' - '), 36),
+                                                 fill=(34, 60, 34), font=caption_font, spacing=6)
+        canvas.paste(panel, (x, y))
+        draw.rectangle((x, y, x + panel_size - 1, y + panel_size - 1), outline=(20, 20, 20), width=4)
+
+    draw.text((width // 2, height - footer // 2 - margin // 2), f"{ending_category}  -  Score: {score}",
+              fill=(20, 20, 20), font=_load_font(40), anchor='mm')
+
+    out = io.BytesIO()
+    canvas.save(out, format='WEBP' if image_format == 'webp' else 'PNG')
+    return out.getvalue()
+
+class ShareImageCache:
+    def __init__(self, directory=SHARE_CACHE_DIR, image_format=SHARE_IMAGE_FORMAT):
+        self.directory = directory
+        self.image_format = image_format
+        self.pool = None
+        self.lock = threading.Lock()
+        self.render_locks = [threading.Lock() for _ in range(16)]
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def register(self, game_state, ending_category, score):
+        """Record what a share image should contain and return its file name"""
+        path_node_ids = game_state.get("path_history", [])
+        key = hashlib.sha256(json.dumps([path_node_ids, ending_category, score]).encode()).hexdigest()
+        name = f"{key}.{self.image_format}"
+        spec_path = self._path(key + '.json')
+        if not os.path.exists(spec_path):
+            os.makedirs(self.directory, exist_ok=True)
+            spec = {"panels": share_panels(game_state), "ending_category": ending_category, "score": score}
+            tmp_path = f"{spec_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(spec, f)
+            os.replace(tmp_path, spec_path)
+        return name
+
+    def _fetch_panel(self, url):
+        try:
+            if IMAGE_PROXY:
+                return image_cache.fetch(image_cache.register(url))
+            response = image_cache.http().get(url, timeout=IMAGE_FETCH_TIMEOUT)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            logging.error(f"Error fetching share panel: {str(e)}")
+            return None
+
+    def render(self, name):
+        """Return the image bytes for name, compositing it on first request; None if unknown"""
+        key = name.split('.', 1)[0]
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        with self.render_locks[int(key[:8], 16) % len(self.render_locks)]:
+            try:
+                with open(self._path(name), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+            try:
+                with open(self._path(key + '.json')) as f:
+                    spec = json.load(f)
+            except FileNotFoundError:
+                return None
+
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=4) as fetchers:
+                panel_images = list(fetchers.map(self._fetch_panel, [p["url"] for p in spec["panels"]]))
+            with self.lock:
+                if self.pool is None:
+                    from concurrent.futures import ProcessPoolExecutor
+                    self.pool = ProcessPoolExecutor(max_workers=SHARE_IMAGE_WORKERS)
+            future = self.pool.submit(compose_share_image, panel_images, [p["caption"] for p in spec["panels"]],
+                                      spec["ending_category"], spec["score"], name.rsplit('.', 1)[1])
+            data = future.result(timeout=SHARE_IMAGE_TIMEOUT)
+
+            tmp_path = f"{self._path(name)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(name))
+            return data
+
+share_images = ShareImageCache()
+
+# --- Pre-serialized state payloads ---
+# Everything in an /api/state response except score and image_url is fixed per
+# node, so those parts are encoded once and spliced around the dynamic values.
+# The fragments follow the layout jsonify produces for compact, sorted output
+# ({"choices", "current_node", "image_url", "is_end", "score", "situation"} plus
+# a trailing newline), which keeps responses byte-for-byte identical.
+_STATE_FRAGMENTS = {}
+
+def _state_fragments(node):
+    fragments = _STATE_FRAGMENTS.get(node.index)
+    if fragments is None:
+        dumps = app.json.dumps
+        compact = (',', ':')
+        fragments = (
+            ('{"choices":' + dumps(node.payload.get("choices", []), separators=compact)
+             + ',"current_node":' + dumps(node.payload, separators=compact)
+             + ',"image_url":').encode(),
+            (',"is_end":' + dumps(node.is_end) + ',"score":').encode(),
+            (',"situation":' + dumps(node.situation) + '}\n').encode(),
+        )
+        _STATE_FRAGMENTS[node.index] = fragments
+    return fragments
+
+def render_state(node, score, image_url):
+    """Build the /api/state response for a node, equivalent to jsonify(state_details)"""
+    provider = app.json
+    pretty = provider.compact is False or (provider.compact is None and app.debug)
+    if pretty or not getattr(provider, 'sort_keys', False):
+        return jsonify({
+            "current_node": node.payload,
+            "score": score,
+            "image_url": image_url,
+            "is_end": node.is_end,
+            "choices": node.payload.get("choices", []),
+            "situation": node.situation
+        })
+    return app.response_class(state_body(node, score, image_url), mimetype=provider.mimetype)
+
+def state_body(node, score, image_url):
+    """Compact, sorted JSON body of a state response, spliced from cached fragments"""
+    head, middle, tail = _state_fragments(node)
+    dumps = app.json.dumps
+    return b''.join((head, dumps(image_url).encode(), middle, dumps(score).encode(), tail))
+
+def share_image_details(game_state, session_data, session_id):
+    """Share image URL, score and ending for a finished game, or an error message"""
+    # Get score and ending information
+    score = game_state.get("score", 0)
+    current_node_id = game_state.get("current_node_id", "")
+    node = STORY_GRAPH.get(current_node_id)
+    
+    if not node:
+        return None, "Invalid node"
+        
+    # Check if the game has ended
+    if not node.is_end:
+        return None, "Game has not ended yet"
+        
+    # Get the ending category
+    ending_category = node.ending_category or "Adventure Complete"
+    
+    # Generate the specific manga image prompt with user's journey details
+    path_node_ids = game_state.get("path_history", [])
+    sentiment_tally = game_state.get("sentiment_tally", {})
+    
+    # Generate main traits from sentiment tally
+    main_traits = []
+    for tag, count in sentiment_tally.items():
+        if count > 0:
+            main_traits.append(tag)
+    
+    # Select top 3 traits if we have that many
+    top_traits = main_traits[:3] if len(main_traits) >= 3 else main_traits
+    traits_text = ", ".join(top_traits)
+    
+    # Create a personalized story description
+    personality = f"a {traits_text} adventurer" if traits_text else "an adventurer"
+    
+    # Generate image URL with enhanced prompt
+    base_prompt = node.prompt
+    path_tuples = [(node_id, sentiment_tally.get(node_id, 0)) for node_id in path_node_ids]
+    choice_history = game_state.get("choice_history", [])
+    last_choice = choice_history[-1] if choice_history else None
+    
+    # Get dynamic seed
+    base_seed = node.seed
+    dynamic_seed = get_dynamic_seed(base_seed, path_node_ids, session_id)
+    
+    # Generate enhanced prompt for manga-style image
+    enhanced_prompt = enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice,
+                                     style_preferences=session_data.get('style_preferences', []))
+    
+    if SHARE_IMAGE_MODE == 'composite':
+        # Composited locally from the player's own path; rendered on first fetch
+        return {
+            "share_image_url": f"/api/share-image/{share_images.register(game_state, ending_category, score)}",
+            "score": score,
+            "ending_category": ending_category
+        }, None
+    
+    # Create manga-style panel layout prompt
+    share_manga_prompt = f"Manga style, 4-panel comic strip telling the story of {personality} who achieved the '{ending_category}' ending with a score of {score}, {enhanced_prompt}, clean white background with title 'Mystic Forest Adventure' and score displayed"
+    
+    # URL encode the prompt
+    encoded_manga_prompt = quote(share_manga_prompt)
+    share_image_url = f"{POLLINATIONS_BASE_URL}{encoded_manga_prompt}"
+    if IMAGE_PROMPT_MODE == 'deterministic':
+        share_image_url += image_query(dynamic_seed)
+    share_image_url = proxied_image_url(share_image_url)
+    
+    # Return the share image URL
+    return {
+        "share_image_url": share_image_url,
+        "score": score,
+        "ending_category": ending_category
+    }, None
+
+# --- Signature verification ---
+# SIGNATURE_VERIFICATION=eip191 checks that each save was signed by its wallet
+# (MetaMask personal_sign) by recovering the signer with the optional eth_account
+# package. Recovery is CPU-bound, so it runs in a process pool of
+# SIGNATURE_WORKERS processes, and verified (wallet, message, signature) triples
+# are remembered in a bounded cache so resubmissions skip it. `format` only does
+# the cheap shape checks that always run first; `off` (the default) accepts any
+# signature as before.
+SIGNATURE_VERIFICATION = os.environ.get('SIGNATURE_VERIFICATION', 'off').lower()
+SIGNATURE_WORKERS = int(os.environ.get('SIGNATURE_WORKERS', '2'))
+SIGNATURE_CACHE_SIZE = int(os.environ.get('SIGNATURE_CACHE_SIZE', '10000'))
+SIGNATURE_TIMEOUT = float(os.environ.get('SIGNATURE_TIMEOUT', '10'))
+SIGNATURE_MESSAGE_MAX = 1024
+
+def valid_wallet_address(wallet_address):
+    return (len(wallet_address) == 42 and wallet_address[:2] in ('0x', '0X')
+            and not wallet_address[2:].strip('0123456789abcdefABCDEF'))
+
+def signature_matches(wallet_address, message, signature):
+    """True if signature is wallet_address's EIP-191 signature of message (runs in the pool)"""
+    from eth_account import Account
+    from eth_account.messages import encode_defunct
+    try:
+        signer = Account.recover_message(encode_defunct(text=message), signature=signature)
+    except Exception:
+        return False
+    return signer.lower() == wallet_address.lower()
+
+class SignatureVerifierUnavailable(Exception):
+    pass
+
+class SignatureVerifier:
+    def __init__(self, mode=SIGNATURE_VERIFICATION, workers=SIGNATURE_WORKERS, cache_size=SIGNATURE_CACHE_SIZE):
+        self.available = True
+        if mode == 'eip191':
+            import importlib.util
+            if importlib.util.find_spec('eth_account') is None:
+                # Fail closed: without the library every save is refused rather than trusted
+                logging.error("SIGNATURE_VERIFICATION=eip191 needs eth_account; rejecting all saves")
+                self.available = False
+        self.mode = mode
+        self.workers = workers
+        self.verified = LRUCache(capacity=cache_size, shards=4)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.counts = {'cached': 0, 'verified': 0, 'rejected': 0}
+
+    def format_error(self, wallet_address, message, signature):
+        """Cheap shape checks done before any crypto; returns an error message or None"""
+        if self.mode == 'off':
+            return None
+        if not all(isinstance(value, str) for value in (wallet_address, message, signature)):
+            return "Invalid signature"
+        if not valid_wallet_address(wallet_address):
+            return "Invalid wallet address"
+        if len(message) > SIGNATURE_MESSAGE_MAX:
+            return "Message too long"
+        if (len(signature) != 132 or signature[:2] not in ('0x', '0X')
+                or signature[2:].strip('0123456789abcdefABCDEF')):
+            return "Invalid signature"
+        return None
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def submit(self, wallet_address, message, signature):
+        """A Future resolving to whether the signature is valid; call format_error first.
+
+        Raises SignatureVerifierUnavailable when eip191 is configured but cannot run.
+        """
+        from concurrent.futures import Future
+        if not self.available:
+            raise SignatureVerifierUnavailable("Signature verification is unavailable, try again later")
+        if self.mode != 'eip191':
+            future = Future()
+            future.set_result(True)
+            return future
+        key = (wallet_address.lower(), message, signature.lower())
+        cached = self.verified.get(key)
+        if cached is not None:
+            self._count('cached')
+            future = Future()
+            future.set_result(cached)
+            return future
+        with self.lock:
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        future = self.pool.submit(signature_matches, wallet_address, message, signature)
+
+        def remember(done):
+            # A caller that gave up may have cancelled the check
+            if not done.cancelled() and done.exception() is None:
+                self.verified.set(key, done.result())
+                self._count('verified' if done.result() else 'rejected')
+        future.add_done_callback(remember)
+        return future
+
+    def verify(self, wallet_address, message, signature):
+        """Returns an error message if the signature does not check out, else None"""
+        error = self.format_error(wallet_address, message, signature)
+        if error:
+            return error
+        if not self.submit(wallet_address, message, signature).result(timeout=SIGNATURE_TIMEOUT):
+            return "Signature does not match wallet"
+        return None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+signature_verifier = SignatureVerifier()
+
+# --- Blockchain records ---
+def create_blockchain_record(wallet_address, game_data, signature, message):
+    return {
+        'walletAddress': wallet_address,
+        'gameData': game_data,
+        'signature': signature,
+        'message': message,
+        'timestamp': datetime.now().isoformat(),
+        'blockchainHash': hashlib.sha256(f"{wallet_address}{message}{signature}".encode()).hexdigest()
+    }
+
+# Each wallet's records live in an append-only JSON-lines log plus an index of
+# 8-byte record offsets and a small summary (count, latest record, last
+# modified), all named after a hash of the address. Appends take an
+# exclusive flock and write every new line with one write(), so concurrent saves
+# from any worker never lose records; readers need no lock because a record is
+# in the log before its offset reaches the index. Wallets still stored in the
+# old /tmp/blockchain_<wallet>.json array are imported on first access.
+#
+# Saves are idempotent: blockchainHash is derived from the signed message, and a
+# .hashes file next to the index holds the 32-byte digest of every record, so
+# appending a record whose hash is already in the log is a no-op. A client that
+# retries a save that timed out (but was still committed) gets the same answer
+# without a duplicate record. Each worker keeps the digest sets of recently used
+# wallets in memory, so an append only reads the digests other workers added.
+BLOCKCHAIN_DIR = os.environ.get('BLOCKCHAIN_DIR', '/tmp/blockchain')
+BLOCKCHAIN_FSYNC = os.environ.get('BLOCKCHAIN_FSYNC', '0') == '1'
+LEGACY_BLOCKCHAIN_DIR = '/tmp'
+
+class BlockchainLog:
+    OFFSET = struct.Struct('>Q')
+
+    def __init__(self, directory=BLOCKCHAIN_DIR, legacy_directory=LEGACY_BLOCKCHAIN_DIR, fsync=BLOCKCHAIN_FSYNC,
+                 hash_cache_wallets=1024):
+        self.directory = directory
+        self.legacy_directory = legacy_directory
+        self.fsync = fsync
+        # wallet -> (record count, digest set) as of this worker's last look at the log
+        self.known = LRUCache(capacity=hash_cache_wallets, shards=4)
+
+    def _paths(self, wallet_address):
+        key = hashlib.sha256(wallet_address.encode()).hexdigest()
+        base = os.path.join(self.directory, key[:2], key)
+        return base + '.jsonl', base + '.idx'
+
+    def _hashes_path(self, wallet_address):
+        return self._paths(wallet_address)[0][:-len('.jsonl')] + '.hashes'
+
+    @staticmethod
+    def _digest(record):
+        try:
+            digest = bytes.fromhex(record.get('blockchainHash', ''))
+        except (TypeError, ValueError):
+            digest = b''
+        if len(digest) != 32:
+            digest = hashlib.sha256(json.dumps(record, sort_keys=True).encode()).digest()
+        return digest
+
+    def _read_hashes(self, wallet_address, start):
+        """Digest bytes from record start onwards, b'' if there is no .hashes file"""
+        try:
+            with open(self._hashes_path(wallet_address), 'rb') as f:
+                f.seek(start * 32)
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    def _known_hashes(self, wallet_address, log, idx):
+        """Digests of every record in the log (lock held).
+
+        The set is kept per wallet between appends; only digests written since,
+        by another worker, are read back. A .hashes file that lags the index is
+        rebuilt from the log.
+        """
+        count = os.fstat(idx.fileno()).st_size // self.OFFSET.size
+        cached = self.known.get(wallet_address)
+        if cached is not None and cached[0] == count:
+            return cached[1]
+        if cached is not None and cached[0] < count:
+            data = self._read_hashes(wallet_address, cached[0])
+            if len(data) == 32 * (count - cached[0]):
+                known = cached[1] | {data[i:i + 32] for i in range(0, len(data), 32)}
+                self.known.set(wallet_address, (count, known))
+                return known
+        data = self._read_hashes(wallet_address, 0)
+        if len(data) != 32 * count:
+            # Written before hashes existed, or a crash between the log and this file
+            log.seek(0)
+            data = b''.join(self._digest(json.loads(line)) for line in log)
+            with open(self._hashes_path(wallet_address), 'wb') as f:
+                f.write(data)
+        known = {data[i:i + 32] for i in range(0, len(data), 32)}
+        self.known.set(wallet_address, (count, known))
+        return known
+
+    def _summary_path(self, wallet_address):
+        return self._paths(wallet_address)[0][:-len('.jsonl')] + '.summary.json'
+
+    def _legacy_path(self, wallet_address):
+        # The old layout used the raw address as a file name; never follow anything path-like
+        if not wallet_address or '/' in wallet_address or '\\' in wallet_address or wallet_address.startswith('.'):
+            return None
+        return os.path.join(self.legacy_directory, f"blockchain_{wallet_address}.json")
+
+    @staticmethod
+    def _encode(record):
+        return json.dumps(record, separators=(',', ':')).encode() + b'\n'
+
+    def _repair(self, log, idx):
+        """Bring the index in line with the log after a crash between the two writes (lock held).
+
+        Returns True if anything had to be fixed.
+        """
+        log_size = os.fstat(log.fileno()).st_size
+        idx_size = os.fstat(idx.fileno()).st_size
+        if idx_size % self.OFFSET.size:
+            idx_size -= idx_size % self.OFFSET.size
+            idx.truncate(idx_size)
+        if idx_size:
+            idx.seek(idx_size - self.OFFSET.size)
+            position, = self.OFFSET.unpack(idx.read(self.OFFSET.size))
+            log.seek(position)
+            position += len(log.readline())
+        else:
+            position = 0
+        if position >= log_size:
+            return False
+        log.seek(position)
+        missing = []
+        for line in log:
+            if not line.endswith(b'\n'):
+                # Torn final write: drop it, the append that made it never returned
+                log.truncate(position)
+                break
+            missing.append(self.OFFSET.pack(position))
+            position += len(line)
+        idx.seek(0, os.SEEK_END)
+        idx.write(b''.join(missing))
+        return True
+
+    def _import_legacy(self, wallet_address, log, idx):
+        """Move records from the old JSON array file into the log (lock held, log empty)"""
+        legacy_path = self._legacy_path(wallet_address)
+        if legacy_path is None or not os.path.exists(legacy_path):
+            return
+        try:
+            with open(legacy_path, 'r') as f:
+                records = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading legacy blockchain file {legacy_path}: {str(e)}")
+            return
+        self._write(log, idx, records)
+        self._write_summary(wallet_address, self._summarize(idx, None, records))
+        os.replace(legacy_path, legacy_path + '.migrated')
+        logging.info(f"Imported {len(records)} legacy blockchain records for wallet {wallet_address}")
+
+    def _write(self, log, idx, records):
+        log.seek(0, os.SEEK_END)
+        position = log.tell()
+        lines, offsets = [], []
+        for record in records:
+            line = self._encode(record)
+            offsets.append(self.OFFSET.pack(position))
+            lines.append(line)
+            position += len(line)
+        log.write(b''.join(lines))
+        log.flush()
+        if self.fsync:
+            os.fsync(log.fileno())
+        idx.seek(0, os.SEEK_END)
+        idx.write(b''.join(offsets))
+        idx.flush()
+        if self.fsync:
+            os.fsync(idx.fileno())
+
+    @staticmethod
+    def _latest(current, records):
+        for record in records:
+            if current is None or record.get('timestamp', '') >= current.get('timestamp', ''):
+                current = record
+        return current
+
+    def _summarize(self, idx, summary, new_records):
+        """The summary after appending new_records to one described by summary (lock held)"""
+        return {
+            'count': os.fstat(idx.fileno()).st_size // self.OFFSET.size,
+            'latest': self._latest(summary['latest'] if summary else None, new_records),
+            'last_modified': time.time(),
+        }
+
+    def _write_summary(self, wallet_address, summary):
+        path = self._summary_path(wallet_address)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(summary, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def _read_summary(self, wallet_address):
+        try:
+            with open(self._summary_path(wallet_address)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _rebuild_summary(self, wallet_address, log, idx):
+        # Full scan; only needed for logs written before summaries existed or after a repair
+        log.seek(0)
+        latest = self._latest(None, (json.loads(line) for line in log))
+        summary = self._summarize(idx, None, [latest] if latest else [])
+        self._write_summary(wallet_address, summary)
+        return summary
+
+    def _open_locked(self, wallet_address):
+        import fcntl
+        log_path, idx_path = self._paths(wallet_address)
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        log = open(log_path, 'a+b')
+        fcntl.flock(log.fileno(), fcntl.LOCK_EX)
+        idx = open(idx_path, 'a+b')
+        if os.fstat(log.fileno()).st_size == 0:
+            self._import_legacy(wallet_address, log, idx)
+        if self._repair(log, idx) or (os.fstat(log.fileno()).st_size
+                                      and not os.path.exists(self._summary_path(wallet_address))):
+            self._rebuild_summary(wallet_address, log, idx)
+        return log, idx
+
+    def append(self, wallet_address, records):
+        """Append records to a wallet's log, skipping any already in it; returns the record count"""
+        start = time.perf_counter()
+        log, idx = self._open_locked(wallet_address)
+        try:
+            known = self._known_hashes(wallet_address, log, idx)
+            new_records, digests = [], {}
+            for record in records:
+                digest = self._digest(record)
+                if digest not in known and digest not in digests:
+                    new_records.append(record)
+                    digests[digest] = None
+            if not new_records:
+                return os.fstat(idx.fileno()).st_size // self.OFFSET.size
+            self._write(log, idx, new_records)
+            with open(self._hashes_path(wallet_address), 'ab') as f:
+                f.write(b''.join(digests))
+            # Only committed digests join the cached set; a failed write leaves it behind the index
+            known.update(digests)
+            self.known.set(wallet_address, (os.fstat(idx.fileno()).st_size // self.OFFSET.size, known))
+            summary = self._summarize(idx, self._read_summary(wallet_address), new_records)
+            self._write_summary(wallet_address, summary)
+            return summary['count']
+        finally:
+            idx.close()
+            log.close()  # closing releases the flock
+            metrics.observe('blockchain_append_seconds', time.perf_counter() - start)
+
+    def _ensure_migrated(self, wallet_address):
+        log_path, _ = self._paths(wallet_address)
+        if not os.path.exists(log_path):
+            legacy_path = self._legacy_path(wallet_address)
+            if legacy_path is not None and os.path.exists(legacy_path):
+                log, idx = self._open_locked(wallet_address)
+                idx.close()
+                log.close()
+
+    def summary(self, wallet_address):
+        """{'count', 'latest', 'last_modified'} for a wallet without touching its records, or None"""
+        summary = self._read_summary(wallet_address)
+        if summary is None and (os.path.exists(self._paths(wallet_address)[0])
+                                or self._legacy_path(wallet_address) is not None
+                                and os.path.exists(self._legacy_path(wallet_address))):
+            # Old log without a summary, or a legacy file: build it under the lock
+            log, idx = self._open_locked(wallet_address)
+            idx.close()
+            log.close()
+            summary = self._read_summary(wallet_address)
+        return summary
+
+    def count(self, wallet_address):
+        self._ensure_migrated(wallet_address)
+        try:
+            return os.path.getsize(self._paths(wallet_address)[1]) // self.OFFSET.size
+        except FileNotFoundError:
+            return 0
+
+    def read(self, wallet_address, start=0, stop=None):
+        """Records start..stop-1 of a wallet, read straight from their offsets"""
+        with timed('blockchain_read_seconds'):
+            return self._read(wallet_address, start, stop)
+
+    def _read(self, wallet_address, start, stop):
+        self._ensure_migrated(wallet_address)
+        log_path, idx_path = self._paths(wallet_address)
+        try:
+            idx = open(idx_path, 'rb')
+        except FileNotFoundError:
+            return []
+        with idx, open(log_path, 'rb') as log:
+            total = os.fstat(idx.fileno()).st_size // self.OFFSET.size
+            stop = total if stop is None else min(stop, total)
+            if start >= stop:
+                return []
+            idx.seek(start * self.OFFSET.size)
+            first, = self.OFFSET.unpack(idx.read(self.OFFSET.size))
+            if stop < total:
+                idx.seek(stop * self.OFFSET.size)
+                end, = self.OFFSET.unpack(idx.read(self.OFFSET.size))
+            else:
+                # Take whole lines only, an append may be in flight past the indexed end
+                idx.seek((stop - 1) * self.OFFSET.size)
+                last, = self.OFFSET.unpack(idx.read(self.OFFSET.size))
+                log.seek(last)
+                end = last + len(log.readline())
+            log.seek(first)
+            data = log.read(end - first)
+        return [json.loads(line) for line in data.splitlines()]
+
+blockchain_log = BlockchainLog()
+
+# --- Group-commit blockchain writer ---
+# BLOCKCHAIN_WRITE_MODE=group-commit hands records to one background thread per
+# worker. Requests queue their record and wait for it to be committed; the writer
+# takes everything queued (up to BLOCKCHAIN_BATCH_MAX records) and appends each
+# wallet's share with one write, and one fsync with BLOCKCHAIN_FSYNC=1. When
+# BLOCKCHAIN_QUEUE_MAX records are already waiting, saves fail fast with
+# BlockchainBusy so the endpoint can answer 503 instead of piling up threads.
+BLOCKCHAIN_WRITE_MODE = os.environ.get('BLOCKCHAIN_WRITE_MODE', 'sync').lower()
+BLOCKCHAIN_QUEUE_MAX = int(os.environ.get('BLOCKCHAIN_QUEUE_MAX', '1024'))
+BLOCKCHAIN_BATCH_MAX = int(os.environ.get('BLOCKCHAIN_BATCH_MAX', '256'))
+BLOCKCHAIN_COMMIT_TIMEOUT = float(os.environ.get('BLOCKCHAIN_COMMIT_TIMEOUT', '10'))
+
+class BlockchainBusy(Exception):
+    pass
+
+class BlockchainWriter(BackgroundThread):
+    thread_name = 'blockchain-writer'
+
+    def __init__(self, log, queue_max=BLOCKCHAIN_QUEUE_MAX, batch_max=BLOCKCHAIN_BATCH_MAX):
+        import queue
+        self.log = log
+        self.batch_max = batch_max
+        self.queue = queue.Queue(maxsize=queue_max)
+        self.lock = threading.Lock()
+        self.counts = {'batches': 0, 'records': 0, 'max_batch': 0, 'rejected': 0, 'failed': 0,
+                       'commit_seconds': 0.0, 'max_commit_seconds': 0.0, 'wait_seconds': 0.0}
+        self.stopped = False
+
+    def submit(self, record):
+        """Queue a record; returns a Future that completes once it is committed"""
+        import queue
+        from concurrent.futures import Future
+        self.start()
+        future = Future()
+        try:
+            self.queue.put_nowait((record, future, time.monotonic()))
+        except queue.Full:
+            with self.lock:
+                self.counts['rejected'] += 1
+            raise BlockchainBusy("Too many saves in flight, try again shortly")
+        return future
+
+    def _commit(self, batch):
+        by_wallet = {}
+        for item in batch:
+            # A future cancelled while queued is dropped; the rest can no longer be cancelled
+            if item[1].set_running_or_notify_cancel():
+                by_wallet.setdefault(item[0]['walletAddress'], []).append(item)
+        start = time.monotonic()
+        failed = 0
+        for wallet_address, items in by_wallet.items():
+            try:
+                self.log.append(wallet_address, [record for record, _, _ in items])
+            except Exception as e:
+                logging.error(f"Error committing {len(items)} blockchain records for {wallet_address}: {str(e)}")
+                failed += len(items)
+                for _, future, _ in items:
+                    future.set_exception(e)
+                continue
+            for _, future, _ in items:
+                future.set_result(True)
+        done = time.monotonic()
+        with self.lock:
+            counts = self.counts
+            counts['batches'] += 1
+            counts['records'] += len(batch)
+            counts['failed'] += failed
+            counts['max_batch'] = max(counts['max_batch'], len(batch))
+            counts['commit_seconds'] += done - start
+            counts['max_commit_seconds'] = max(counts['max_commit_seconds'], done - start)
+            counts['wait_seconds'] += sum(done - queued for _, _, queued in batch)
+
+    def _run(self):
+        import queue
+        while True:
+            try:
+                first = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.stopped:
+                    return
+                continue
+            # Everything that queued up while the previous batch was being written goes together
+            batch = [first]
+            while len(batch) < self.batch_max:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # One bad batch must not stop the writer for every later save
+                logging.error(f"Error committing a batch of {len(batch)} blockchain records: {str(e)}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['queued'] = self.queue.qsize()
+        stats['mean_batch'] = stats['records'] / stats['batches'] if stats['batches'] else 0.0
+        stats['mean_commit_seconds'] = stats['commit_seconds'] / stats['batches'] if stats['batches'] else 0.0
+        stats['mean_wait_seconds'] = stats['wait_seconds'] / stats['records'] if stats['records'] else 0.0
+        return stats
+
+    def shutdown(self):
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join(timeout=BLOCKCHAIN_COMMIT_TIMEOUT)
+
+blockchain_writer = None
+if BLOCKCHAIN_WRITE_MODE == 'group-commit':
+    import atexit
+    blockchain_writer = BlockchainWriter(blockchain_log)
+    atexit.register(blockchain_writer.shutdown)
+
+def store_blockchain_record(blockchain_record):
+    if blockchain_writer is not None:
+        blockchain_writer.submit(blockchain_record).result(timeout=BLOCKCHAIN_COMMIT_TIMEOUT)
+        return
+    blockchain_log.append(blockchain_record['walletAddress'], [blockchain_record])
+
+def load_blockchain_records(wallet_address):
+    return blockchain_log.read(wallet_address)
+
+BLOCKCHAIN_PAGE_DEFAULT = int(os.environ.get('BLOCKCHAIN_PAGE_DEFAULT', '50'))
+BLOCKCHAIN_PAGE_MAX = int(os.environ.get('BLOCKCHAIN_PAGE_MAX', '500'))
+
+def blockchain_page_args(cursor, limit):
+    """Parse the cursor/limit query parameters; returns (start, limit, error)"""
+    try:
+        start = int(cursor) if cursor else 0
+        limit = int(limit) if limit else BLOCKCHAIN_PAGE_DEFAULT
+    except ValueError:
+        return None, None, "cursor and limit must be numbers"
+    if start < 0 or limit < 1:
+        return None, None, "cursor and limit must be positive"
+    return start, min(limit, BLOCKCHAIN_PAGE_MAX), None
+
+def blockchain_etag(summary, start, limit):
+    """Validator for one page, derived from the wallet summary alone"""
+    if summary is None:
+        return f"empty-{start}-{limit}"
+    latest = summary['latest'] or {}
+    return f"{summary['count']}-{summary['last_modified']}-{latest.get('blockchainHash', '')[:16]}-{start}-{limit}"
+
+def blockchain_page(wallet_address, summary, start, limit):
+    """The load-from-blockchain payload for one page of a wallet's records"""
+    if summary is None or not summary['count']:
+        return {"records": [], "message": "No blockchain records found"}
+    records = blockchain_log.read(wallet_address, start, start + limit)
+    next_start = start + len(records)
+    return {
+        "records": records,
+        "latest": summary['latest'],
+        "count": summary['count'],
+        "next_cursor": str(next_start) if next_start < summary['count'] else None,
+        "message": f"Found {summary['count']} blockchain records"
+    }
+
+# --- Wallet balances ---
+# WALLET_BALANCE_PROVIDER=rpc asks WALLET_RPC_URL for eth_getBalance over a pooled
+# HTTP session; the default `mock` keeps the fixed showcase balance. Balances are
+# cached per wallet: fresh for WALLET_BALANCE_TTL seconds, then served stale for up
+# to WALLET_BALANCE_STALE more while one background refresh runs. Concurrent misses
+# for the same wallet share a single upstream call.
+WALLET_BALANCE_PROVIDER = os.environ.get('WALLET_BALANCE_PROVIDER', 'mock').lower()
+WALLET_RPC_URL = os.environ.get('WALLET_RPC_URL', 'https://testnet-passet-hub-eth-rpc.polkadot.io')
+WALLET_RPC_TIMEOUT = float(os.environ.get('WALLET_RPC_TIMEOUT', '5'))
+WALLET_RPC_POOL_SIZE = int(os.environ.get('WALLET_RPC_POOL_SIZE', '8'))
+WALLET_BALANCE_TTL = float(os.environ.get('WALLET_BALANCE_TTL', '15'))
+WALLET_BALANCE_STALE = float(os.environ.get('WALLET_BALANCE_STALE', '300'))
+
+class BalanceProvider:
+    currency = 'PAS'
+    network = 'Polkadot Hub Testnet'
+
+    def balance(self, wallet_address):
+        """The wallet's balance in whole tokens, as a string"""
+        raise NotImplementedError
+
+class MockBalanceProvider(BalanceProvider):
+    def balance(self, wallet_address):
+        # In a real implementation, you would query the blockchain
+        return '1000.0'
+
+class RpcBalanceProvider(BalanceProvider):
+    def __init__(self, url=WALLET_RPC_URL, timeout=WALLET_RPC_TIMEOUT, pool_size=WALLET_RPC_POOL_SIZE):
+        self.url = url
+        self.timeout = timeout
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def balance(self, wallet_address):
+        from decimal import Decimal
+        response = self.session.post(self.url, timeout=self.timeout, json={
+            'jsonrpc': '2.0', 'id': 1, 'method': 'eth_getBalance', 'params': [wallet_address, 'latest']
+        })
+        response.raise_for_status()
+        reply = response.json()
+        if 'error' in reply:
+            raise requests.RequestException(f"RPC error: {reply['error']}")
+        tokens = f"{(Decimal(int(reply['result'], 16)) / Decimal(10) ** 18).normalize():f}"
+        return tokens if '.' in tokens else tokens + '.0'  # same shape as the mock, e.g. '1000.0'
+
+class BalanceCache:
+    def __init__(self, provider, ttl=WALLET_BALANCE_TTL, stale=WALLET_BALANCE_STALE, capacity=10000):
+        self.provider = provider
+        self.ttl = ttl
+        self.entries = LRUCache(capacity=capacity, ttl=ttl + stale, shards=4)
+        self.lock = threading.Lock()
+        self.inflight = {}  # wallet -> Future of the upstream call in progress
+        self.counts = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'coalesced': 0, 'upstream_calls': 0, 'errors': 0}
+        self._refresher = None
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _load(self, wallet_address):
+        """Fetch through the single-flight gate; returns a Future for the balance"""
+        from concurrent.futures import Future
+        with self.lock:
+            future = self.inflight.get(wallet_address)
+            if future is not None:
+                self.counts['coalesced'] += 1
+                return future, False
+            future = self.inflight[wallet_address] = Future()
+            self.counts['upstream_calls'] += 1
+        return future, True
+
+    def _fetch(self, wallet_address, future):
+        try:
+            with timed('balance_fetch_seconds'):
+                balance = self.provider.balance(wallet_address)
+            self.entries.set(wallet_address, (balance, time.monotonic()))
+            future.set_result(balance)
+        except Exception as e:
+            self._count('errors')
+            logging.error(f"Error fetching balance for {wallet_address}: {str(e)}")
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.inflight.pop(wallet_address, None)
+
+    def _refresh_in_background(self, wallet_address):
+        future, owner = self._load(wallet_address)
+        if not owner:
+            return
+        if self._refresher is None:
+            from concurrent.futures import ThreadPoolExecutor
+            with self.lock:
+                if self._refresher is None:
+                    self._refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='balance-refresh')
+        self._refresher.submit(self._fetch, wallet_address, future)
+
+    def get(self, wallet_address):
+        entry = self.entries.get(wallet_address)
+        if entry is not None:
+            balance, fetched_at = entry
+            if time.monotonic() - fetched_at < self.ttl:
+                self._count('hits')
+                return balance
+            self._count('stale_hits')
+            self._refresh_in_background(wallet_address)
+            return balance
+        self._count('misses')
+        future, owner = self._load(wallet_address)
+        if owner:
+            self._fetch(wallet_address, future)
+        return future.result(timeout=WALLET_RPC_TIMEOUT + 5)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['inflight'] = len(self.inflight)
+        return stats
+
+if WALLET_BALANCE_PROVIDER == 'rpc':
+    balance_cache = BalanceCache(RpcBalanceProvider())
+else:
+    balance_cache = BalanceCache(MockBalanceProvider())
+
+def wallet_balance(wallet_address):
+    provider = balance_cache.provider
+    return {
+        'balance': balance_cache.get(wallet_address),
+        'currency': provider.currency,
+        'walletAddress': wallet_address,
+        'network': provider.network
+    }
+
+# --- Static assets ---
+# The frontend files are held in memory with their compressed variants and
+# served with strong ETags. scripts/build_assets.py writes fingerprinted copies
+# (script.<hash>.js), .gz/.br variants and a manifest.json into ASSET_BUILD_DIR;
+# fingerprinted names are cached as immutable, while index.html and the plain
+# names are revalidated on every load. Without a build the files in public/ are
+# loaded as they are and gzipped in memory. Files that are not loaded (too
+# large, or added after startup) fall back to send_from_directory.
+PUBLIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public')
+ASSET_BUILD_DIR = os.environ.get('ASSET_BUILD_DIR',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'build', 'public'))
+ASSET_MAX_BYTES = int(os.environ.get('ASSET_MAX_BYTES', str(1024 * 1024)))
+ASSET_IMMUTABLE = 'public, max-age=31536000, immutable'
+ASSET_REVALIDATE = 'no-cache'
+# Only text formats are worth compressing; images and fonts already are
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+class Asset(NamedTuple):
+    content_type: str
+    digest: str
+    variants: dict         # encoding ('identity', 'gzip', 'br') -> bytes
+    cache_control: str
+
+    def etag(self, encoding):
+        # Each encoding is a different byte sequence, so each gets its own strong ETag
+        return self.digest if encoding == 'identity' else f"{self.digest}-{encoding}"
+
+class AssetStore:
+    def __init__(self, public_dir=PUBLIC_DIR, build_dir=ASSET_BUILD_DIR, max_bytes=ASSET_MAX_BYTES):
+        self.public_dir = public_dir
+        self.build_dir = build_dir
+        self.max_bytes = max_bytes
+        self.assets = None
+        self.built = False
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'not_modified': 0, 'fallbacks': 0, 'br': 0, 'gzip': 0, 'identity': 0}
+
+    def _read(self, directory, name):
+        with open(os.path.join(directory, name), 'rb') as f:
+            return f.read()
+
+    def _load_build(self, manifest):
+        """Assets from a scripts/build_assets.py output directory"""
+        import mimetypes
+        assets = {}
+        for name, entry in manifest['files'].items():
+            variants = {'identity': self._read(self.build_dir, entry['file'])}
+            for encoding, file_name in entry.get('encodings', {}).items():
+                variants[encoding] = self._read(self.build_dir, file_name)
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            digest = entry['sha256'][:32]
+            if entry['file'] != name:
+                assets[entry['file']] = Asset(content_type, digest, variants, ASSET_IMMUTABLE)
+            assets[name] = Asset(content_type, digest, variants, ASSET_REVALIDATE)
+        return assets
+
+    def _load_public(self):
+        """Unbuilt assets straight from public/, gzipped here"""
+        import gzip
+        import mimetypes
+        assets = {}
+        for root, _, files in os.walk(self.public_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                if os.path.getsize(path) > self.max_bytes:
+                    continue
+                name = os.path.relpath(path, self.public_dir).replace(os.sep, '/')
+                data = self._read(self.public_dir, name)
+                content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                variants = {'identity': data}
+                if content_type.startswith(COMPRESSIBLE_TYPES):
+                    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+                    if len(compressed) < len(data):
+                        variants['gzip'] = compressed
+                assets[name] = Asset(content_type, hashlib.sha256(data).hexdigest()[:32], variants, ASSET_REVALIDATE)
+        return assets
+
+    def load(self):
+        # Loaded on the first static request rather than at import, to keep cold starts lean
+        with self.lock:
+            if self.assets is not None:
+                return self.assets
+            try:
+                manifest_path = os.path.join(self.build_dir, 'manifest.json')
+                if os.path.exists(manifest_path):
+                    with open(manifest_path) as f:
+                        self.assets = self._load_build(json.load(f))
+                    self.built = True
+                else:
+                    self.assets = self._load_public()
+            except Exception as e:
+                logging.error(f"Error loading static assets: {str(e)}")
+                self.assets = {}
+            return self.assets
+
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def get(self, name):
+        assets = self.assets if self.assets is not None else self.load()
+        asset = assets.get(name)
+        self._count('hits' if asset is not None else 'fallbacks')
+        return asset
+
+    def respond(self, name, accept_encoding, if_none_match):
+        """(status, body, headers) for an asset, or None if it should be served from disk"""
+        from werkzeug.http import parse_accept_header, parse_etags
+        asset = self.get(name)
+        if asset is None:
+            return None
+        accepted = parse_accept_header(accept_encoding)
+        encoding = next((candidate for candidate in ('br', 'gzip')
+                         if candidate in asset.variants and accepted[candidate] > 0), 'identity')
+        etag = asset.etag(encoding)
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': asset.cache_control, 'Vary': 'Accept-Encoding'}
+        if parse_etags(if_none_match).contains(etag):
+            self._count('not_modified')
+            return 304, b'', headers
+        self._count(encoding)
+        headers['Content-Type'] = asset.content_type
+        if asset.content_type.startswith('text/') or asset.content_type == 'application/javascript':
+            headers['Content-Type'] += '; charset=utf-8'
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return 200, asset.variants[encoding], headers
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['loaded'] = len(self.assets or ())
+            stats['built'] = int(self.built)
+        return stats
+
+static_assets = AssetStore()
+
+@metrics.collector
+def subsystem_metrics():
+    """Counters kept by the caches, workers and pools, exported as gauges"""
+    sources = {
+        'hot_sessions': hot_sessions,
+        'image_url_cache': image_url_cache,
+        'image_cache': image_cache,
+        'image_prefetch': image_prefetcher,
+        'session_sweeper': session_sweeper,
+        'blockchain_writer': blockchain_writer,
+        'balance_cache': balance_cache,
+        'signatures': signature_verifier,
+        'static_assets': static_assets,
+    }
+    gauges = {}
+    for prefix, source in sources.items():
+        if source is None:
+            continue
+        for key, value in source.stats().items():
+            # Ratios and means are left to the scraper, they do not add up across workers
+            if isinstance(value, (int, float)) and not key.endswith('rate') and not key.startswith('mean'):
+                gauges[f"{prefix}_{key}"] = value
+    return gauges
+
+# --- API Endpoints ---
+def asset_response(name):
+    result = static_assets.respond(name, request.headers.get('Accept-Encoding'),
+                                   request.headers.get('If-None-Match'))
+    if result is None:
+        return None
+    status, body, headers = result
+    return make_response(body, status, headers)
+
+@app.route('/')
+def serve_index():
+    try:
+        return asset_response('index.html') or send_from_directory('../public', 'index.html')
+    except Exception as e:
+        print(f"Error serving index: {str(e)}")
+        return f"Error serving page: {str(e)}", 500
+
+@app.route('/<path:path>')
+def serve_static(path):
+    try:
+        return asset_response(path) or send_from_directory('../public', path)
+    except Exception as e:
+        print(f"Error serving static file {path}: {str(e)}")
+        return f"Error serving file: {str(e)}", 404
+
+@app.route('/api/state', methods=['GET', 'OPTIONS'])
+def get_current_state():
+    if request.method == 'OPTIONS':
+        response = make_response()
+        response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
         response.headers.add('Access-Control-Allow-Methods', 'GET, OPTIONS')
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
 
     try:
-        # Get user's session ID from cookies or create a new one
-        session_id = request.cookies.get('session_id')
+        # Get user's session ID from cookies (or the one /api/reset just made) or create a new one
+        session_id = request.cookies.get('session_id') or g.get('session_id')
         if not session_id:
             # Generate a new session ID
             session_id = hashlib.md5(f"{time.time()}-{os.urandom(8).hex()}".encode()).hexdigest()
         
         # Get or create the user's game state from persistent storage
-        session_data = get_user_session(session_id)
+        session_data = request_session(session_id)
         game_state = session_data.get('state')
         
         if not game_state:
-            # Reset/initialize the game state
+            # Reset/initialize the game state; reset_game_state stores it on session_data
             game_state = reset_game_state(session_id)
-            session_data['state'] = game_state
-            save_user_session(session_id, session_data)
             logging.info(f"Created new state for session {session_id}")
         
         current_node_id = game_state["current_node_id"]
-        node_details = get_node_details(current_node_id)
+        node = STORY_GRAPH.get(current_node_id)
         
-        if not node_details:
+        if not node:
             return jsonify({"error": "Invalid node"}), 400
         
         # Generate image URL with dynamic seed and enhanced prompt
-        path_node_ids = game_state.get("path_history", [])
-        sentiment_tally = game_state.get("sentiment_tally", {})
-        choice_history = game_state.get("choice_history", [])
-        last_choice = choice_history[-1] if choice_history else None
-        
-        base_seed = node_details.get("seed", 12345)
-        dynamic_seed = get_dynamic_seed(base_seed, path_node_ids, session_id)
-        
-        path_tuples = [(node, game_state.get("sentiment_tally", {}).get(node, 0)) 
-                       for node in path_node_ids]
+        image_url = state_image_url(node, game_state, session_data, session_id)
         
-        base_prompt = node_details.get("prompt", "")
-        enhanced_prompt = enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id)
-        
-        # Create the image URL
-        encoded_prompt = requests.utils.quote(enhanced_prompt)
-        image_url = f"{POLLINATIONS_BASE_URL}{encoded_prompt}"
-        
-        # Create response data
-        state_details = {
-            "current_node": node_details,
-            "score": game_state.get("score", 0),
-            "image_url": image_url,
-            "is_end": node_details.get("is_end", False),
-            "choices": node_details.get("choices", []),
-            "situation": node_details.get("situation", "")
-        }
+        if image_prefetcher is not None and not node.is_end:
+            image_prefetcher.schedule(session_id, node, game_state, session_data)
         
-        # Create response with cookie
-        response = make_response(jsonify(state_details))
+        # Create response with cookie; the static node content is pre-serialized
+        response = render_state(node, game_state.get("score", 0), image_url)
         response.set_cookie('session_id', session_id, httponly=True, samesite='Strict')
         return response
         
@@ -722,6 +3708,8 @@ def make_choice():
         data = request.get_json()
         if not data:
             return jsonify({"error": "No data provided"}), 400
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
             
         # Get user's session ID from cookies
         session_id = request.cookies.get('session_id')
@@ -740,106 +3728,67 @@ def make_choice():
             return jsonify({"error": "Choice index must be a number"}), 400
             
         # Get the user's game state from persistent storage
-        session_data = get_user_session(session_id)
+        session_data = request_session(session_id)
         game_state = session_data.get('state')
         
         if not game_state:
             return jsonify({"error": "No game in progress"}), 400
             
-        # Get current node
-        current_node_id = game_state.get("current_node_id", "")
-        if not current_node_id:
-            return jsonify({"error": "No current node in game state"}), 400
-        
-        # Get current node details
-        node_details = get_node_details(current_node_id)
-        if not node_details:
-            return jsonify({"error": "Invalid current node"}), 400
-            
-        # Validate choice index
-        if not node_details.get("choices") or choice_index >= len(node_details["choices"]):
-            return jsonify({"error": "Invalid choice index"}), 400
-            
-        # Get the chosen choice
-        choice = node_details["choices"][choice_index]
-        
-        # Special processing for dynamic ending calculation
-        next_node_id = choice.get("next_node")
-        if next_node_id == "_calculate_end":
-            # Calculate ending based on score and sentiment
-            score = game_state.get("score", 0)
-            sentiment_tally = game_state.get("sentiment_tally", {})
-            
-            # Count positive vs negative tags
-            positive_count = sum(sentiment_tally.get(tag, 0) for tag in 
-                             ["kind", "adventurous", "bold", "wise", "resourceful"])
-            negative_count = sum(sentiment_tally.get(tag, 0) for tag in 
-                             ["selfish", "cautious", "stubborn"])
-            
-            # Determine ending based on score and sentiment balance
-            if score >= 5 and positive_count > negative_count:
-                next_node_id = "generic_good_ending"
-            elif score <= 0 or negative_count > positive_count:
-                next_node_id = "generic_bad_ending"
-            else:
-                next_node_id = "generic_neutral_ending"
-                
-            # Create a unique ending variation based on the session ID
-            # This ensures each user gets a different ending
-            custom_endings = {
-                "generic_good_ending": [
-                    "heroic_savior_ending", "wise_mage_ending", "forest_guardian_ending"
-                ],
-                "generic_neutral_ending": [
-                    "peaceful_traveler_ending", "forest_explorer_ending", "merchant_ending"
-                ],
-                "generic_bad_ending": [
-                    "lost_soul_ending", "cursed_wanderer_ending", "forest_prisoner_ending"
-                ]
-            }
-            
-            if next_node_id in custom_endings:
-                # Use the session ID to pick a specific variant
-                session_hash = int(hashlib.md5(session_id.encode()).hexdigest(), 16)
-                ending_options = custom_endings[next_node_id]
-                ending_index = session_hash % len(ending_options)
-                custom_ending = ending_options[ending_index]
-                
-                # If we have this ending defined, use it instead
-                if custom_ending in story_nodes:
-                    next_node_id = custom_ending
-        
-        # Update game state
-        game_state["current_node_id"] = next_node_id
-        game_state["path_history"].append(next_node_id)
-        
-        # Update score
-        score_modifier = choice.get("score_modifier", 0)
-        game_state["score"] += score_modifier
-        
-        # Update sentiment tally
-        tag = choice.get("tag")
-        if tag:
-            if tag not in game_state["sentiment_tally"]:
-                game_state["sentiment_tally"][tag] = 0
-            game_state["sentiment_tally"][tag] += 1
-        
-        # Record this choice
-        game_state["choice_history"].append({
-            "from_node": current_node_id,
-            "choice_index": choice_index,
-            "choice_text": choice.get("text", ""),
-            "tag": tag
-        })
+        # Validate and apply the choice
+        error = apply_choice(game_state, choice_index, session_id)
+        if error:
+            return jsonify({"error": error}), 400
         
         # Save the updated state to persistent storage
         session_data['state'] = game_state
-        save_user_session(session_id, session_data)
-        logging.info(f"Saved updated state after choice for session {session_id}")
+        mark_session_dirty(session_id, session_data)
+        logging.info(f"Updated state after choice for session {session_id}")
         
-        # Return the new state
+        # Return the new state; it reuses this request's session instead of reloading it
         return get_current_state()
-        
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/choices', methods=['POST', 'OPTIONS'])
+def make_choices():
+    if request.method == 'OPTIONS':
+        response = make_response()
+        response.headers.add('Access-Control-Allow-Origin', request.headers.get('Origin', '*'))
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
+        response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        response.headers.add('Access-Control-Allow-Credentials', 'true')
+        return response
+
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({"error": "No data provided"}), 400
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+
+        session_id = request.cookies.get('session_id')
+        if not session_id:
+            return jsonify({"error": "No session found"}), 400
+
+        session_data = request_session(session_id)
+        game_state = session_data.get('state')
+        if not game_state:
+            return jsonify({"error": "No game in progress"}), 400
+
+        # Replay every step in memory; nothing is saved unless all of them are valid
+        new_state, error = apply_choices(game_state, data.get("choice_indexes"), session_id)
+        if error:
+            step, message = error
+            return jsonify({"error": message, "step": step}), 400
+
+        session_data['state'] = new_state
+        mark_session_dirty(session_id, session_data)
+        logging.info(f"Applied {len(data['choice_indexes'])} choices for session {session_id}")
+
+        return get_current_state()
+
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
@@ -854,6 +3803,7 @@ def reset_game():
             session_id = hashlib.md5(f"{time.time()}-{os.urandom(8).hex()}".encode()).hexdigest()
         
         # Reset the game state for this session
+        g.session_id = session_id
         reset_game_state(session_id)
         logging.info(f"Reset game state for session {session_id}")
         
@@ -874,75 +3824,67 @@ def generate_share_image():
             return jsonify({"error": "No session found"}), 400
         
         # Get the user's game state from persistent storage
-        session_data = get_user_session(session_id)
+        session_data = request_session(session_id)
         game_state = session_data.get('state')
         
         if not game_state:
             return jsonify({"error": "No game in progress"}), 400
             
-        # Get score and ending information
-        score = game_state.get("score", 0)
-        current_node_id = game_state.get("current_node_id", "")
-        node_details = get_node_details(current_node_id)
-        
-        if not node_details:
-            return jsonify({"error": "Invalid node"}), 400
-            
-        # Check if the game has ended
-        if not node_details.get("is_end", False):
-            return jsonify({"error": "Game has not ended yet"}), 400
-            
-        # Get the ending category
-        ending_category = node_details.get("ending_category", "Adventure Complete")
-        
-        # Generate the specific manga image prompt with user's journey details
-        path_node_ids = game_state.get("path_history", [])
-        sentiment_tally = game_state.get("sentiment_tally", {})
-        
-        # Generate main traits from sentiment tally
-        main_traits = []
-        for tag, count in sentiment_tally.items():
-            if count > 0:
-                main_traits.append(tag)
-        
-        # Select top 3 traits if we have that many
-        top_traits = main_traits[:3] if len(main_traits) >= 3 else main_traits
-        traits_text = ", ".join(top_traits)
-        
-        # Create a personalized story description
-        personality = f"a {traits_text} adventurer" if traits_text else "an adventurer"
-        
-        # Generate image URL with enhanced prompt
-        base_prompt = node_details.get("prompt", "")
-        path_tuples = [(node, sentiment_tally.get(node, 0)) for node in path_node_ids]
-        choice_history = game_state.get("choice_history", [])
-        last_choice = choice_history[-1] if choice_history else None
-        
-        # Get dynamic seed
-        base_seed = node_details.get("seed", 12345)
-        dynamic_seed = get_dynamic_seed(base_seed, path_node_ids, session_id)
-        
-        # Generate enhanced prompt for manga-style image
-        enhanced_prompt = enhance_prompt(base_prompt, path_tuples, sentiment_tally, last_choice, session_id)
-        
-        # Create manga-style panel layout prompt
-        share_manga_prompt = f"Manga style, 4-panel comic strip telling the story of {personality} who achieved the '{ending_category}' ending with a score of {score}, {enhanced_prompt}, clean white background with title 'Mystic Forest Adventure' and score displayed"
-        
-        # URL encode the prompt
-        encoded_manga_prompt = requests.utils.quote(share_manga_prompt)
-        share_image_url = f"{POLLINATIONS_BASE_URL}{encoded_manga_prompt}"
-        
-        # Return the share image URL
-        return jsonify({
-            "share_image_url": share_image_url,
-            "score": score,
-            "ending_category": ending_category
-        })
+        details, error = share_image_details(game_state, session_data, session_id)
+        if error:
+            return jsonify({"error": error}), 400
+        return jsonify(details)
         
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/image/<key>', methods=['GET'])
+def get_proxied_image(key):
+    if not IMAGE_PROXY or len(key) != 64 or key.strip('0123456789abcdef'):
+        return jsonify({"error": "Image not found"}), 404
+
+    try:
+        data = image_cache.fetch(key)
+        if data is None:
+            return jsonify({"error": "Image not found"}), 404
+        if image_prefetcher is not None:
+            image_prefetcher.record_use(key)
+
+        response = app.response_class(data, mimetype=_sniff_image_type(data))
+        # The key names a fixed prompt, so the bytes never change for a given URL
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.set_etag(key)
+        return response.make_conditional(request)
+
+    except requests.RequestException as e:
+        logging.error(f"Error fetching image {key}: {str(e)}")
+        return jsonify({"error": "Image generator unavailable"}), 502
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/share-image/<name>', methods=['GET'])
+def get_share_image(name):
+    key, _, extension = name.partition('.')
+    if (SHARE_IMAGE_MODE != 'composite' or len(key) != 64 or key.strip('0123456789abcdef')
+            or extension not in ('png', 'webp')):
+        return jsonify({"error": "Image not found"}), 404
+
+    try:
+        data = share_images.render(name)
+        if data is None:
+            return jsonify({"error": "Image not found"}), 404
+
+        response = app.response_class(data, mimetype=f"image/{extension}")
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.set_etag(key)
+        return response.make_conditional(request)
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/save-to-blockchain', methods=['POST', 'OPTIONS'])
 def save_to_blockchain():
     if request.method == 'OPTIONS':
@@ -966,35 +3908,17 @@ def save_to_blockchain():
         if not all([wallet_address, game_data, signature, message]):
             return jsonify({"error": "Missing required fields"}), 400
 
+        # Reject forged or malformed saves before touching storage
+        error = signature_verifier.verify(wallet_address, message, signature)
+        if error:
+            return jsonify({"error": error}), 400
+
         # Create a blockchain record
-        blockchain_record = {
-            'walletAddress': wallet_address,
-            'gameData': game_data,
-            'signature': signature,
-            'message': message,
-            'timestamp': datetime.now().isoformat(),
-            'blockchainHash': hashlib.sha256(f"{wallet_address}{message}{signature}".encode()).hexdigest()
-        }
+        blockchain_record = create_blockchain_record(wallet_address, game_data, signature, message)
 
         # In a real implementation, you would save this to a blockchain
         # For now, we'll save it to a file-based storage
-        blockchain_file = f"/tmp/blockchain_{wallet_address}.json"
-        
-        # Load existing records
-        existing_records = []
-        if os.path.exists(blockchain_file):
-            try:
-                with open(blockchain_file, 'r') as f:
-                    existing_records = json.load(f)
-            except:
-                existing_records = []
-
-        # Add new record
-        existing_records.append(blockchain_record)
-
-        # Save back to file
-        with open(blockchain_file, 'w') as f:
-            json.dump(existing_records, f, indent=2)
+        store_blockchain_record(blockchain_record)
 
         logging.info(f"Saved blockchain record for wallet {wallet_address}")
 
@@ -1004,6 +3928,10 @@ def save_to_blockchain():
             "message": "Game data saved to blockchain successfully"
         })
 
+    except (BlockchainBusy, SignatureVerifierUnavailable) as e:
+        response = jsonify({"error": str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
@@ -1023,24 +3951,22 @@ def load_from_blockchain():
         if not wallet_address:
             return jsonify({"error": "Wallet address required"}), 400
 
-        blockchain_file = f"/tmp/blockchain_{wallet_address}.json"
-        
-        if not os.path.exists(blockchain_file):
-            return jsonify({"records": [], "message": "No blockchain records found"})
-
-        with open(blockchain_file, 'r') as f:
-            records = json.load(f)
-
-        # Return the most recent record
-        if records:
-            latest_record = max(records, key=lambda x: x.get('timestamp', ''))
-            return jsonify({
-                "records": records,
-                "latest": latest_record,
-                "message": f"Found {len(records)} blockchain records"
-            })
-        else:
-            return jsonify({"records": [], "message": "No blockchain records found"})
+        start, limit, error = blockchain_page_args(request.args.get('cursor'), request.args.get('limit'))
+        if error:
+            return jsonify({"error": error}), 400
+
+        # The summary alone answers a poll that has nothing new
+        summary = blockchain_log.summary(wallet_address)
+        etag = blockchain_etag(summary, start, limit)
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+
+        response = jsonify(blockchain_page(wallet_address, summary, start, limit))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
 
     except Exception as e:
         traceback.print_exc()
@@ -1060,17 +3986,48 @@ def get_wallet_balance():
         wallet_address = request.args.get('walletAddress')
         if not wallet_address:
             return jsonify({"error": "Wallet address required"}), 400
+        if WALLET_BALANCE_PROVIDER == 'rpc' and not valid_wallet_address(wallet_address):
+            return jsonify({"error": "Invalid wallet address"}), 400
 
-        # In a real implementation, you would query the blockchain
-        # For now, we'll return a mock balance
-        mock_balance = {
-            'balance': '1000.0',
-            'currency': 'PAS',
-            'walletAddress': wallet_address,
-            'network': 'Polkadot Hub Testnet'
-        }
+        return jsonify(wallet_balance(wallet_address))
+
+    except requests.RequestException as e:
+        logging.error(f"Error fetching balance for {wallet_address}: {str(e)}")
+        return jsonify({"error": "Balance service unavailable"}), 502
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
 
-        return jsonify(mock_balance)
+@app.route('/api/profiles/<name>', methods=['GET'])
+def get_profile(name):
+    if not profile_token_ok(request.headers.get('X-Profile')):
+        return jsonify({"error": "Not found"}), 404
+    if '/' in name or not name.endswith('.pstats'):
+        return jsonify({"error": "Not found"}), 404
+    try:
+        return send_from_directory(PROFILE_DIR, name, as_attachment=True)
+    except Exception:
+        return jsonify({"error": "Not found"}), 404
+
+# The scrape shows wallet, session and traffic volumes, so /api/metrics answers
+# 404 until METRICS_TOKEN is set and then requires it as a bearer token
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+def metrics_token_ok(authorization):
+    import hmac
+    return bool(METRICS_TOKEN) and hmac.compare_digest(authorization or '', f"Bearer {METRICS_TOKEN}")
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    if not METRICS_TOKEN or not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    if not metrics_token_ok(request.headers.get('Authorization')):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        write_metrics_snapshot()
+        body = render_prometheus(collect_worker_snapshots())
+        return app.response_class(body, mimetype='text/plain; version=0.0.4')
 
     except Exception as e:
         traceback.print_exc()
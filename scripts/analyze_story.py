@@ -0,0 +1,157 @@
+"""Offline analysis of the story graph: reachability, exact ending odds and a bulk simulation.
+
+Usage:
+    python scripts/analyze_story.py [--players 1000000] [--max-depth 32] [--seed 7]
+
+Paths are enumerated exactly (every player picks uniformly among the choices
+of each node), then the same policy is simulated for --players players at
+once with NumPy arrays of scores and tag counts. The simulated ending
+distribution should match the exact one to within sampling noise.
+"""
+import argparse
+import os
+import sys
+from collections import Counter, defaultdict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import index  # noqa: E402
+
+GENERIC_ENDINGS = ["generic_good_ending", "generic_neutral_ending", "generic_bad_ending"]
+
+
+def exact_distribution(graph, max_depth, ending_table):
+    """Probability of each generic ending and each end node under uniform random play"""
+    generic = Counter()
+    endings = Counter()
+    truncated = 0.0
+    paths = 0
+    for path in index.enumerate_story_paths(graph, max_depth):
+        paths += 1
+        probability = 1.0
+        for node, _ in path:
+            probability /= len(node.choices)
+        last_node, last_choice = path[-1]
+        if last_choice.next_index == index.CALCULATE_END_INDEX:
+            ending = ending_table[index.path_outcome(path)]
+            generic[ending] += probability
+            # The session hash picks each variant with equal probability
+            for variant in index.CUSTOM_ENDINGS[ending]:
+                endings[variant] += probability / len(index.CUSTOM_ENDINGS[ending])
+        elif graph.nodes[last_choice.next_index].is_end:
+            endings[graph.nodes[last_choice.next_index].id] += probability
+        else:
+            truncated += probability
+    return paths, generic, endings, truncated
+
+
+def reachability(graph, max_depth, ending_table):
+    reached = {"start"}
+    predecessors = defaultdict(set)
+    for path in index.enumerate_story_paths(graph, max_depth):
+        for node, choice in path:
+            reached.add(node.id)
+            if choice.next_index != index.CALCULATE_END_INDEX:
+                reached.add(choice.next_node)
+                predecessors[choice.next_node].add(node.id)
+    # Endings reached through _calculate_end
+    for ending in set(ending_table.values()):
+        reached.update(index.CUSTOM_ENDINGS[ending])
+    rejoins = {node_id: sorted(nodes) for node_id, nodes in predecessors.items() if len(nodes) > 1}
+    return reached, rejoins
+
+
+def simulate(graph, players, max_depth, seed):
+    """Play every player in lockstep; returns end-node counts and generic-ending counts"""
+    rng = np.random.default_rng(seed)
+    n_nodes = len(graph.nodes)
+    width = max(len(node.choices) for node in graph.nodes)
+    n_choices = np.array([len(node.choices) for node in graph.nodes], dtype=np.int64)
+    next_index = np.zeros((n_nodes, width), dtype=np.int64)
+    modifier = np.zeros((n_nodes, width), dtype=np.int64)
+    tag_index = np.zeros((n_nodes, width), dtype=np.int64)
+    # Choices without a tag count into one extra column that is neither positive nor negative
+    untagged = len(graph.tags)
+    for node in graph.nodes:
+        for choice in node.choices:
+            next_index[node.index, choice.index] = choice.next_index
+            modifier[node.index, choice.index] = choice.score_modifier
+            tag_index[node.index, choice.index] = graph.tag_index.get(choice.tag, untagged)
+    positive = np.array([tag in index.POSITIVE_TRAITS for tag in graph.tags] + [False])
+    negative = np.array([tag in index.NEGATIVE_TRAITS for tag in graph.tags] + [False])
+    node_by_id = {node.id: node.index for node in graph.nodes}
+    variants = np.array([[node_by_id[v] for v in index.CUSTOM_ENDINGS[g]] for g in GENERIC_ENDINGS])
+
+    current = np.full(players, graph.get("start").index, dtype=np.int64)
+    score = np.zeros(players, dtype=np.int64)
+    tags = np.zeros((players, len(graph.tags) + 1), dtype=np.int64)
+    generic = np.full(players, -1, dtype=np.int64)
+    active = np.ones(players, dtype=bool)
+
+    for _ in range(max_depth):
+        active &= n_choices[current] > 0
+        idx = np.nonzero(active)[0]
+        if idx.size == 0:
+            break
+        node = current[idx]
+        choice = (rng.random(idx.size) * n_choices[node]).astype(np.int64)
+        target = next_index[node, choice]
+
+        ending = target == index.CALCULATE_END_INDEX
+        if ending.any():
+            # Same rule as generic_ending_for, evaluated before the last choice is applied
+            e = idx[ending]
+            pos = tags[e][:, positive].sum(axis=1)
+            neg = tags[e][:, negative].sum(axis=1)
+            good = (score[e] >= 5) & (pos > neg)
+            bad = ~good & ((score[e] <= 0) | (neg > pos))
+            g = np.where(good, 0, np.where(bad, 2, 1))
+            generic[e] = g
+            target[ending] = variants[g, rng.integers(0, variants.shape[1], e.size)]
+
+        score[idx] += modifier[node, choice]
+        np.add.at(tags, (idx, tag_index[node, choice]), 1)
+        current[idx] = target
+
+    end_counts = np.bincount(current, minlength=n_nodes)
+    generic_counts = np.bincount(generic[generic >= 0], minlength=len(GENERIC_ENDINGS))
+    return end_counts, generic_counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=1_000_000)
+    parser.add_argument('--max-depth', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    graph = index.STORY_GRAPH
+    ending_table = index.build_ending_table(graph, args.max_depth)
+    paths, generic, endings, truncated = exact_distribution(graph, args.max_depth, ending_table)
+    reached, rejoins = reachability(graph, args.max_depth, ending_table)
+    unreachable = [node.id for node in graph.nodes if node.id not in reached]
+
+    print(f"Nodes: {len(graph.nodes)}  reachable: {len(reached)}  complete paths: {paths}")
+    # The generic_* endings only ever stand in for one of their CUSTOM_ENDINGS variants
+    print(f"Unreachable: {', '.join(unreachable) or 'none'}")
+    for node_id, sources in sorted(rejoins.items()):
+        print(f"Rejoin: {node_id} <- {', '.join(sources)}")
+    if truncated:
+        print(f"Probability mass cut off at depth {args.max_depth}: {truncated:.4%}")
+    print(f"Reachable (score, positive, negative) outcomes at _calculate_end: {len(ending_table)}")
+
+    end_counts, generic_counts = simulate(graph, args.players, args.max_depth, args.seed)
+    print(f"\n{'generic ending':<26} {'exact':>8} {'simulated':>10}")
+    for i, name in enumerate(GENERIC_ENDINGS):
+        print(f"{name:<26} {generic.get(name, 0):>8.2%} {generic_counts[i] / args.players:>10.2%}")
+    print(f"\n{'ending':<26} {'category':<18} {'exact':>8} {'simulated':>10}")
+    for node in graph.nodes:
+        if node.is_end and (endings.get(node.id) or end_counts[node.index]):
+            print(f"{node.id:<26} {node.ending_category:<18} {endings.get(node.id, 0):>8.2%} "
+                  f"{end_counts[node.index] / args.players:>10.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""Compare the Flask app under gunicorn with the ASGI app under uvicorn.
+
+Usage:
+    python scripts/bench_asgi.py [--clients 300] [--choices 3] [--workers 2]
+                                 [--threads 8] [--upstream-delay 1.0]
+
+Starts a stand-in image generator that answers every request after
+--upstream-delay seconds, then runs each server in turn with IMAGE_PROXY=1
+pointed at it, in fresh session and image-cache directories. Every simulated
+player resets a game, loads its image and makes a few random choices, loading
+each new image, all players at once. Prints throughput and latency
+percentiles per server. Needs the packages in requirements-asgi.txt.
+"""
+import argparse
+import asyncio
+import http.server
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class SlowImageHandler(http.server.BaseHTTPRequestHandler):
+    delay = 1.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = b'\xff\xd8\xff' + os.urandom(16 * 1024)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowImageServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_command(kind, port, args):
+    if kind == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', '--chdir', 'api', 'index:app',
+                '--workers', str(args.workers), '--threads', str(args.threads),
+                '--bind', f'127.0.0.1:{port}', '--timeout', '120', '--log-level', 'warning']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:app', '--app-dir', 'api',
+            '--workers', str(args.workers), '--port', str(port), '--log-level', 'warning']
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/api/state', timeout=2)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+async def play(client, rng, choices, latencies, errors):
+    async def timed(method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPError:
+            errors.append(url)
+            return None
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    response = await timed('POST', '/api/reset')
+    for _ in range(choices + 1):
+        if response is None:
+            return
+        state = response.json()
+        if state.get('image_url', '').startswith('/'):
+            await timed('GET', state['image_url'])
+        if state.get('is_end') or not state.get('choices'):
+            return
+        response = await timed('POST', '/api/choice', json={'choice_index': rng.randrange(len(state['choices']))})
+
+
+async def run_load(port, args):
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(args.upstream_delay * 20 + 30)
+    clients = [httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', limits=limits, timeout=timeout)
+               for _ in range(args.clients)]
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[play(client, random.Random(i), args.choices, latencies, errors)
+                               for i, client in enumerate(clients)])
+    finally:
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*[client.aclose() for client in clients])
+    return latencies, errors, elapsed
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench(kind, args, upstream):
+    workdir = tempfile.mkdtemp(prefix=f'bench_{kind}_')
+    port = free_port()
+    env = dict(os.environ, IMAGE_PROXY='1', IMAGE_UPSTREAM_BASE=upstream,
+               IMAGE_CACHE_DIR=os.path.join(workdir, 'images'), SESSION_DIR=workdir,
+               SESSION_DB_PATH=os.path.join(workdir, 'sessions.db'))
+    server = subprocess.Popen(server_command(kind, port, args), cwd=ROOT, env=env)
+    try:
+        wait_until_up(port)
+        latencies, errors, elapsed = asyncio.run(run_load(port, args))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{kind:<9} {len(latencies):>6} requests  {len(errors):>4} errors  {elapsed:6.1f}s  "
+          f"{len(latencies) / elapsed:7.1f} req/s  p50 {percentile(latencies, 0.5) * 1000:7.1f} ms  "
+          f"p95 {percentile(latencies, 0.95) * 1000:7.1f} ms  p99 {percentile(latencies, 0.99) * 1000:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=300, help='players running at once')
+    parser.add_argument('--choices', type=int, default=3, help='choices each player makes')
+    parser.add_argument('--workers', type=int, default=2, help='server worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gunicorn worker')
+    parser.add_argument('--upstream-delay', type=float, default=1.0, help='seconds the image server takes per image')
+    parser.add_argument('--servers', default='gunicorn,uvicorn', help='comma-separated servers to run')
+    args = parser.parse_args()
+
+    SlowImageHandler.delay = args.upstream_delay
+    image_server = SlowImageServer(('127.0.0.1', 0), SlowImageHandler)
+    threading.Thread(target=image_server.serve_forever, daemon=True).start()
+    upstream = f'http://127.0.0.1:{image_server.server_address[1]}/prompt/'
+
+    print(f"{args.clients} players, {args.choices} choices each, {args.workers} workers, "
+          f"image server delay {args.upstream_delay}s")
+    for kind in args.servers.split(','):
+        bench(kind.strip(), args, upstream)
+    image_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
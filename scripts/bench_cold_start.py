@@ -0,0 +1,116 @@
+"""Cold-start cost of the API: import time per module and time to first response.
+
+Usage:
+    python scripts/bench_cold_start.py [--runs 10] [--top 15] [--budget-ms 250]
+
+Every run starts a fresh interpreter that imports api/index.py, creates a
+Flask test client and sends GET /api/state, the same work a serverless cold
+start does before answering its first request. The report gives the median,
+min and max of the import time and of the time to first response (import
+plus request), followed by the modules that took longest to import
+according to `python -X importtime`.
+
+Runs use fresh session and blockchain directories and write no bytecode
+(PYTHONDONTWRITEBYTECODE=1), so api/index.py is compiled from source every
+time, as it is on a read-only serverless filesystem; delete a stale
+api/__pycache__ before comparing numbers. With --budget-ms the script exits
+with code 1 if the median time to first response is over budget.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, 'api')
+import index
+imported = time.perf_counter()
+response = index.app.test_client().get('/api/state')
+done = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import_ms': (imported - start) * 1000, 'first_response_ms': (done - start) * 1000}))
+"""
+
+
+def child_env(workdir):
+    return dict(os.environ,
+                SESSION_DIR=os.path.join(workdir, 'sessions'),
+                SESSION_DB_PATH=os.path.join(workdir, 'sessions.db'),
+                BLOCKCHAIN_DIR=os.path.join(workdir, 'blockchain'),
+                METRICS_DIR=os.path.join(workdir, 'metrics'),
+                PYTHONDONTWRITEBYTECODE='1')
+
+
+def cold_start(workdir):
+    result = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, env=child_env(workdir),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def import_profile(workdir):
+    """(cumulative_ms, self_ms, module) for index and everything it imports, from -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', "import sys; sys.path.insert(0, 'api'); import index"],
+                            cwd=ROOT, env=child_env(workdir), capture_output=True, text=True, check=True)
+    rows, block = [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        block.append((int(cumulative_us) / 1000, int(self_us) / 1000, module.rstrip()))
+        # A top-level import closes its block; keep only index's (site and friends are interpreter startup)
+        if not module.startswith('  '):
+            if module.strip() == 'index':
+                rows.extend(block)
+            block = []
+    return rows
+
+
+def spread(values):
+    return f"median {statistics.median(values):7.1f} ms  min {min(values):7.1f} ms  max {max(values):7.1f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters to time')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--budget-ms', type=float, help='fail if the median time to first response exceeds this')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='coldstart_')
+    try:
+        runs = [cold_start(workdir) for _ in range(args.runs)]
+        profile = import_profile(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import_ms = [run['import_ms'] for run in runs]
+    first_response_ms = [run['first_response_ms'] for run in runs]
+    print(f"{args.runs} cold starts")
+    print(f"  import index      {spread(import_ms)}")
+    print(f"  first response    {spread(first_response_ms)}")
+    print("\nSlowest imports (cumulative / self):")
+    for cumulative, own, module in sorted(profile, reverse=True)[:args.top]:
+        print(f"  {cumulative:8.1f} ms {own:8.1f} ms  {module}")
+
+    median = statistics.median(first_response_ms)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'runs': runs, 'median_first_response_ms': median,
+                       'imports': [{'module': m.strip(), 'cumulative_ms': c, 'self_ms': s} for c, s, m in profile]},
+                      f, indent=2)
+    if args.budget_ms is not None and median > args.budget_ms:
+        print(f"\nOVER BUDGET: median first response {median:.1f} ms > {args.budget_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Compare the compact session codec against pickle for size and speed.
+
+Usage:
+    python scripts/bench_session_codec.py [--sessions 1000] [--repeat 5]
+
+Sessions are built by random walks through story_nodes, so they have the same
+shape as the ones written by reset_game_state and make_choice.
+"""
+import argparse
+import os
+import pickle
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import index  # noqa: E402
+
+
+def random_session(rng):
+    state = {
+        "current_node_id": "start",
+        "path_history": ["start"],
+        "score": 0,
+        "sentiment_tally": {},
+        "choice_history": [],
+        "created_at": time.time()
+    }
+    node_id = "start"
+    while True:
+        choices = index.story_nodes[node_id].get("choices", [])
+        if not choices:
+            break
+        choice_index = rng.randrange(len(choices))
+        choice = choices[choice_index]
+        state["choice_history"].append({
+            "from_node": node_id,
+            "choice_index": choice_index,
+            "choice_text": choice.get("text", ""),
+            "tag": choice.get("tag")
+        })
+        state["score"] += choice.get("score_modifier", 0)
+        state["sentiment_tally"][choice["tag"]] = state["sentiment_tally"].get(choice["tag"], 0) + 1
+        node_id = choice["next_node"]
+        if node_id == "_calculate_end":
+            node_id = rng.choice(["heroic_savior_ending", "peaceful_traveler_ending", "lost_soul_ending"])
+        state["path_history"].append(node_id)
+        state["current_node_id"] = node_id
+    return {
+        'style_preferences': rng.sample(["fantasy", "medieval", "ethereal", "mystical", "dramatic"], 3),
+        'personality_traits': rng.sample(["cautious", "bold", "diplomatic", "direct", "curious"], 3),
+        'state': state
+    }
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sessions = [random_session(rng) for _ in range(args.sessions)]
+    pickled = [pickle.dumps(s) for s in sessions]
+    encoded = [index.encode_session(s) for s in sessions]
+    assert all(index.decode_session(b) == s for b, s in zip(encoded, sessions))
+
+    results = {
+        'pickle': (
+            sum(map(len, pickled)),
+            best_of(args.repeat, lambda: [pickle.dumps(s) for s in sessions]),
+            best_of(args.repeat, lambda: [pickle.loads(b) for b in pickled]),
+        ),
+        'codec': (
+            sum(map(len, encoded)),
+            best_of(args.repeat, lambda: [index.encode_session(s) for s in sessions]),
+            best_of(args.repeat, lambda: [index.decode_session(b) for b in encoded]),
+        ),
+    }
+
+    n = len(sessions)
+    print(f"{'format':<8} {'avg bytes':>10} {'encode us':>10} {'decode us':>10}")
+    for name, (size, encode_time, decode_time) in results.items():
+        print(f"{name:<8} {size / n:>10.1f} {encode_time / n * 1e6:>10.2f} {decode_time / n * 1e6:>10.2f}")
+    print(f"size ratio pickle/codec: {results['pickle'][0] / results['codec'][0]:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
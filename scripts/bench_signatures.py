@@ -0,0 +1,78 @@
+"""Throughput of save-to-blockchain signature verification, per core and cached.
+
+Usage:
+    python scripts/bench_signatures.py [--signatures 2000] [--workers 1,2,4]
+
+Signs --signatures distinct messages with throwaway keys, then measures EIP-191
+signer recovery inline in one process, through process pools of each size in
+--workers, and again through SignatureVerifier once every triple is cached.
+Needs the optional eth_account package.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import index  # noqa: E402
+
+
+def make_signed(count):
+    from eth_account import Account
+    from eth_account.messages import encode_defunct
+    accounts = [Account.create() for _ in range(min(count, 50))]
+    signed = []
+    for i in range(count):
+        account = accounts[i % len(accounts)]
+        message = f"Mystic Forest Adventure - Score: {i % 12}, Ending: Forest Guardian, Timestamp: {i}"
+        signature = Account.sign_message(encode_defunct(text=message), account.key).signature.hex()
+        if not signature.startswith('0x'):
+            signature = '0x' + signature
+        signed.append((account.address, message, signature))
+    return signed
+
+
+def report(label, count, elapsed, cores):
+    rate = count / elapsed
+    print(f"{label:<24} {rate:10.0f} verifications/s  {rate / cores:10.0f} per core")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--signatures', type=int, default=2000)
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated process pool sizes')
+    args = parser.parse_args()
+
+    try:
+        signed = make_signed(args.signatures)
+    except ImportError:
+        sys.exit("eth_account is not installed (pip install eth-account)")
+    wallets, messages, signatures = zip(*signed)
+
+    start = time.perf_counter()
+    assert all(index.signature_matches(*triple) for triple in signed)
+    report("inline", len(signed), time.perf_counter() - start, 1)
+
+    for workers in (int(w) for w in args.workers.split(',')):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(index.signature_matches, wallets[:workers], messages[:workers], signatures[:workers]))
+            start = time.perf_counter()
+            results = list(pool.map(index.signature_matches, wallets, messages, signatures, chunksize=16))
+            elapsed = time.perf_counter() - start
+        assert all(results)
+        report(f"pool of {workers}", len(signed), elapsed, workers)
+
+    verifier = index.SignatureVerifier(mode='eip191', workers=max(int(w) for w in args.workers.split(',')))
+    for future in [verifier.submit(*triple) for triple in signed]:
+        future.result()
+    start = time.perf_counter()
+    for triple in signed:
+        assert verifier.verify(*triple) is None
+    report("cached", len(signed), time.perf_counter() - start, 1)
+    verifier.pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Micro-benchmark of /api/state serialization: jsonify vs pre-serialized fragments.
+
+Usage:
+    python scripts/bench_state_payload.py [--iterations 20000]
+
+Only the response body is measured; session lookup and prompt building are
+left out so the numbers isolate the JSON cost per request.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from flask import jsonify  # noqa: E402
+
+import index  # noqa: E402
+
+IMAGE_URL = index.POLLINATIONS_BASE_URL + "Fantasy%20forest%20with%20two%20paths%2C%20detailed%2C%20fantasy%20style"
+
+
+def with_jsonify(node, score):
+    return jsonify({
+        "current_node": node.payload,
+        "score": score,
+        "image_url": IMAGE_URL,
+        "is_end": node.is_end,
+        "choices": node.payload.get("choices", []),
+        "situation": node.situation
+    }).get_data()
+
+
+def with_fragments(node, score):
+    return index.render_state(node, score, IMAGE_URL).get_data()
+
+
+def measure(fn, nodes, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(nodes[i % len(nodes)], i % 7)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    nodes = index.STORY_GRAPH.nodes
+    with index.app.app_context():
+        # Checking equivalence also warms the fragment cache, so the timing reflects steady state
+        for node in nodes:
+            assert with_jsonify(node, 3) == with_fragments(node, 3), node.id
+        baseline = measure(with_jsonify, nodes, args.iterations)
+        spliced = measure(with_fragments, nodes, args.iterations)
+
+    print(f"jsonify:    {baseline * 1e6:8.2f} us/request")
+    print(f"fragments:  {spliced * 1e6:8.2f} us/request")
+    print(f"speedup:    {baseline / spliced:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Build fingerprinted, precompressed copies of the frontend for the Flask server.
+
+Usage:
+    python scripts/build_assets.py [--source public] [--output build/public]
+
+Copies every file in --source to --output. Scripts, stylesheets and other
+assets get a content hash in their name (script.js -> script.1a2b3c4d5e.js),
+and HTML files are rewritten to reference the hashed names. Text files also
+get .gz and (if the brotli package is installed) .br variants when those are
+smaller. manifest.json maps each original name to its output file, encodings
+and SHA-256; api/index.py loads it on the first static request. Point
+ASSET_BUILD_DIR at --output if you move it.
+
+Run it again after every frontend change. The output directory is replaced,
+so stale fingerprints never linger.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# src="..." / href="..." attributes in HTML; absolute URLs never match a manifest name
+REFERENCE = re.compile(r'''((?:src|href)=["'])(/?)([^"'?#]+)''')
+
+
+def fingerprinted(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def compress(data):
+    """{encoding: bytes} for the variants that come out smaller than data"""
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        variants['br'] = brotli.compress(data, quality=11)
+    except ImportError:
+        pass
+    return {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+
+
+def rewrite_references(html, renamed):
+    def replace(match):
+        prefix, slash, target = match.groups()
+        return prefix + slash + renamed.get(target, target)
+    return REFERENCE.sub(replace, html)
+
+
+def build(source, output):
+    names = []
+    for root, _, files in os.walk(source):
+        for file_name in files:
+            names.append(os.path.relpath(os.path.join(root, file_name), source).replace(os.sep, '/'))
+    contents = {}
+    for name in names:
+        with open(os.path.join(source, name), 'rb') as f:
+            contents[name] = f.read()
+
+    # Assets are hashed first so the HTML that references them can be rewritten, then hashed itself
+    renamed = {name: fingerprinted(name, data) for name, data in contents.items() if not name.endswith('.html')}
+    for name in names:
+        if name.endswith('.html'):
+            contents[name] = rewrite_references(contents[name].decode('utf-8'), renamed).encode('utf-8')
+
+    shutil.rmtree(output, ignore_errors=True)
+    manifest = {'files': {}}
+    for name in sorted(names):
+        data = contents[name]
+        file_name = renamed.get(name, name)
+        entry = {'file': file_name, 'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data), 'encodings': {}}
+        outputs = {file_name: data}
+        content_type = mimetypes.guess_type(name)[0] or ''
+        if content_type.startswith(COMPRESSIBLE_TYPES):
+            for encoding, body in compress(data).items():
+                suffix = '.br' if encoding == 'br' else '.gz'
+                entry['encodings'][encoding] = file_name + suffix
+                outputs[file_name + suffix] = body
+        for path, body in outputs.items():
+            os.makedirs(os.path.dirname(os.path.join(output, path)), exist_ok=True)
+            with open(os.path.join(output, path), 'wb') as f:
+                f.write(body)
+        manifest['files'][name] = entry
+        sizes = '  '.join(f"{encoding} {len(outputs[path])}" for encoding, path in entry['encodings'].items())
+        print(f"{name:<20} -> {file_name:<28} {len(data):>8} bytes  {sizes}")
+
+    with open(os.path.join(output, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source', default=os.path.join(ROOT, 'public'), help='frontend directory')
+    parser.add_argument('--output', default=os.path.join(ROOT, 'build', 'public'), help='build directory')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        sys.exit(f"{args.source} is not a directory")
+    if os.path.realpath(args.output) == os.path.realpath(args.source):
+        sys.exit("--output must differ from --source, it is replaced on every build")
+    build(args.source, args.output)
+    print(f"Wrote {os.path.join(args.output, 'manifest.json')}")
+
+
+if __name__ == '__main__':
+    main()
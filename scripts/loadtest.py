@@ -0,0 +1,239 @@
+"""Load test for the game API: concurrent players walking the story to an ending.
+
+Usage:
+    python scripts/loadtest.py [--mode inprocess|gunicorn] [--players 20]
+                               [--games 5] [--seed 1] [--output results.json]
+                               [--baseline baseline.json] [--threshold 0.2]
+
+Each player keeps its own session_id cookie. It loads /api/state, makes random
+choices until it reaches an ending, then calls /api/reset, --games times over.
+The seed fixes every player's walk, so runs with the same arguments replay the
+same requests.
+
+--mode inprocess drives the Flask app through its test client from one thread
+per player. --mode gunicorn starts `gunicorn --chdir api index:app` on a free
+local port (or uses --url if given) and sends real HTTP requests. Both modes
+run against fresh session and blockchain directories.
+
+The report gives throughput and p50/p95/p99 latency per endpoint. --output
+saves it as JSON. With --baseline, the run fails (exit code 1) if any
+endpoint's p95 grows, or its throughput drops, by more than --threshold
+(0.2 = 20%) compared with the saved results.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ENDPOINTS = ('state', 'choice', 'reset')
+
+
+class InProcessClient:
+    """One player's connection through the Flask test client"""
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_json(silent=True)
+
+    def post(self, path, body=None):
+        response = self.client.post(path, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpClient:
+    """One player's connection to a running server, with its own cookie jar"""
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path):
+        response = self.session.get(self.base_url + path, timeout=30)
+        return response.status_code, response.json() if response.content else None
+
+    def post(self, path, body=None):
+        response = self.session.post(self.base_url + path, json=body, timeout=30)
+        return response.status_code, response.json() if response.content else None
+
+
+def play(client, rng, games, results, errors):
+    """Play games to their endings, recording (endpoint, seconds) pairs"""
+    def timed(endpoint, call, *args):
+        start = time.perf_counter()
+        try:
+            status, body = call(*args)
+        except Exception:
+            status, body = None, None
+        results.append((endpoint, time.perf_counter() - start))
+        if status != 200:
+            errors.append((endpoint, status))
+            return None
+        return body
+
+    state = timed('state', client.get, '/api/state')
+    for _ in range(games):
+        steps = 0
+        while state is not None and state.get('choices') and not state.get('is_end') and steps < 64:
+            state = timed('choice', client.post, '/api/choice', {'choice_index': rng.randrange(len(state['choices']))})
+            steps += 1
+        state = timed('reset', client.post, '/api/reset')
+        if state is None:
+            return
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(results, errors, elapsed):
+    report = {'elapsed_seconds': elapsed, 'requests': len(results), 'errors': len(errors), 'endpoints': {}}
+    for endpoint in ENDPOINTS:
+        latencies = [seconds for name, seconds in results if name == endpoint]
+        if not latencies:
+            continue
+        report['endpoints'][endpoint] = {
+            'requests': len(latencies),
+            'errors': sum(1 for name, _ in errors if name == endpoint),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    return report
+
+
+def run_players(make_client, args):
+    results, errors = [], []
+    threads = [threading.Thread(target=play, args=(make_client(), random.Random(args.seed * 100003 + i),
+                                                   args.games, results, errors))
+               for i in range(args.players)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(results, errors, time.perf_counter() - start)
+
+
+def isolated_env(workdir):
+    return {'SESSION_DIR': os.path.join(workdir, 'sessions'),
+            'SESSION_DB_PATH': os.path.join(workdir, 'sessions.db'),
+            'BLOCKCHAIN_DIR': os.path.join(workdir, 'blockchain'),
+            'METRICS_DIR': os.path.join(workdir, 'metrics'),
+            'SESSION_SWEEP_INTERVAL': '0'}
+
+
+def run_inprocess(args, workdir):
+    os.environ.update(isolated_env(workdir))
+    sys.path.insert(0, os.path.join(ROOT, 'api'))
+    import index
+    return run_players(lambda: InProcessClient(index.app), args)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run_gunicorn(args, workdir):
+    import requests
+    if args.url:
+        return run_players(lambda: HttpClient(args.url.rstrip('/')), args)
+
+    port = free_port()
+    env = dict(os.environ, **isolated_env(workdir))
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--chdir', 'api', 'index:app',
+                               '--workers', str(args.workers), '--threads', str(args.threads),
+                               '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'], cwd=ROOT, env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                requests.get(base_url + '/api/state', timeout=2)
+                break
+            except requests.RequestException:
+                if time.time() > deadline:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.2)
+        return run_players(lambda: HttpClient(base_url), args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def regressions(report, baseline, threshold):
+    """Endpoints whose p95 or throughput is more than threshold worse than the baseline"""
+    found = []
+    for endpoint, before in baseline.get('endpoints', {}).items():
+        after = report['endpoints'].get(endpoint)
+        if after is None:
+            continue
+        if after['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            found.append(f"{endpoint}: p95 {before['p95_ms']:.2f} ms -> {after['p95_ms']:.2f} ms")
+        if after['throughput'] < before['throughput'] * (1 - threshold):
+            found.append(f"{endpoint}: throughput {before['throughput']:.1f} -> {after['throughput']:.1f} req/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('inprocess', 'gunicorn'), default='inprocess')
+    parser.add_argument('--players', type=int, default=20, help='concurrent players')
+    parser.add_argument('--games', type=int, default=5, help='games each player finishes')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the players\' choices')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--url', help='test this running server instead of starting gunicorn')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression, 0.2 = 20%%')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    try:
+        if args.mode == 'inprocess':
+            report = run_inprocess(args, workdir)
+        else:
+            report = run_gunicorn(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report['config'] = {key: getattr(args, key) for key in ('mode', 'players', 'games', 'seed', 'workers', 'threads')}
+
+    print(f"{args.mode}: {args.players} players x {args.games} games, {report['requests']} requests, "
+          f"{report['errors']} errors in {report['elapsed_seconds']:.2f}s")
+    for endpoint, stats in report['endpoints'].items():
+        print(f"  {endpoint:<7} {stats['requests']:>6} req  {stats['throughput']:8.1f} req/s  "
+              f"p50 {stats['p50_ms']:7.2f} ms  p95 {stats['p95_ms']:7.2f} ms  p99 {stats['p99_ms']:7.2f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = report['errors'] > 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config', {}).get('mode') not in (None, args.mode):
+            print(f"Warning: baseline was recorded in {baseline['config']['mode']} mode")
+        found = regressions(report, baseline, args.threshold)
+        for line in found:
+            print(f"REGRESSION {line}")
+        failed = failed or bool(found)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Migrate stored sessions, re-encoding legacy pickles in the compact format.
+
+Usage:
+    python scripts/migrate_sessions.py [--source-dir /tmp] [--db /tmp/sessions.db]
+    python scripts/migrate_sessions.py --source-dir /tmp --in-place
+
+The first form copies per-player session_<id>.pkl files into the SQLite store;
+afterwards start the app with SESSION_STORE=sqlite (and the same SESSION_DB_PATH).
+The second rewrites the file store where it is. Either way no pickles are left
+behind, so the app can run with SESSION_LEGACY_PICKLE=0 (the default).
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+from index import FileSessionStore, SQLiteSessionStore, migrate_sessions  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--source-dir', default='/tmp', help='SESSION_DIR of the file store to copy from')
+    parser.add_argument('--db', default='/tmp/sessions.db', help='SQLite database to migrate into')
+    parser.add_argument('--in-place', action='store_true', help='re-encode the file store instead of copying it')
+    parser.add_argument('--delete', action='store_true', help='remove the .pkl files once copied')
+    args = parser.parse_args()
+
+    source = FileSessionStore(args.source_dir)
+    if args.in_place:
+        migrated = migrate_sessions(source, source)
+        print(f"Re-encoded {migrated} sessions in {args.source_dir}")
+        return
+    destination = SQLiteSessionStore(args.db)
+    migrated = migrate_sessions(source, destination)
+    if args.delete:
+        for session_id in list(source.iter_ids()):
+            if destination.load(session_id) is not None:
+                source.delete(session_id)
+    print(f"Migrated {migrated} sessions from {args.source_dir} into {args.db}")
+
+
+if __name__ == '__main__':
+    main()
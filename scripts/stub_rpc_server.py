@@ -0,0 +1,69 @@
+"""Local stand-in for the chain's JSON-RPC endpoint, for exercising wallet balances.
+
+Usage:
+    python scripts/stub_rpc_server.py [--port 8545] [--delay 0.5] [--failure-rate 0.2]
+
+Answers eth_getBalance with a balance derived from the address, after --delay
+seconds; a --failure-rate fraction of calls get an HTTP 503 instead. Point the
+app at it with:
+
+    WALLET_BALANCE_PROVIDER=rpc WALLET_RPC_URL=http://127.0.0.1:8545 \\
+        python -m flask --app api/index.py run
+
+Every call is logged, so single-flight and caching can be checked by counting
+upstream requests.
+"""
+import argparse
+import hashlib
+import http.server
+import json
+import random
+import time
+
+
+class RpcHandler(http.server.BaseHTTPRequestHandler):
+    delay = 0.0
+    failure_rate = 0.0
+    calls = 0
+
+    def do_POST(self):
+        RpcHandler.calls += 1
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        time.sleep(self.delay)
+        if random.random() < self.failure_rate:
+            self.send_error(503)
+            return
+        if body.get('method') == 'eth_getBalance':
+            address = body['params'][0].lower()
+            wei = int(hashlib.sha256(address.encode()).hexdigest()[:12], 16) * 10 ** 6
+            reply = {'jsonrpc': '2.0', 'id': body.get('id'), 'result': hex(wei)}
+        else:
+            reply = {'jsonrpc': '2.0', 'id': body.get('id'),
+                     'error': {'code': -32601, 'message': 'Method not found'}}
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(f"call {RpcHandler.calls}: {format % args}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds before each reply')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of calls answered with 503')
+    args = parser.parse_args()
+
+    RpcHandler.delay = args.delay
+    RpcHandler.failure_rate = args.failure_rate
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), RpcHandler)
+    print(f"Stand-in RPC listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# index.py reads its configuration at import, so point every on-disk store at a
+# scratch directory before any test imports it
+_SCRATCH = tempfile.mkdtemp(prefix='forest-tests-')
+for _name, _subdir in (('SESSION_DIR', 'sessions'), ('SESSION_DB_PATH', 'sessions.db'),
+                       ('IMAGE_CACHE_DIR', 'images'), ('SHARE_CACHE_DIR', 'share'),
+                       ('BLOCKCHAIN_DIR', 'blockchain'), ('METRICS_DIR', 'metrics'),
+                       ('PROFILE_DIR', 'profiles')):
+    os.environ.setdefault(_name, os.path.join(_SCRATCH, _subdir))
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
@@ -0,0 +1,31 @@
+"""The offline story analyzer handles every graph compile_story accepts."""
+import copy
+import os
+import sys
+
+import pytest
+
+import index
+
+pytest.importorskip('numpy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import analyze_story  # noqa: E402
+
+
+def test_simulation_matches_exact_odds_with_an_untagged_choice():
+    nodes = copy.deepcopy(index.story_nodes)
+    del nodes['start']['choices'][0]['tag']
+    graph = index.compile_story(nodes)
+    table = index.build_ending_table(graph)
+
+    _, generic, _, truncated = analyze_story.exact_distribution(graph, 32, table)
+    _, generic_counts = analyze_story.simulate(graph, 200_000, 32, seed=1)
+
+    assert truncated == 0
+    for i, name in enumerate(analyze_story.GENERIC_ENDINGS):
+        assert generic_counts[i] / 200_000 == pytest.approx(generic.get(name, 0), abs=0.01)
+
+
+def test_calculated_endings_follow_the_rule():
+    for (score, positive, negative), ending in index.build_ending_table().items():
+        assert ending == index.generic_ending_for(score, positive, negative)
@@ -0,0 +1,146 @@
+"""BalanceCache single-flight, stale-while-revalidate and failure handling against a stand-in RPC."""
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+import index
+
+WALLET = '0x' + '1f' * 20
+
+
+class StandInRpcServer:
+    """Answers eth_getBalance with self.wei, or 503 while self.failing, counting calls.
+
+    Replies wait for self.release, so a test can hold an upstream call open.
+    """
+    def __init__(self):
+        self.wei = 5 * 10 ** 18
+        self.failing = False
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server.calls += 1
+                server.release.wait(5)
+                if server.failing:
+                    self.send_error(503)
+                    return
+                data = json.dumps({'jsonrpc': '2.0', 'id': body['id'], 'result': hex(server.wei)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def wait_for_calls(self, count):
+        deadline = time.monotonic() + 5
+        while self.calls < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return self.calls
+
+    def close(self):
+        self.release.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def rpc():
+    server = StandInRpcServer()
+    yield server
+    server.close()
+
+
+def make_cache(rpc, ttl=60, stale=60):
+    return index.BalanceCache(index.RpcBalanceProvider(url=rpc.url, timeout=5), ttl=ttl, stale=stale)
+
+
+def test_concurrent_misses_share_one_upstream_call(rpc):
+    cache = make_cache(rpc)
+    rpc.release.clear()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(WALLET))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    rpc.wait_for_calls(1)
+    time.sleep(0.05)
+    rpc.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ['5.0'] * 8
+    assert rpc.calls == 1
+    assert cache.stats()['upstream_calls'] == 1
+    assert cache.get(WALLET) == '5.0' and rpc.calls == 1  # now a fresh hit
+
+
+def test_stale_entry_is_served_while_one_refresh_runs(rpc):
+    cache = make_cache(rpc, ttl=0.05)
+    assert cache.get(WALLET) == '5.0'
+    time.sleep(0.1)
+    rpc.wei = 7 * 10 ** 18
+    rpc.release.clear()
+
+    start = time.monotonic()
+    assert [cache.get(WALLET) for _ in range(5)] == ['5.0'] * 5
+    assert time.monotonic() - start < 1  # none of them waited for the upstream
+    assert rpc.wait_for_calls(2) == 2
+    assert cache.stats()['stale_hits'] == 5
+
+    rpc.release.set()
+    deadline = time.monotonic() + 5
+    while cache.stats()['inflight'] and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert cache.entries.get(WALLET)[0] == '7.0'
+    assert rpc.calls == 2
+
+
+@pytest.fixture
+def client(rpc, monkeypatch):
+    monkeypatch.setattr(index, 'WALLET_BALANCE_PROVIDER', 'rpc')
+    monkeypatch.setattr(index, 'balance_cache', make_cache(rpc, ttl=0.05))
+    return index.app.test_client()
+
+
+def balance(client):
+    return client.get('/api/wallet-balance', query_string={'walletAddress': WALLET})
+
+
+def test_failure_with_nothing_cached_is_a_bad_gateway(client, rpc):
+    rpc.failing = True
+
+    response = balance(client)
+    assert response.status_code == 502
+    assert response.get_json() == {"error": "Balance service unavailable"}
+
+
+def test_failure_with_a_cached_balance_serves_it(client, rpc):
+    assert balance(client).get_json()['balance'] == '5.0'
+    time.sleep(0.1)
+    rpc.failing = True
+
+    for _ in range(3):
+        response = balance(client)
+        assert response.status_code == 200
+        assert response.get_json()['balance'] == '5.0'
+    rpc.wait_for_calls(2)
+    deadline = time.monotonic() + 5
+    while index.balance_cache.stats()['errors'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert balance(client).get_json()['balance'] == '5.0'
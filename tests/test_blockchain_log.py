@@ -0,0 +1,97 @@
+"""BlockchainLog crash repair, legacy import and the paged load-from-blockchain endpoint."""
+import json
+
+import pytest
+
+import index
+
+
+def record(wallet, message):
+    return index.create_blockchain_record(wallet, {'score': 1}, '0x' + 'ab' * 65, message)
+
+
+@pytest.fixture
+def log(tmp_path):
+    return index.BlockchainLog(directory=str(tmp_path / 'logs'), legacy_directory=str(tmp_path))
+
+
+def test_torn_tail_is_dropped(log):
+    log.append('0xaaa', [record('0xaaa', 'one'), record('0xaaa', 'two')])
+    log_path, _ = log._paths('0xaaa')
+    with open(log_path, 'ab') as f:
+        f.write(b'{"message":"thr')  # The process died mid-write
+
+    assert log.append('0xaaa', [record('0xaaa', 'three')]) == 3
+    assert [r['message'] for r in log.read('0xaaa')] == ['one', 'two', 'three']
+
+
+def test_index_is_rebuilt_from_the_log(log):
+    log.append('0xaaa', [record('0xaaa', f'game {i}') for i in range(5)])
+    _, idx_path = log._paths('0xaaa')
+    with open(idx_path, 'r+b') as f:
+        f.truncate(2 * log.OFFSET.size + 3)  # Lost the last offsets, and half of one
+
+    assert log.append('0xaaa', [record('0xaaa', 'game 5')]) == 6
+    assert [r['message'] for r in log.read('0xaaa')] == [f'game {i}' for i in range(6)]
+    assert [r['message'] for r in log.read('0xaaa', 2, 4)] == ['game 2', 'game 3']
+
+
+def test_legacy_file_is_imported_once(log, tmp_path):
+    legacy = [record('0xbbb', 'old one'), record('0xbbb', 'old two')]
+    legacy_path = tmp_path / 'blockchain_0xbbb.json'
+    legacy_path.write_text(json.dumps(legacy))
+
+    assert log.count('0xbbb') == 2
+    assert log.summary('0xbbb')['count'] == 2
+    assert log.read('0xbbb') == legacy
+    assert not legacy_path.exists()
+    assert (tmp_path / 'blockchain_0xbbb.json.migrated').exists()
+    assert log.append('0xbbb', [legacy[0], record('0xbbb', 'new')]) == 3
+
+
+def test_legacy_lookup_ignores_path_like_wallets(log):
+    assert log._legacy_path('../etc') is None
+    assert log.count('../etc') == 0
+
+
+@pytest.fixture
+def client(log, monkeypatch):
+    monkeypatch.setattr(index, 'blockchain_log', log)
+    log.append('0xccc', [record('0xccc', f'game {i}') for i in range(5)])
+    return index.app.test_client()
+
+
+def test_pages_follow_next_cursor(client):
+    messages, cursor = [], None
+    while True:
+        query = {'walletAddress': '0xccc', 'limit': 2}
+        if cursor is not None:
+            query['cursor'] = cursor
+        body = client.get('/api/load-from-blockchain', query_string=query).get_json()
+        assert body['count'] == 5
+        messages += [r['message'] for r in body['records']]
+        cursor = body['next_cursor']
+        if cursor is None:
+            break
+    assert messages == [f'game {i}' for i in range(5)]
+
+
+@pytest.mark.parametrize('query', [{'cursor': 'x'}, {'limit': '0'}, {'cursor': '-1'}])
+def test_bad_page_arguments_are_rejected(client, query):
+    response = client.get('/api/load-from-blockchain', query_string=dict(query, walletAddress='0xccc'))
+    assert response.status_code == 400
+
+
+def test_unchanged_page_is_not_modified(client, log):
+    query = {'walletAddress': '0xccc', 'limit': 2}
+    first = client.get('/api/load-from-blockchain', query_string=query)
+    etag = first.headers['ETag']
+
+    again = client.get('/api/load-from-blockchain', query_string=query, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.headers['ETag'] == etag
+
+    log.append('0xccc', [record('0xccc', 'game 5')])
+    changed = client.get('/api/load-from-blockchain', query_string=query, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.get_json()['count'] == 6
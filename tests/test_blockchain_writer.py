@@ -0,0 +1,87 @@
+"""Group-commit writer survives cancelled saves, and repeated saves are deduplicated."""
+import threading
+
+import index
+
+
+def record(wallet, message):
+    return index.create_blockchain_record(wallet, {'score': 1}, '0x' + 'ab' * 65, message)
+
+
+class SlowLog:
+    """Wraps a BlockchainLog so a test can hold the writer inside a commit"""
+    def __init__(self, log):
+        self.log = log
+        self.release = threading.Event()
+
+    def append(self, wallet_address, records):
+        self.release.wait(5)
+        return self.log.append(wallet_address, records)
+
+
+def test_cancelled_save_does_not_stop_the_writer(tmp_path):
+    log = SlowLog(index.BlockchainLog(directory=str(tmp_path), legacy_directory=str(tmp_path)))
+    writer = index.BlockchainWriter(log)
+    try:
+        blocking = writer.submit(record('0xaaa', 'first'))
+        cancelled = writer.submit(record('0xaaa', 'second'))
+        assert cancelled.cancel()
+        log.release.set()
+
+        assert blocking.result(timeout=5) is True
+        assert writer.submit(record('0xaaa', 'third')).result(timeout=5) is True
+        assert writer.thread.is_alive()
+        messages = [r['message'] for r in log.log.read('0xaaa')]
+        assert messages == ['first', 'third']
+    finally:
+        writer.shutdown()
+
+
+def test_failed_batch_does_not_stop_the_writer(tmp_path):
+    log = index.BlockchainLog(directory=str(tmp_path), legacy_directory=str(tmp_path))
+    writer = index.BlockchainWriter(log)
+    try:
+        bad = writer.submit(None)  # Not a record at all: _commit itself raises
+        assert bad.exception(timeout=5) is not None
+        assert writer.submit(record('0xbbb', 'after')).result(timeout=5) is True
+        assert writer.thread.is_alive()
+    finally:
+        writer.shutdown()
+
+
+def test_retried_save_is_not_duplicated(tmp_path):
+    log = index.BlockchainLog(directory=str(tmp_path), legacy_directory=str(tmp_path))
+    saved = record('0xccc', 'game over')
+    retried = dict(saved, timestamp='later')  # Same signed message, so the same blockchainHash
+
+    assert log.append('0xccc', [saved]) == 1
+    assert log.append('0xccc', [retried, record('0xccc', 'next game')]) == 2
+    assert [r['message'] for r in log.read('0xccc')] == ['game over', 'next game']
+    assert log.summary('0xccc')['count'] == 2
+
+
+class CountingLog(index.BlockchainLog):
+    """Counts the digest bytes read back from the .hashes file"""
+    hash_bytes_read = 0
+
+    def _read_hashes(self, wallet_address, start):
+        data = super()._read_hashes(wallet_address, start)
+        self.hash_bytes_read += len(data)
+        return data
+
+
+def test_retried_save_does_not_rescan_the_history(tmp_path):
+    log = CountingLog(directory=str(tmp_path), legacy_directory=str(tmp_path))
+    other_worker = index.BlockchainLog(directory=str(tmp_path), legacy_directory=str(tmp_path))
+    history = [record('0xddd', f'game {i}') for i in range(50)]
+    log.append('0xddd', history)
+    log.hash_bytes_read = 0
+
+    assert log.append('0xddd', [dict(history[10], timestamp='retry')]) == 50
+    assert log.hash_bytes_read == 0
+
+    # Another worker's append is picked up from the tail of the .hashes file only
+    other_worker.append('0xddd', [record('0xddd', 'elsewhere')])
+    assert log.append('0xddd', [record('0xddd', 'elsewhere')]) == 51
+    assert log.hash_bytes_read == 32
+    assert len(log.read('0xddd')) == 51
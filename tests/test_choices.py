@@ -0,0 +1,71 @@
+"""/api/choices replays a batch of choices all-or-nothing."""
+import pytest
+
+import index
+
+
+@pytest.fixture
+def client():
+    client = index.app.test_client()
+    assert client.get('/api/state').status_code == 200
+    return client
+
+
+def stored_state(client):
+    session_id = client.get_cookie('session_id').value
+    return index.get_user_session(session_id)['state']
+
+
+@pytest.mark.parametrize('body', [[0, 1], 3, "choices"])
+def test_body_that_is_not_an_object_is_rejected(client, body):
+    for path in ('/api/choices', '/api/choice'):
+        response = client.post(path, json=body)
+        assert response.status_code == 400
+        assert response.get_json() == {"error": "Request body must be a JSON object"}
+
+
+@pytest.mark.parametrize('choice_indexes', [0, "0,1", {"0": 1}, [], None])
+def test_choice_indexes_must_be_a_non_empty_list(client, choice_indexes):
+    response = client.post('/api/choices', json={'choice_indexes': choice_indexes, 'other': 1})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "choice_indexes must be a non-empty list", "step": None}
+
+
+def test_batch_size_is_capped(client):
+    response = client.post('/api/choices', json={'choice_indexes': [0] * (index.CHOICE_BATCH_MAX + 1)})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == f"At most {index.CHOICE_BATCH_MAX} choices per batch"
+
+
+@pytest.mark.parametrize('choice_indexes, step, message', [
+    ([0, 99], 1, "Invalid choice index"),
+    ([0, 0, "left"], 2, "Choice index must be a number"),
+    ([True], 0, "Choice index must be a number"),
+])
+def test_invalid_step_reports_its_index(client, choice_indexes, step, message):
+    response = client.post('/api/choices', json={'choice_indexes': choice_indexes})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": message, "step": step}
+
+
+def test_failed_batch_leaves_the_session_unchanged(client):
+    before = stored_state(client)
+    snapshot = {key: (list(value) if isinstance(value, list) else
+                      dict(value) if isinstance(value, dict) else value) for key, value in before.items()}
+
+    assert client.post('/api/choices', json={'choice_indexes': [0, 0, 99]}).status_code == 400
+
+    assert stored_state(client) == snapshot
+
+
+def test_batch_matches_single_choices(client):
+    other = index.app.test_client()
+    other.set_cookie('session_id', 'batch-twin')
+    other.get('/api/state')
+    for _ in range(2):
+        assert other.post('/api/choice', json={'choice_index': 0}).status_code == 200
+    batch = client.post('/api/choices', json={'choice_indexes': [0, 0]})
+
+    assert batch.status_code == 200
+    assert stored_state(client)['path_history'] == stored_state(other)['path_history']
+    assert batch.get_json()['current_node'] == other.get('/api/state').get_json()['current_node']
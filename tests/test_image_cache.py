@@ -0,0 +1,207 @@
+"""ImageCache and ImagePrefetcher against a local stand-in for the image generator."""
+import http.server
+import os
+import threading
+import time
+
+import pytest
+
+import index
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 1000
+
+
+class StandInImageServer:
+    """Answers every GET with the same PNG, optionally after a delay, counting requests"""
+    def __init__(self):
+        self.delay = 0
+        self.paths = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.paths.append(self.path)
+                time.sleep(server.delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(PNG)))
+                self.end_headers()
+                try:
+                    self.wfile.write(PNG)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}/prompt/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    server = StandInImageServer()
+    monkeypatch.setattr(index, 'IMAGE_UPSTREAM_BASE', server.base)
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = index.ImageCache(directory=str(tmp_path), max_bytes=10 * len(PNG))
+    monkeypatch.setattr(index, 'image_cache', cache)
+    monkeypatch.setattr(index, 'IMAGE_PROXY', True)
+    return cache
+
+
+def prompt_url(name):
+    return f"{index.POLLINATIONS_BASE_URL}{name}?seed=1"
+
+
+def test_miss_fetches_upstream_then_hits_disk(cache, upstream):
+    key = cache.register(prompt_url('owl'))
+    assert cache.get(key) is None
+    assert cache.fetch(key) == PNG
+    assert upstream.paths == ['/prompt/owl?seed=1']
+    assert cache.fetch(key) == PNG
+    assert len(upstream.paths) == 1
+
+
+def test_unknown_key_is_not_fetched(cache, upstream):
+    assert cache.fetch('0' * 64) is None
+    assert upstream.paths == []
+
+
+def test_byte_cap_evicts_least_recently_used(cache, upstream):
+    cache.max_bytes = int(2.5 * len(PNG))
+    keys = [cache.register(prompt_url(f"tree-{i}")) for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.fetch(key)
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+    cache.get(keys[0])  # Touch the first one, so the second is now the oldest
+    cache.fetch(keys[2])
+
+    assert cache.get(keys[1]) is None
+    assert not os.path.exists(cache._path(keys[1], '.url'))
+    assert cache.get(keys[0]) == PNG and cache.get(keys[2]) == PNG
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['last_bytes'] <= cache.max_bytes
+
+
+def test_workers_sharing_a_directory_share_the_cap(tmp_path, upstream):
+    workers = [index.ImageCache(directory=str(tmp_path), max_bytes=int(3.5 * len(PNG))) for _ in range(2)]
+    for i in range(8):
+        worker = workers[i % 2]
+        worker.fetch(worker.register(prompt_url(f"fern-{i}")))
+
+    on_disk = sum(entry.stat().st_size for directory in os.scandir(tmp_path) if directory.is_dir()
+                  for entry in os.scandir(directory.path))
+    assert on_disk <= 3.5 * len(PNG)
+
+
+def test_orphaned_url_files_are_swept(cache, upstream):
+    cache.url_max_age = 60
+    orphan = cache.register(prompt_url('never-fetched'))
+    os.utime(cache._path(orphan, '.url'), (time.time() - 3600,) * 2)
+    fresh = cache.register(prompt_url('just-registered'))
+    cache.max_bytes = len(PNG)  # The next put goes over the cap and recounts the directory
+    cache.fetch(cache.register(prompt_url('moss')))
+
+    assert not os.path.exists(cache._path(orphan, '.url'))
+    assert os.path.exists(cache._path(fresh, '.url'))
+    assert cache.stats()['orphans_removed'] == 1
+    assert cache.stats()['last_orphans'] == 1
+
+
+def test_upstream_timeout_falls_back_to_502(cache, upstream, monkeypatch):
+    monkeypatch.setattr(index, 'IMAGE_FETCH_TIMEOUT', 0.2)
+    upstream.delay = 1
+    key = cache.register(prompt_url('slow'))
+
+    response = index.app.test_client().get(f"/api/image/{key}")
+
+    assert response.status_code == 502
+    assert response.get_json() == {"error": "Image generator unavailable"}
+    assert cache.get(key) is None
+
+
+def test_prefetch_fills_cache_and_credits_hits(cache, upstream):
+    prefetcher = index.ImagePrefetcher(cache, workers=2, max_inflight=4, per_session=4)
+    game_state = index.new_game_state()
+    node = index.STORY_GRAPH.get(game_state['current_node_id'])
+    session_data = {'state': game_state, 'style_preferences': ['fantasy']}
+
+    prefetcher.schedule('session-1', node, game_state, session_data)
+    futures = [future for _, future in prefetcher.sessions['session-1'][1]]
+    for future in futures:
+        future.result(timeout=5)
+
+    keys = [key for key, _ in prefetcher.sessions['session-1'][1]]
+    assert keys and all(cache.get(key) == PNG for key in keys)
+    prefetcher.record_use(keys[0])
+    stats = prefetcher.stats()
+    assert stats['completed'] == len(keys)
+    assert stats['hits'] == 1
+
+
+def test_prefetch_timeout_is_counted_as_failed(cache, upstream, monkeypatch):
+    monkeypatch.setattr(index, 'IMAGE_FETCH_TIMEOUT', 0.2)
+    upstream.delay = 1
+    prefetcher = index.ImagePrefetcher(cache, workers=1, max_inflight=1, per_session=1)
+    game_state = index.new_game_state()
+    node = index.STORY_GRAPH.get(game_state['current_node_id'])
+
+    prefetcher.schedule('session-2', node, game_state, {'state': game_state})
+    prefetcher.sessions['session-2'][1][0][1].result(timeout=5)
+
+    assert prefetcher.stats()['failed'] == 1
+    assert prefetcher.stats()['completed'] == 0
+
+
+def test_per_session_cap_counts_fetches_still_in_flight(cache, upstream):
+    upstream.delay = 0.5
+    prefetcher = index.ImagePrefetcher(cache, workers=2, max_inflight=8, per_session=2)
+    game_state = index.new_game_state()
+    session_data = {'state': game_state}
+    prefetcher.schedule('clicker', index.STORY_GRAPH.get('start'), game_state, session_data)
+    first = [future for _, future in prefetcher.sessions['clicker'][1]]
+    while not all(future.running() or future.done() for future in first):
+        time.sleep(0.01)
+
+    # Click straight through to the next node while both fetches are still running
+    assert index.apply_choice(game_state, 0, 'clicker') is None
+    node = index.STORY_GRAPH.get(game_state['current_node_id'])
+    prefetcher.schedule('clicker', node, game_state, session_data)
+
+    pending = prefetcher.sessions['clicker'][1]
+    assert len(pending) == 2
+    assert [future for _, future in pending] == first
+    assert prefetcher.stats()['submitted'] == 2
+    for future in first:
+        future.result(timeout=5)
+
+
+def fetches_timed():
+    series = index.metrics.histograms['image_fetch_seconds'][3]
+    return series.get((), [0])[-1]
+
+
+def test_flask_and_asgi_both_time_upstream_fetches(cache, upstream):
+    pytest.importorskip('starlette')
+    from starlette.testclient import TestClient
+    import asgi
+
+    before = fetches_timed()
+    assert index.app.test_client().get(f"/api/image/{cache.register(prompt_url('flask'))}").status_code == 200
+    assert fetches_timed() == before + 1
+
+    with TestClient(asgi.app) as client:
+        assert client.get(f"/api/image/{cache.register(prompt_url('asgi'))}").status_code == 200
+    assert fetches_timed() == before + 2
@@ -0,0 +1,88 @@
+"""LRUCache bounds (count, bytes, TTL), shard striping and counters."""
+import index
+
+
+def test_least_recently_used_entry_is_evicted_first():
+    cache = index.LRUCache(capacity=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1  # 'b' is now the oldest
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(index.time, 'monotonic', lambda: now[0])
+    cache = index.LRUCache(capacity=10, ttl=30)
+    cache.set('default', 'x')
+    cache.set('longer', 'y', ttl=120)
+
+    now[0] += 29
+    assert cache.get('default') == 'x'
+    now[0] += 2
+    assert cache.get('default') is None
+    assert cache.get('longer') == 'y'
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['entries'] == 1
+
+
+def test_byte_cap_evicts_until_under_the_cap():
+    cache = index.LRUCache(capacity=100, max_bytes=100, sizer=len)
+    for key in 'abcd':
+        cache.set(key, 'x' * 30)
+    cache.set('e', 'x' * 50)
+
+    stats = cache.stats()
+    assert stats['bytes'] <= 100
+    assert [key for key in 'abcde' if cache.get(key) is not None] == ['d', 'e']
+    assert stats['evictions'] == 3
+
+
+def test_replacing_an_entry_does_not_double_count_bytes():
+    cache = index.LRUCache(capacity=10, max_bytes=100, sizer=len)
+    cache.set('a', 'x' * 60)
+    cache.set('a', 'x' * 70)
+    assert cache.stats()['bytes'] == 70
+    assert cache.get('a') == 'x' * 70
+
+
+def test_shards_split_limits_and_keep_keys_apart():
+    cache = index.LRUCache(capacity=8, max_bytes=80, shards=4)
+    assert len(cache.shards) == 4
+    assert all(shard.capacity == 2 and shard.max_bytes == 20 for shard in cache.shards)
+    for i in range(50):
+        cache.set(f"key-{i}", i)
+    assert cache.stats()['entries'] <= 8
+    for shard in cache.shards:
+        assert len(shard.cache) <= 2
+        assert all(cache._shard(key) is shard for key in shard.cache)
+
+
+def test_hit_and_miss_counters():
+    cache = index.LRUCache(capacity=10, shards=2)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('a')
+    cache.get('missing')
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 1)
+    assert stats['hit_rate'] == 2 / 3
+
+
+def test_dirty_snapshots_survive_eviction():
+    cache = index.LRUCache(capacity=1)
+    cache.set('a', 1)
+    cache.mark_dirty('a', b'blob')
+    cache.set('b', 2)
+
+    assert cache.get('a') is None
+    assert cache.get_dirty('a') == b'blob'
+    assert cache.mark_dirty('a', b'older', replace=False) == 1
+    assert cache.pop_dirty() == {'a': b'blob'}
+    assert cache.stats()['dirty'] == 0
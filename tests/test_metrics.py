@@ -0,0 +1,74 @@
+"""Per-worker metric snapshots merge into one Prometheus text exposition."""
+import index
+
+
+def worker_snapshot(requests, latencies, gauges):
+    registry = index.MetricsRegistry()
+    registry.counter('requests_total', 'Requests served', ('endpoint',))
+    registry.histogram('request_seconds', 'Request latency', ('endpoint',), buckets=(0.1, 1.0))
+    for endpoint, count in requests.items():
+        registry.inc('requests_total', (endpoint,), count)
+    for value in latencies:
+        registry.observe('request_seconds', value, ('state',))
+    registry.collector(lambda: gauges)
+    return registry.snapshot()
+
+
+def test_snapshots_merge_across_workers():
+    first = worker_snapshot({'state': 2, 'choice': 1}, [0.05, 2.0], {'cache_hits': 3, 'max_batch': 4})
+    second = worker_snapshot({'state': 5}, [0.5], {'cache_hits': 7, 'max_batch': 2})
+
+    counters, histograms, gauges = index.merge_metric_snapshots([first, second])
+
+    assert counters['requests_total'][2] == {('state',): 7, ('choice',): 1}
+    counts = histograms['request_seconds'][3][('state',)]
+    assert counts[:3] == [1, 1, 1]  # <=0.1, <=1.0, +Inf
+    assert counts[-2] == 2.55 and counts[-1] == 3
+    assert gauges == {'cache_hits': 10, 'max_batch': 4}  # high-water marks merge by max
+
+
+def test_prometheus_text_format():
+    snapshot = worker_snapshot({'say "hi"\n': 1}, [0.05, 0.5, 5.0], {'cache_hits': 3})
+
+    lines = index.render_prometheus([snapshot, snapshot]).splitlines()
+
+    assert 'forest_workers 2' in lines
+    assert '# HELP forest_requests_total Requests served' in lines
+    assert '# TYPE forest_requests_total counter' in lines
+    assert 'forest_requests_total{endpoint="say \\"hi\\"\\n"} 2' in lines
+    assert '# TYPE forest_request_seconds histogram' in lines
+    # Buckets are cumulative and end with +Inf == _count
+    assert 'forest_request_seconds_bucket{endpoint="state",le="0.1"} 2' in lines
+    assert 'forest_request_seconds_bucket{endpoint="state",le="1.0"} 4' in lines
+    assert 'forest_request_seconds_bucket{endpoint="state",le="+Inf"} 6' in lines
+    assert 'forest_request_seconds_count{endpoint="state"} 6' in lines
+    assert '# TYPE forest_cache_hits gauge' in lines
+    assert 'forest_cache_hits 6' in lines
+
+
+def test_metrics_route_needs_a_configured_token(monkeypatch):
+    from starlette.testclient import TestClient
+    import asgi
+
+    monkeypatch.setattr(index, 'METRICS_TOKEN', '')
+    with TestClient(asgi.app) as asgi_client:
+        for client in (index.app.test_client(), asgi_client):
+            assert client.get('/api/metrics').status_code == 404
+            assert client.get('/api/metrics', headers={'Authorization': 'Bearer '}).status_code == 404
+
+
+def test_metrics_route_checks_the_bearer_token(monkeypatch, tmp_path):
+    from starlette.testclient import TestClient
+    import asgi
+
+    monkeypatch.setattr(index, 'METRICS_TOKEN', 's3cret')
+    monkeypatch.setattr(index, 'METRICS_DIR', str(tmp_path))
+    with TestClient(asgi.app) as asgi_client:
+        for client in (index.app.test_client(), asgi_client):
+            assert client.get('/api/metrics').status_code == 401
+            assert client.get('/api/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+            assert client.get('/api/metrics', headers={'Authorization': 's3cret'}).status_code == 401
+            response = client.get('/api/metrics', headers={'Authorization': 'Bearer s3cret'})
+            assert response.status_code == 200
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert 'forest_workers ' in response.text
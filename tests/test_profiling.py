@@ -0,0 +1,73 @@
+"""Per-request profiling: one profiler at a time, always released."""
+import os
+import threading
+
+import pytest
+
+import index
+
+
+@pytest.fixture
+def profiling(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, 'PROFILE_ADMIN_TOKEN', 'tok')
+    monkeypatch.setattr(index, 'PROFILE_DIR', str(tmp_path))
+    yield tmp_path
+    assert not index._profile_lock.locked()
+
+
+def profiled_request(entered, leave, results):
+    """Runs the profiling hooks around a request that waits for leave"""
+    with index.app.test_request_context('/api/state', headers={'X-Profile': 'tok'}):
+        index.start_request_profile()
+        entered.set()
+        leave.wait(5)
+        response = index.finish_request_profile(index.app.response_class('ok'))
+        index.teardown_request_profile()
+        results.append(response.headers.get('X-Profile-File'))
+
+
+def test_overlapping_requests_profile_one_at_a_time(profiling):
+    first_in, second_in, release = threading.Event(), threading.Event(), threading.Event()
+    first, second = [], []
+    threads = [threading.Thread(target=profiled_request, args=(first_in, release, first))]
+    threads[0].start()
+    assert first_in.wait(5)
+    threads.append(threading.Thread(target=profiled_request, args=(second_in, release, second)))
+    threads[1].start()
+    assert second_in.wait(5)  # the overlapping request got through its before_request hook
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert first[0] is not None and second == [None]
+    assert os.listdir(profiling) == [first[0]]
+
+    # Once the first profile is saved the next request is profiled again
+    third = []
+    done = threading.Event()
+    done.set()
+    profiled_request(threading.Event(), done, third)
+    assert third[0] is not None
+
+
+def test_failed_request_releases_the_profiler(profiling):
+    with index.app.test_request_context('/api/state', headers={'X-Profile': 'tok'}):
+        index.start_request_profile()
+        assert index._profile_lock.locked()
+        index.teardown_request_profile(RuntimeError('handler raised'))  # after_request never ran
+    assert not index._profile_lock.locked()
+
+
+def test_enable_failure_skips_profiling(profiling, monkeypatch):
+    import cProfile
+
+    class Busy(cProfile.Profile):
+        def enable(self, *args, **kwargs):
+            raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(cProfile, 'Profile', Busy)
+    with index.app.test_request_context('/api/state', headers={'X-Profile': 'tok'}):
+        index.start_request_profile()
+        response = index.finish_request_profile(index.app.response_class('ok'))
+    assert 'X-Profile-File' not in response.headers
+    assert os.listdir(profiling) == []
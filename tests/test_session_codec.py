@@ -0,0 +1,93 @@
+"""The compact session format round-trips and rejects what it cannot read."""
+import logging
+import pickle
+import struct
+
+import pytest
+
+import index
+
+
+def played_session():
+    session = {'style_preferences': ['fantasy', 'ethereal', 'dramatic'],
+               'personality_traits': ['bold', 'curious', 'practical'],
+               'state': index.new_game_state()}
+    for _ in range(3):
+        assert index.apply_choice(session['state'], 0, 'codec-test') is None
+    session.update(index.init_player_extras())
+    session['achievements'].add('first_steps')
+    session['stats']['unique_nodes'].update(session['state']['path_history'])
+    return session
+
+
+def test_full_game_round_trips_including_sets():
+    session = played_session()
+    blob = index.encode_session(session)
+
+    assert blob[:2] == index.SESSION_CODEC_MAGIC
+    assert blob[2] == index.SESSION_CODEC_VERSION
+    assert index.decode_session(blob) == session
+    assert len(blob) < len(pickle.dumps(session))
+
+
+def test_new_session_without_state_round_trips():
+    assert index.decode_session(index.encode_session({'state': None})) == {'state': None}
+
+
+def test_float_score_falls_back_to_json():
+    session = played_session()
+    session['state']['score'] = 2.5
+    blob = index.encode_session(session)
+
+    assert blob[2] == 0
+    assert index.decode_session(blob) == session
+
+
+def test_unknown_history_node_falls_back_to_json():
+    session = played_session()
+    session['state']['choice_history'][0]['from_node'] = 'renamed_node'
+    blob = index.encode_session(session)
+
+    assert blob[2] == 0
+    assert index.decode_session(blob) == session
+
+
+def corrupt(blob, field):
+    if field == 'version':
+        return blob[:2] + bytes([99]) + blob[3:]
+    if field == 'fingerprint':
+        _, version, fingerprint, flags = index._CODEC_HEADER.unpack_from(blob)
+        return index._CODEC_HEADER.pack(index.SESSION_CODEC_MAGIC, version, fingerprint ^ 1, flags) + blob[9:]
+    return blob[:len(blob) // 2]
+
+
+@pytest.mark.parametrize('field', ['version', 'fingerprint', 'truncated'])
+def test_unreadable_blobs_are_rejected(field):
+    blob = corrupt(index.encode_session(played_session()), field)
+    with pytest.raises((ValueError, struct.error)):
+        index.decode_session(blob)
+
+
+@pytest.mark.parametrize('field', ['version', 'fingerprint', 'truncated'])
+def test_unreadable_stored_session_starts_a_new_game(field, monkeypatch):
+    session_id = f"corrupt{field}"
+    monkeypatch.setattr(index, 'session_flusher', None)
+    index.session_store.save(session_id, corrupt(index.encode_session(played_session()), field))
+    client = index.app.test_client()
+    client.set_cookie('session_id', session_id)
+
+    response = client.get('/api/state')
+
+    assert response.status_code == 200
+    assert response.get_json()['current_node']['situation'] == index.STORY_GRAPH.get('start').situation
+
+
+def test_pickles_are_skipped_with_a_warning_unless_enabled(monkeypatch, caplog):
+    blob = pickle.dumps(played_session())
+    with caplog.at_level(logging.WARNING):
+        with pytest.raises(ValueError):
+            index.decode_session(blob)
+    assert 'migrate_sessions.py' in caplog.text
+
+    monkeypatch.setattr(index, 'SESSION_LEGACY_PICKLE', True)
+    assert index.decode_session(blob)['state']['path_history'][0] == 'start'
@@ -0,0 +1,65 @@
+"""Each game request loads its session exactly once and saves it at most once."""
+import pytest
+
+import index
+
+
+@pytest.fixture(autouse=True)
+def fresh_counts():
+    with index._session_io_lock:
+        index.SESSION_IO_COUNTS.clear()
+    yield
+
+
+def io_for(endpoint):
+    return index.session_io_counts().get(endpoint, {'loads': 0, 'saves': 0})
+
+
+def assert_one_load_at_most_one_save(endpoint, requests):
+    counts = io_for(endpoint)
+    assert counts['loads'] == requests
+    assert counts['saves'] <= requests
+
+
+def test_flask_state_choice_and_choices():
+    client = index.app.test_client()
+
+    assert client.get('/api/state').status_code == 200
+    assert io_for('get_current_state') == {'loads': 1, 'saves': 1}
+    assert client.get('/api/state').status_code == 200
+    assert io_for('get_current_state') == {'loads': 2, 'saves': 1}
+
+    assert client.post('/api/choice', json={'choice_index': 0}).status_code == 200
+    assert io_for('make_choice') == {'loads': 1, 'saves': 1}
+
+    assert client.post('/api/choices', json={'choice_indexes': [0, 0]}).status_code == 200
+    assert io_for('make_choices') == {'loads': 1, 'saves': 1}
+
+    # A rejected choice still loads once but must not save
+    assert client.post('/api/choice', json={'choice_index': 99}).status_code == 400
+    assert io_for('make_choice') == {'loads': 2, 'saves': 1}
+    assert 'background' not in index.session_io_counts()
+
+
+def test_flask_reset():
+    client = index.app.test_client()
+    client.get('/api/state')
+    assert client.post('/api/reset').status_code == 200
+    assert io_for('reset_game') == {'loads': 1, 'saves': 1}
+
+
+def test_asgi_counts_per_endpoint():
+    pytest.importorskip('starlette')
+    pytest.importorskip('httpx')
+    from starlette.testclient import TestClient
+    import asgi
+
+    with TestClient(asgi.app) as client:
+        assert client.get('/api/state').status_code == 200
+        assert client.post('/api/choice', json={'choice_index': 0}).status_code == 200
+        assert client.post('/api/choices', json={'choice_indexes': [0]}).status_code == 200
+        assert client.post('/api/reset').status_code == 200
+
+    for endpoint in ('get_current_state', 'make_choice', 'make_choices', 'reset_game'):
+        assert_one_load_at_most_one_save(endpoint, 1)
+    assert 'background' not in index.session_io_counts()
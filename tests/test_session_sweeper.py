@@ -0,0 +1,69 @@
+"""Swept sessions disappear from the store and from the hot cache."""
+import os
+import time
+
+import index
+
+
+def test_sweep_evicts_swept_sessions_from_the_hot_cache(tmp_path):
+    store = index.FileSessionStore(str(tmp_path))
+    cache = index.LRUCache(capacity=10)
+    sweeper = index.SessionSweeper(store, interval=0, max_age=3600, cache=cache)
+    for session_id, age in (('oldsession', 7200), ('newsession', 0)):
+        session = {'state': index.new_game_state()}
+        store.save(session_id, index.encode_session(session))
+        cache.set(session_id, session)
+        stamp = time.time() - age
+        os.utime(store._path(session_id), (stamp, stamp))
+
+    result = sweeper.sweep()
+
+    assert result['removed'] == ['oldsession']
+    assert store.load('oldsession') is None and cache.get('oldsession') is None
+    assert cache.get('newsession') is not None
+
+
+def test_sweep_names_sessions_stored_under_a_hashed_file_name(tmp_path):
+    store = index.FileSessionStore(str(tmp_path))
+    cache = index.LRUCache(capacity=10)
+    sweeper = index.SessionSweeper(store, interval=0, max_age=3600, cache=cache)
+    session_id = '../odd cookie=1'
+    session = {'state': index.new_game_state()}
+    store.save(session_id, index.encode_session(session))
+    cache.set(session_id, session)
+    assert session_id not in store._path(session_id)
+    assert list(store.iter_ids()) == [session_id]
+    stamp = time.time() - 7200
+    os.utime(store._path(session_id), (stamp, stamp))
+
+    assert sweeper.sweep()['removed'] == [session_id]
+    assert cache.get(session_id) is None
+    assert store.load(session_id) is None
+    assert os.listdir(os.path.dirname(store._path(session_id))) == []  # the .id file went too
+
+
+def test_only_the_first_sweep_scans_the_flat_layout(tmp_path):
+    store = index.FileSessionStore(str(tmp_path))
+    (tmp_path / 'unrelated.txt').write_text('not a session')
+    for name in ('session_first.pkl', 'session_second.pkl'):
+        (tmp_path / name).write_bytes(index.encode_session({'state': None}))
+        stamp = time.time() - 7200
+        os.utime(tmp_path / name, (stamp, stamp))
+
+    assert sorted(store.sweep(3600, 0)['removed']) == ['first', 'second']
+    (tmp_path / 'session_third.pkl').write_bytes(b'')
+    os.utime(tmp_path / 'session_third.pkl', (stamp, stamp))
+    assert store.sweep(3600, 0)['removed'] == []
+    assert (tmp_path / 'unrelated.txt').exists()
+
+
+def test_background_threads_start_on_first_use(tmp_path):
+    store = index.FileSessionStore(str(tmp_path))
+    flusher = index.SessionFlusher(index.LRUCache(capacity=10), store, interval=60)
+    assert flusher.thread is None
+
+    flusher.mark_dirty('lazysession', index.encode_session({'state': None}))
+
+    assert flusher.thread.is_alive()
+    flusher.shutdown()
+    assert store.load('lazysession') is not None
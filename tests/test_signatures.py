@@ -0,0 +1,50 @@
+"""Save signatures are checked before storage, and the check fails closed."""
+import pytest
+
+import index
+
+WALLET = '0x' + '1' * 40
+
+
+def save(client, wallet, message, signature):
+    return client.post('/api/save-to-blockchain', json={
+        'walletAddress': wallet, 'gameData': {'score': 3}, 'signature': signature, 'message': message})
+
+
+def test_missing_library_rejects_every_save(monkeypatch):
+    verifier = index.SignatureVerifier(mode='eip191')
+    verifier.available = False  # As if eth_account were not installed
+    monkeypatch.setattr(index, 'signature_verifier', verifier)
+
+    response = save(index.app.test_client(), WALLET, 'unverifiable', '0x' + 'ab' * 65)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert index.blockchain_log.summary(WALLET) is None
+
+
+def test_eip191_accepts_the_wallet_and_rejects_forgeries(monkeypatch):
+    pytest.importorskip('eth_account')
+    from eth_account import Account
+    from eth_account.messages import encode_defunct
+
+    account = Account.create()
+    message = 'Save my Mystic Forest game'
+    signature = Account.sign_message(encode_defunct(text=message), account.key).signature.hex()
+    if not signature.startswith('0x'):
+        signature = '0x' + signature
+    verifier = index.SignatureVerifier(mode='eip191', workers=1)
+    monkeypatch.setattr(index, 'signature_verifier', verifier)
+    client = index.app.test_client()
+    try:
+        forged = save(client, WALLET, message, signature)
+        assert forged.status_code == 400
+        assert forged.get_json() == {"error": "Signature does not match wallet"}
+
+        genuine = save(client, account.address, message, signature)
+        assert genuine.status_code == 200
+        assert index.blockchain_log.summary(account.address)['count'] == 1
+        assert verifier.stats() == {'cached': 0, 'verified': 1, 'rejected': 1}
+    finally:
+        if verifier.pool is not None:
+            verifier.pool.shutdown()
@@ -0,0 +1,39 @@
+"""/api/state bodies spliced from cached fragments match jsonify of the plain dict."""
+import json
+
+import pytest
+
+import index
+
+IMAGE_URL = 'https://image.pollinations.ai/prompt/forest%20"quoted"%20é?seed=7'
+
+
+def expected_body(node_id, score, image_url):
+    node = index.story_nodes[node_id]
+    state_details = {
+        "current_node": node,
+        "score": score,
+        "image_url": image_url,
+        "is_end": node.get("is_end", False),
+        "choices": node.get("choices", []),
+        "situation": node.get("situation", ""),
+    }
+    # What jsonify produces outside debug mode: sorted keys, compact, ASCII, trailing newline
+    return (json.dumps(state_details, sort_keys=True, separators=(',', ':')) + '\n').encode()
+
+
+@pytest.mark.parametrize('node_id', list(index.story_nodes))
+@pytest.mark.parametrize('score', [0, -3, 12])
+def test_state_body_matches_jsonify(node_id, score):
+    node = index.STORY_GRAPH.get(node_id)
+    assert index.state_body(node, score, IMAGE_URL) == expected_body(node_id, score, IMAGE_URL)
+
+
+@pytest.mark.parametrize('node_id', list(index.story_nodes))
+def test_render_state_matches_jsonify(node_id):
+    node = index.STORY_GRAPH.get(node_id)
+    with index.app.app_context():
+        response = index.render_state(node, 5, IMAGE_URL)
+        plain = index.jsonify(json.loads(expected_body(node_id, 5, IMAGE_URL)))
+    assert response.mimetype == 'application/json'
+    assert response.get_data() == expected_body(node_id, 5, IMAGE_URL) == plain.get_data()
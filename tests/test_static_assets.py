@@ -0,0 +1,82 @@
+"""AssetStore content negotiation, revalidation and the static routes."""
+import json
+
+import pytest
+
+import index
+
+
+@pytest.fixture
+def store(tmp_path):
+    build = tmp_path / 'build'
+    build.mkdir()
+    (build / 'script.1234.js').write_bytes(b'console.log("forest");')
+    (build / 'script.1234.js.gz').write_bytes(b'gzip bytes')
+    (build / 'script.1234.js.br').write_bytes(b'br bytes')
+    (build / 'manifest.json').write_text(json.dumps({'files': {'script.js': {
+        'file': 'script.1234.js',
+        'encodings': {'gzip': 'script.1234.js.gz', 'br': 'script.1234.js.br'},
+        'sha256': 'ab' * 32,
+    }}}))
+    return index.AssetStore(public_dir=str(tmp_path / 'public'), build_dir=str(build))
+
+
+@pytest.mark.parametrize('accept_encoding, encoding', [
+    (None, 'identity'),
+    ('gzip, deflate, br', 'br'),
+    ('gzip', 'gzip'),
+    ('br;q=0, gzip', 'gzip'),
+    ('br;q=0, gzip;q=0', 'identity'),
+    ('identity', 'identity'),
+])
+def test_encoding_follows_accept_encoding(store, accept_encoding, encoding):
+    status, body, headers = store.respond('script.js', accept_encoding, None)
+
+    assert status == 200
+    assert headers.get('Content-Encoding', 'identity') == encoding
+    assert body == store.get('script.js').variants[encoding]
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert headers['Content-Type'].startswith(('application/javascript', 'text/javascript'))
+
+
+def test_fingerprinted_name_is_immutable(store):
+    assert store.respond('script.js', None, None)[2]['Cache-Control'] == 'no-cache'
+    assert 'immutable' in store.respond('script.1234.js', None, None)[2]['Cache-Control']
+
+
+def test_matching_etag_is_not_modified(store):
+    _, _, headers = store.respond('script.js', 'gzip', None)
+
+    status, body, not_modified = store.respond('script.js', 'gzip', headers['ETag'])
+    assert (status, body) == (304, b'')
+    assert not_modified['ETag'] == headers['ETag']
+    # The identity bytes are a different representation, so its ETag must not match
+    assert store.respond('script.js', None, headers['ETag'])[0] == 200
+    assert store.stats()['not_modified'] == 1
+
+
+def test_unknown_names_fall_back_to_disk(store):
+    assert store.respond('missing.js', 'gzip', None) is None
+    assert store.respond('../build/manifest.json', 'gzip', None) is None
+
+
+def test_unbuilt_public_files_are_gzipped_in_memory(tmp_path):
+    public = tmp_path / 'public'
+    public.mkdir()
+    (public / 'style.css').write_text('body { color: green; }\n' * 50)
+    store = index.AssetStore(public_dir=str(public), build_dir=str(tmp_path / 'no-build'))
+
+    status, body, headers = store.respond('style.css', 'gzip', None)
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Content-Type'] == 'text/css; charset=utf-8'
+    assert store.respond('style.css', 'br', None)[2].get('Content-Encoding') is None
+
+
+@pytest.mark.parametrize('path', ['/..%2Fapi%2Findex.py', '/%2e%2e/api/index.py', '/..%2F..%2Fetc%2Fpasswd'])
+def test_path_traversal_is_not_found(path):
+    from starlette.testclient import TestClient
+    import asgi
+
+    assert index.app.test_client().get(path).status_code == 404
+    with TestClient(asgi.app) as client:
+        assert client.get(path).status_code == 404
@@ -0,0 +1,51 @@
+"""compile_story rejects broken stories and hands out read-only node data."""
+import copy
+
+import pytest
+
+import index
+
+
+def story():
+    return copy.deepcopy(index.story_nodes)
+
+
+def test_the_shipped_story_compiles():
+    assert index.STORY_GRAPH.get('start').index == 0
+    assert len(index.STORY_GRAPH.nodes) == len(index.story_nodes)
+
+
+def test_dangling_next_node_is_rejected():
+    nodes = story()
+    nodes['start']['choices'][0]['next_node'] = 'no_such_node'
+    with pytest.raises(ValueError, match="choice 0 of 'start' points to unknown node 'no_such_node'"):
+        index.compile_story(nodes)
+
+
+def test_duplicate_node_id_is_rejected():
+    pairs = list(story().items())
+    pairs.append(('deep_forest', pairs[1][1]))
+    with pytest.raises(ValueError, match="node 'deep_forest' is defined more than once"):
+        index.compile_story(pairs)
+
+
+def test_missing_start_and_endings_are_rejected():
+    nodes = story()
+    del nodes['merchant_ending']
+    with pytest.raises(ValueError, match="ending 'merchant_ending' is missing"):
+        index.compile_story(nodes, start='nowhere')
+
+
+def test_node_and_choice_payloads_are_read_only():
+    node = index.STORY_GRAPH.get('start')
+    with pytest.raises(TypeError):
+        node.payload['situation'] = 'changed'
+    with pytest.raises(TypeError):
+        node.payload['choices'][0]['text'] = 'changed'
+    with pytest.raises((TypeError, AttributeError)):
+        node.payload['choices'].append({})
+    with pytest.raises(TypeError):
+        index.get_node_details('start')['seed'] = 1
+    with pytest.raises(TypeError):
+        index.CUSTOM_ENDINGS['generic_good_ending'] = ()
+    assert node.payload['situation'] == index.story_nodes['start']['situation']